@@ -9,19 +9,44 @@ Generated at: 2025-01-17
 import simpy
 import random
 import json
+import ast
 import asyncio
 import websockets
 import logging
+import logging.handlers
+import atexit
+import signal
 import time
 import queue
 import os
 import sys
 import functools
-from typing import Dict, List, Any, Optional, Set, Callable
-from dataclasses import dataclass, asdict
+import importlib
+import bisect
+import heapq
+import math
+import operator
+import re
+import zlib
+import types
+import textwrap
+import io
+import tokenize
+import marshal
+import pickle
+import hashlib
+import cProfile
+import pstats
+import tracemalloc
+import itertools
+import http.server
+from typing import Dict, List, Any, Optional, Set, Callable, Tuple
+from dataclasses import dataclass, field, asdict
 from enum import Enum
 import numpy as np
-from collections import deque
+from collections import deque, ChainMap, defaultdict
+from collections.abc import Mapping, MutableMapping
+import xml.etree.ElementTree as ET
 import threading
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
@@ -44,6 +69,7 @@ class ActivityTimelineLogger:
         # 活动执行记录
         self.timeline_records = []
         self.activity_stats = {}
+        self.invocation_counts = {}  # 各Activity调用次数（所有埋点级别都会统计，OFF除外）
         
         # 初始化日志文件
         self._init_log_file()
@@ -61,6 +87,12 @@ class ActivityTimelineLogger:
         with open(self.log_file_path, 'w', encoding='utf-8') as f:
             json.dump(initial_data, f, ensure_ascii=False, indent=2)
     
+    def start_new_file(self, suffix: str):
+        """改写到新的时间线文件（fork出的分支各自记录分支点之后的活动，不与父进程和其他分支共用文件）"""
+        root, ext = os.path.splitext(self.log_file_path)
+        self.log_file_path = f"{root}_{suffix}{ext}"
+        self._init_log_file()
+    
     def log_activity_start(self, activity_name: str, entity_name: str, entity_id: str, sim_time: float):
         """记录Activity开始"""
         record = {
@@ -77,6 +109,11 @@ class ActivityTimelineLogger:
         self._append_to_file(record)
         
         # 更新统计信息
+        self.count_invocation(activity_name)
+    
+    def count_invocation(self, activity_name: str):
+        """仅记录调用次数（COUNTERS级别）"""
+        self.invocation_counts[activity_name] = self.invocation_counts.get(activity_name, 0) + 1
         if activity_name not in self.activity_stats:
             self.activity_stats[activity_name] = {
                 "count": 0,
@@ -106,6 +143,10 @@ class ActivityTimelineLogger:
         self._append_to_file(record)
         
         # 更新统计信息
+        self.record_execution(activity_name, entity_name, duration, sim_time)
+    
+    def record_execution(self, activity_name: str, entity_name: str, duration: float, sim_time: float):
+        """只更新汇总统计，不写时间线（SUMMARY级别）"""
         if activity_name in self.activity_stats:
             stats = self.activity_stats[activity_name]
             stats["count"] += 1
@@ -117,27 +158,15 @@ class ActivityTimelineLogger:
             })
     
     def _append_to_file(self, record: Dict):
-        """追加记录到文件"""
-        try:
-            # 读取现有数据
-            with open(self.log_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # 追加新记录
-            data["timeline"].append(record)
-            
-            # 写回文件
-            with open(self.log_file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-                
-        except Exception as e:
-            logging.error(f"写入Activity日志失败: {e}")
+        """追加记录到文件（交给日志监听线程写入，不阻塞仿真线程）"""
+        timeline_file_log.info('', extra={'timeline_record': record, 'timeline_path': self.log_file_path})
     
     def generate_summary_report(self, output_file: str):
         """生成执行摘要报告"""
         summary = {
             "total_activities": len(self.activity_stats),
             "total_executions": sum(stats["count"] for stats in self.activity_stats.values()),
+            "invocation_counts": dict(self.invocation_counts),
             "activity_details": {}
         }
         
@@ -158,11 +187,198 @@ class ActivityTimelineLogger:
 # 全局Activity记录器实例
 activity_logger = ActivityTimelineLogger()
 
+# ============================================================================
+# 异步日志管道模块（仿真线程只入队，由独立监听线程负责输出）
+# ============================================================================
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FILE = os.environ.get('LOG_FILE')  # 可选的文件输出
+LOG_FILE_ROTATION = os.environ.get('LOG_FILE_ROTATION', 'size')  # size: 按大小轮转, time: 按时间轮转
+LOG_FILE_MAX_BYTES = int(os.environ.get('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024))
+LOG_FILE_ROTATE_WHEN = os.environ.get('LOG_FILE_ROTATE_WHEN', 'midnight')
+LOG_FILE_BACKUP_COUNT = int(os.environ.get('LOG_FILE_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_OVERFLOW_POLICY = os.environ.get('LOG_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest / drop_newest
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """非阻塞队列日志处理器 - 队列满时按溢出策略丢弃，绝不阻塞调用线程"""
+    def __init__(self, log_queue: queue.Queue, overflow_policy: str = 'drop_oldest'):
+        super().__init__(log_queue)
+        if overflow_policy not in ('drop_oldest', 'drop_newest'):
+            raise ValueError(f'未知的日志溢出策略: {overflow_policy}')
+        self.overflow_policy = overflow_policy
+        self.dropped_count = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """在本线程展开消息文本（参数之后可能被修改），时间戳等完整格式化交给监听线程"""
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        
+        if self.overflow_policy == 'drop_oldest':
+            try:
+                oldest = self.queue.get_nowait()
+                self.queue.task_done()
+                if oldest is LogQueueListener._sentinel:
+                    # 监听线程正在停止，结束标记不能丢弃，改为丢弃新记录
+                    record = oldest
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                pass
+        self.dropped_count += 1
+
+class LogQueueListener(logging.handlers.QueueListener):
+    """日志监听线程 - 停止时阻塞等待队列空位放入结束标记（队列满时put_nowait会抛出queue.Full）"""
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+class TimelineQueueHandler(logging.handlers.QueueHandler):
+    """时间线记录队列处理器 - 无界队列，不丢弃记录（时间线必须完整）"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class TimelineFileHandler(logging.Handler):
+    """Activity时间线文件写入处理器 - 文件保持打开，每条记录只追加写入
+
+    新记录覆盖写在时间线数组的结尾标记处，随后重新写出结尾标记，文件在任意时刻都是完整的JSON。
+    直接写文件描述符，没有库缓冲：fork出的子进程关闭继承的描述符即可，不会重复写出父进程的数据。
+    """
+    TAIL = b'\n  ]\n}\n'
+
+    def __init__(self):
+        super().__init__()
+        self.files: Dict[str, list] = {}  # 路径 -> [文件描述符, 结尾标记位置, 数组是否为空]
+
+    def _open(self, path: str) -> list:
+        """打开时间线文件并定位到timeline数组的结尾（可能是其他进程写过一部分的文件）"""
+        fd = os.open(path, os.O_RDWR)
+        size = os.fstat(fd).st_size
+        tail = os.pread(fd, min(size, 64), max(0, size - 64))
+        body = tail.rstrip()
+        if not body.endswith(b'}') or not body[:-1].rstrip().endswith(b']'):
+            os.close(fd)
+            raise ValueError(f'时间线文件结尾不是timeline数组: {path}')
+        body = body[:-1].rstrip()[:-1].rstrip()
+        entry = self.files[path] = [fd, size - len(tail) + len(body), body.endswith(b'[')]
+        return entry
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            entry = self.files.get(record.timeline_path) or self._open(record.timeline_path)
+            fd, offset, empty = entry
+            data = (b'\n    ' if empty else b',\n    ') + json.dumps(
+                record.timeline_record, ensure_ascii=False, default=str).encode('utf-8')
+            os.pwrite(fd, data + self.TAIL, offset)
+            entry[1] = offset + len(data)
+            entry[2] = False
+        except Exception as e:
+            logging.error(f"写入Activity日志失败: {e}")
+
+    def close(self):
+        """关闭所有时间线文件（下次写入时重新打开并定位）"""
+        for fd, _, _ in self.files.values():
+            os.close(fd)
+        self.files = {}
+        super().close()
+
+class AsyncLoggingPipeline:
+    """日志管道 - QueueHandler + 独立监听线程，支持轮转文件输出"""
+    def __init__(self, queue_size: int = LOG_QUEUE_SIZE, overflow_policy: str = LOG_OVERFLOW_POLICY,
+                 log_file: Optional[str] = LOG_FILE):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_handler = NonBlockingQueueHandler(self.queue, overflow_policy)
+        self.listener = None
+        
+        # 时间线记录走独立的无界队列和监听线程，普通日志溢出时不会挤掉时间线记录
+        self.timeline_queue = queue.Queue()
+        self.timeline_handler = TimelineQueueHandler(self.timeline_queue)
+        self.timeline_listener = None
+        
+        formatter = logging.Formatter(LOG_FORMAT)
+        self.sinks: List[logging.Handler] = []
+        
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(formatter)
+        self.sinks.append(stream_handler)
+        
+        if log_file:
+            if LOG_FILE_ROTATION == 'time':
+                file_handler = logging.handlers.TimedRotatingFileHandler(
+                    log_file, when=LOG_FILE_ROTATE_WHEN, backupCount=LOG_FILE_BACKUP_COUNT, encoding='utf-8')
+            else:
+                file_handler = logging.handlers.RotatingFileHandler(
+                    log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT, encoding='utf-8')
+            file_handler.setFormatter(formatter)
+            self.sinks.append(file_handler)
+        
+        self.timeline_sink = TimelineFileHandler()
+
+    def start(self):
+        """启动监听线程（可重复调用，例如fork后在子进程中重启）"""
+        self.listener = LogQueueListener(self.queue, *self.sinks, respect_handler_level=True)
+        self.listener.start()
+        self.timeline_listener = logging.handlers.QueueListener(self.timeline_queue, self.timeline_sink)
+        self.timeline_listener.start()
+
+    def reset_after_fork(self):
+        """fork后在子进程中重建队列与监听线程（父进程的监听线程不会被复制）"""
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.queue_handler.queue = self.queue
+        self.queue_handler.dropped_count = 0
+        self.timeline_queue = queue.Queue()
+        self.timeline_handler.queue = self.timeline_queue
+        self.timeline_sink.close()  # 关闭继承的描述符，由子进程按需重新打开
+        self.listener = None
+        self.timeline_listener = None
+        self.start()
+
+    def stop(self):
+        """停止监听线程并输出队列中剩余的日志"""
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            listener.stop()
+            for sink in self.sinks:
+                try:
+                    sink.flush()
+                except (OSError, ValueError):
+                    pass  # 退出时输出流可能已被关闭（如被测试框架替换后关闭的stderr）
+            if self.queue_handler.dropped_count:
+                sys.stderr.write(f'日志队列溢出，共丢弃 {self.queue_handler.dropped_count} 条日志\n')
+        if self.timeline_listener is not None:
+            listener, self.timeline_listener = self.timeline_listener, None
+            listener.stop()
+            self.timeline_sink.close()
+
+def setup_logging(level: int = logging.INFO) -> AsyncLoggingPipeline:
+    """配置日志：根日志器与时间线日志器都只向队列写入"""
+    pipeline = AsyncLoggingPipeline()
+    
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(pipeline.queue_handler)
+    
+    timeline_logger = logging.getLogger('activity_timeline')
+    timeline_logger.setLevel(logging.INFO)
+    timeline_logger.propagate = False
+    timeline_logger.addHandler(pipeline.timeline_handler)
+    
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    return pipeline
+
 # 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+log_pipeline = setup_logging()
+timeline_file_log = logging.getLogger('activity_timeline')
 
 # 仿真常量
 SIMULATION_END_TIME = 1800  # 30分钟
@@ -172,6 +388,46 @@ RUN_MODE = 'step'  # 默认单步模式
 STEP_SIZE = 1  # 单步模式下每步1秒
 REAL_TIME_RATIO = 5.0  # 5倍速
 RANDOM_SEED = 123
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', 0))  # 检查点间隔（仿真秒），0表示关闭
+MAX_CHECKPOINTS = int(os.environ.get('MAX_CHECKPOINTS', 10))  # 最多保留的检查点数量
+TIMER_WHEEL_RESOLUTION = float(os.environ.get('TIMER_WHEEL_RESOLUTION', 1.0))  # 定时轮刻度（仿真秒）
+EVENT_QUEUE = os.environ.get('EVENT_QUEUE', 'heap')  # 事件表实现: heap(二叉堆，默认) / calendar(日历队列，CPython下基准慢于二叉堆)
+FLAT_ACTION_EXECUTION = os.environ.get('FLAT_ACTION_EXECUTION', '0') == '1'  # 动作内以yield from组合Activity，不创建子进程
+SPATIAL_CELL_SIZE = float(os.environ.get('SPATIAL_CELL_SIZE', 500.0))  # 空间网格单元边长（米）
+DEFAULT_SENSOR_RANGE = 1500.0  # 侦察班传感器作用距离（米）
+DETECTION_BASE_PROBABILITY = 0.45  # 零距离单次扫描发现概率，随距离平方衰减至作用距离处为0
+TERRAIN_FILE = os.environ.get('TERRAIN_FILE')  # 高程栅格(.npy，按行y、列x存放)，未设置时为平坦地形
+TERRAIN_CELL_SIZE = float(os.environ.get('TERRAIN_CELL_SIZE', 30.0))  # 栅格分辨率（米）
+TERRAIN_ORIGIN = (float(os.environ.get('TERRAIN_ORIGIN_X', -5000.0)), float(os.environ.get('TERRAIN_ORIGIN_Y', -5000.0)))  # 栅格(0,0)左下角的世界坐标
+OBSERVER_HEIGHT = 2.0  # 观察者视线高度（米）
+TARGET_HEIGHT = 2.5  # 目标可见部位高度（米）
+LOS_MAX_SAMPLES = 256  # 单条视线最大采样点数
+KINEMATICS_TICK = float(os.environ.get('KINEMATICS_TICK', 1.0))  # 运动学积分步长（仿真秒）
+PATROL_RADIUS = 200.0  # 环形巡逻半径（米）
+PATROL_ANGULAR_SPEED = 0.01  # 环形巡逻角速度（弧度/秒）
+FIRE_AIM_ERROR = 30.0  # 单门火炮诸元误差（米，标准差），同一炮的各发弹共享
+FIRE_RANGE_DISPERSION = 0.004  # 距离散布标准差占射距比例
+FIRE_DEFLECTION_DISPERSION = 0.002  # 方向散布标准差占射距比例
+FIRE_MIN_DISPERSION = 8.0  # 散布标准差下限（米）
+LETHAL_RADIUS = (20.0, 30.0)  # 单发弹对单个目标要素的杀伤半径（沿射向, 垂直射向，米）
+INTERACTION_MODEL_FILE = os.environ.get('INTERACTION_MODEL_FILE',
+                                        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                     'enhanced-battlefield-simulation-fixedV2.3.xml'))  # 交互QoS来源
+ENTITY_SCHEMA_FILE = os.environ.get('ENTITY_SCHEMA_FILE', INTERACTION_MODEL_FILE)  # 场景实体上下文字段（属性模式）来源
+CHANNEL_LATENCY = float(os.environ.get('CHANNEL_LATENCY', 0.5))  # 信道基础时延（仿真秒）
+CHANNEL_BANDWIDTH = float(os.environ.get('CHANNEL_BANDWIDTH', 9600.0))  # 信道带宽（bit/秒），战术电台量级
+CHANNEL_LOSS_PROBABILITY = float(os.environ.get('CHANNEL_LOSS_PROBABILITY', 0.0))  # 单次传输丢失概率（默认不丢失，交互QoS的 LossProbability 优先）
+CHANNEL_MAX_RETRIES = 5  # 可靠信道的最大重传次数
+MONITORED_STATE_VARIABLES = frozenset(
+    os.environ.get('MONITORED_STATE_VARIABLES', 'fire_status,patrol_status,alert_level').split(','))  # 统计驻留时间的状态变量
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR')  # 编译模型缓存目录，未设置时使用XML所在目录下的 __eaticache__
+MODEL_CACHE_VERSION = 1  # 编译模型结构变化时递增，使旧缓存失效
+MODEL_TRIGGER_INTERVAL = 1.0  # 解释执行模型时检查动作触发条件和事件的间隔（仿真秒）
+BATCH_EVALUATION_MIN_ENTITIES = int(os.environ.get('BATCH_EVALUATION_MIN_ENTITIES', 8))  # 同一触发条件的实体数达到该值时批量向量化求值
+ANALYSIS_TIME_STEP = float(os.environ.get('ANALYSIS_TIME_STEP', 1.0))  # 关键路径分析的时长离散步长（秒）
+ANALYSIS_SAMPLE_SIZE = 200000  # 无解析分布函数的分布（gamma）离散化时的样本量
+ANALYSIS_MAX_PATHS = 256  # 关键路径分析枚举的最大路径数
+SCENARIO_UNITS = os.environ.get('SCENARIO_UNITS')  # 按模板生成实体，如 "recon_squad=48,artillery_battalion=6,command_post=2"；未设置时使用原有3个实体
 random.seed(RANDOM_SEED)
 np.random.seed(RANDOM_SEED)
 
@@ -180,6 +436,27 @@ WS_HOST = '0.0.0.0'
 WS_PORT = int(os.environ.get('WS_PORT', 8765))
 WS_HEARTBEAT = 5
 DEFAULT_LOG_PUSH_INTERVAL = 1.0  # 默认日志推送间隔（秒）
+LOG_RETENTION_LEVEL = os.environ.get('LOG_RETENTION_LEVEL', 'INFO')  # 日志历史保留级别（供后连接的客户端查询）
+# 消息历史保留量（紧凑消息约为原dataclass表示的2/3大小，默认保留量约为原先的1.5~2倍，总内存相当）
+MESSAGE_HISTORY = int(os.environ.get('MESSAGE_HISTORY', 2000))  # 消息收集器保留的消息总数
+MESSAGE_HISTORY_PER_TYPE = int(os.environ.get('MESSAGE_HISTORY_PER_TYPE', 150))  # 每种消息类型保留的条数
+LOG_HISTORY = int(os.environ.get('LOG_HISTORY', 1000))  # 日志缓存（推送与LOG_MESSAGE查询）保留的条数
+
+# Activity埋点配置（批量复现可设为off/counters，实时会话保持full）
+INSTRUMENTATION_LEVEL = os.environ.get('INSTRUMENTATION_LEVEL', 'full')
+
+# 运行指标配置（关闭时不统计SimPy事件数和Activity墙钟耗时，也不启动推送与指标服务）
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', WS_PORT + 1))  # Prometheus文本格式指标端口，0表示不启动
+METRICS_PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', 5.0))  # METRIC_UPDATE推送间隔（秒）
+PROFILE_TOP_N = 30  # 性能剖析和内存快照默认返回的条目数
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', 16))  # tracemalloc记录的调用栈深度（用于按子系统归属）
+MEMORY_SNAPSHOT_LIMIT = 4  # 保留的内存快照数量
+TRACE_FILE = os.environ.get('TRACE_FILE')  # 设置时导出Chrome/Perfetto追踪文件
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))  # 动作采样比例，活动随所属动作记录
+TRACE_BUFFER_EVENTS = int(os.environ.get('TRACE_BUFFER_EVENTS', 5000))  # 缓冲的追踪事件达到该数量时批量写出
+METRICS_TIME_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0)  # 墙钟耗时直方图桶上界（秒）
 
 # 消息类型枚举
 class MessageType(Enum):
@@ -199,6 +476,10 @@ class MessageType(Enum):
     METRIC_UPDATE = "metric_update"
     SIMULATION_STATE_CHANGED = "simulation_state_changed"
     STEP_COMPLETED = "step_completed"
+    STATISTICS = "statistics"
+    CRITICAL_PATH = "critical_path"
+    PROFILE_RESULT = "profile_result"
+    MEMORY_REPORT = "memory_report"
 
 # 运行状态枚举
 class RunState(Enum):
@@ -207,26 +488,449 @@ class RunState(Enum):
     STEPPING = "stepping"
     STOPPED = "stopped"
 
-# 消息包装器
-@dataclass
-class SimulationMessage:
-    """仿真消息"""
-    type: MessageType
-    data: Any
-    timestamp: datetime = None
-    entity_id: Optional[str] = None
-    log_id: int = 0  # 新增：日志唯一ID
+# Activity埋点级别枚举
+class InstrumentationLevel(Enum):
+    OFF = "off"            # 不做任何记录
+    COUNTERS = "counters"  # 仅统计调用次数
+    SUMMARY = "summary"    # 调用次数 + 耗时汇总
+    FULL = "full"          # 完整时间线 + 运行日志 + 开始/完成消息
+
+# 延迟格式化的日志记录
+class LazyLogRecord:
+    """日志记录（模板 + 参数），首次需要文本时才格式化，且只格式化一次"""
+    __slots__ = ('template', 'args', '_text')
+
+    def __init__(self, template: str, args: tuple = ()):
+        self.template = template
+        self.args = args
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.template % self.args if self.args else self.template
+        return self._text
+
+    def __str__(self) -> str:
+        return self.text
+
+# 运行指标（计数器、仪表、直方图），定期以METRIC_UPDATE推送并以Prometheus文本格式对外提供
+class Counter:
+    """单调递增计数器，可带一个标签"""
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, label: str = None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values: Dict[str, float] = {}
+
+    def inc(self, label_value: str = '', amount: float = 1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def collect(self) -> Dict[str, float]:
+        return dict(self.values)
+
+class Gauge(Counter):
+    """仪表：直接设置，或指定 collector() 在读取时计算 {标签值: 数值}"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, label: str = None, collector: Callable = None):
+        super().__init__(name, help_text, label)
+        self.collector = collector
+
+    def set(self, value: float, label_value: str = ''):
+        self.values[label_value] = value
+
+    def collect(self) -> Dict[str, float]:
+        if self.collector is None:
+            return dict(self.values)
+        try:
+            return self.collector()
+        except Exception as e:
+            logging.debug(f'指标 {self.name} 采集失败: {e}')
+            return {}
+
+class Histogram(Counter):
+    """直方图：各桶计数（非累积存放，输出时累积）、总和与次数"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label: str = None, buckets: tuple = METRICS_TIME_BUCKETS):
+        super().__init__(name, help_text, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, label_value: str = ''):
+        entry = self.values.get(label_value)
+        if entry is None:
+            entry = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def collect(self) -> Dict[str, Dict]:
+        result = {}
+        for label_value, (counts, total, count) in list(self.values.items()):
+            result[label_value] = {'count': count, 'sum': total, 'mean': total / count if count else 0.0,
+                                   'buckets': list(itertools.accumulate(counts))}
+        return result
+
+class MetricsRegistry:
+    """指标注册表；同名指标重复注册时返回已有实例（仪表会更新采集函数）"""
+    def __init__(self, prefix: str = 'eati_'):
+        self.prefix = prefix
+        self.metrics: Dict[str, Counter] = {}
+        self.lock = threading.Lock()
+        self._rate_base = None
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif isinstance(metric, Gauge) and kwargs.get('collector') is not None:
+                metric.collector = kwargs['collector']
+            return metric
+
+    def counter(self, name: str, help_text: str, label: str = None) -> Counter:
+        return self._register(Counter, name, help_text, label)
+
+    def gauge(self, name: str, help_text: str, label: str = None, collector: Callable = None) -> Gauge:
+        return self._register(Gauge, name, help_text, label, collector=collector)
+
+    def histogram(self, name: str, help_text: str, label: str = None,
+                  buckets: tuple = METRICS_TIME_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help_text, label, buckets=buckets)
+
+    def update_rates(self):
+        """按两次调用之间的墙钟时间计算SimPy事件处理速率"""
+        now, events = time.perf_counter(), simpy_events_total.values.get('', 0)
+        if self._rate_base is not None:
+            elapsed = now - self._rate_base[0]
+            if elapsed > 0:
+                simpy_events_rate.set((events - self._rate_base[1]) / elapsed)
+        self._rate_base = (now, events)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: {'type': metric.kind, 'label': metric.label, 'values': metric.collect()}
+                for metric in metrics}
+
+    def render_prometheus(self) -> str:
+        """Prometheus文本格式（0.0.4）"""
+        def labels(metric, label_value, extra: str = '') -> str:
+            parts = []
+            if metric.label and label_value != '':
+                escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                parts.append(f'{metric.label}="{escaped}"')
+            if extra:
+                parts.append(extra)
+            return '{' + ','.join(parts) + '}' if parts else ''
+        
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            name = self.prefix + metric.name
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for label_value, value in metric.collect().items():
+                if metric.kind != 'histogram':
+                    lines.append(f'{name}{labels(metric, label_value)} {float(value)!r}')
+                    continue
+                for bound, count in zip(metric.buckets + (float('inf'),), value['buckets']):
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{float(bound)!r}"'
+                    lines.append(f'{name}_bucket{labels(metric, label_value, le)} {count}')
+                lines.append(f'{name}_sum{labels(metric, label_value)} {value["sum"]!r}')
+                lines.append(f'{name}_count{labels(metric, label_value)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+# 全局指标注册表与热点路径指标
+metrics = MetricsRegistry()
+simpy_events_total = metrics.counter('simpy_events_total', 'SimPy处理的事件数')
+simpy_events_rate = metrics.gauge('simpy_events_per_second', 'SimPy每秒处理的事件数（按推送间隔计算）')
+activity_invocations = metrics.counter('activity_invocations_total', 'Activity调用次数', 'activity')
+activity_wall_seconds = metrics.histogram('activity_wall_seconds', 'Activity每次调用占用的墙钟时间（秒）', 'activity')
+collector_messages_total = metrics.counter('collector_messages_total', '加入消息收集器的消息数', 'type')
+ws_bytes_sent_total = metrics.counter('ws_bytes_sent_total', 'WebSocket发送的字节数')
+ws_messages_sent_total = metrics.counter('ws_messages_sent_total', 'WebSocket发送的消息数')
+
+def count_simpy_steps(env: simpy.Environment):
+    """统计环境处理的事件数（env.run 与手动单步都经由实例上的 step）"""
+    step = env.step
+    values = simpy_events_total.values
     
-    def __post_init__(self):
-        if self.timestamp is None:
-            self.timestamp = datetime.now()
+    def counted_step():
+        values[''] = values.get('', 0) + 1
+        step()
     
+    env.step = counted_step
+
+def timed_activity(activity_name: str, generator):
+    """逐步驱动Activity生成器，累计其每次恢复执行的墙钟时间（不含等待仿真时间）"""
+    activity_invocations.inc(activity_name)
+    elapsed = 0.0
+    send, value = generator.send, None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                event = send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                elapsed += time.perf_counter() - start
+            try:
+                value, send = (yield event), generator.send
+            except GeneratorExit:
+                generator.close()
+                raise
+            except BaseException as e:
+                # 中断等异常交给Activity自身处理
+                value, send = e, generator.throw
+    finally:
+        activity_wall_seconds.observe(elapsed, activity_name)
+
+class MetricsHTTPServer:
+    """在本地端口以Prometheus文本格式提供指标（GET /metrics）"""
+    def __init__(self, registry: MetricsRegistry, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        registry_ref = registry
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry_ref.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        log_and_collect('INFO', 'Prometheus指标服务启动: http://%s:%s/metrics', host, port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(timeout=5.0)
+
+# 追踪导出（Chrome trace-event JSON，可在 chrome://tracing 或 Perfetto 中打开）
+class TraceExporter:
+    """动作→活动嵌套区间按实体分轨道（tid），仿真时间与墙钟时间各为一个进程（pid）
+
+    WebSocket推送和命令处理区间只有墙钟时间，放在墙钟进程的服务轨道上。
+    按动作采样，动作内的活动随动作一并记录；事件先缓冲，攒够一批再写出。
+    """
+    SIM_PID = 1
+    WALL_PID = 2
+    SERVER_TRACKS = {'ws_push': 'WebSocket推送', 'ws_command': 'WebSocket命令', 'sim_command': '仿真线程命令处理'}
+
+    def __init__(self, path: str, sample_rate: float = TRACE_SAMPLE_RATE, buffer_events: int = TRACE_BUFFER_EVENTS):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.buffer_events = buffer_events
+        # 直接写文件描述符：fork出的检查点与父进程共享写入位置，且没有需要同步的库缓冲
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, b'[\n')
+        self.sampler = random.Random(RANDOM_SEED)  # 独立随机数，不影响仿真
+        self.buffer: List[Dict] = []
+        self.lock = threading.Lock()
+        self.tids: Dict[str, int] = {}
+        self.wall_origin = time.perf_counter()
+        self.closed = False
+        for pid, name in ((self.SIM_PID, '仿真时间'), (self.WALL_PID, '墙钟时间')):
+            self.buffer.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}})
+
+    def _tid(self, key: str, name: str, pids: tuple = (SIM_PID, WALL_PID)) -> int:
+        """轨道号（调用方持有锁），首次出现时写入轨道名"""
+        tid = self.tids.get(key)
+        if tid is None:
+            tid = self.tids[key] = len(self.tids) + 1
+            for pid in pids:
+                self.buffer.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        return tid
+
+    def _flush_locked(self):
+        if not self.buffer or self.closed:
+            return
+        separator = ',\n' if os.lseek(self.fd, 0, os.SEEK_CUR) > 2 else ''
+        text = ',\n'.join(json.dumps(event, ensure_ascii=False, separators=(',', ':'), default=str)
+                          for event in self.buffer)
+        os.write(self.fd, (separator + text).encode('utf-8'))
+        self.buffer.clear()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._flush_locked()
+            os.write(self.fd, b'\n]\n')
+            os.close(self.fd)
+            self.closed = True
+
+    def reset_after_fork(self):
+        """fork出的子进程丢弃父进程已负责写出的缓冲事件"""
+        self.lock = threading.Lock()
+        self.buffer.clear()
+
+    # 采样（标志记在执行动作的进程上，子进程经 child_process 继承，扁平执行时就在同一进程内）
+    def begin_action(self, process: Optional[simpy.Process]) -> Optional[bool]:
+        """为动作抽样，返回进程原来的标志，由 end_action 恢复（扁平执行时动作可在同一进程内嵌套）"""
+        if process is None:
+            return None
+        outer_sampled = getattr(process, 'trace_sampled', None)
+        process.trace_sampled = self.sampler.random() < self.sample_rate
+        return outer_sampled
+
+    def sample_activity(self, process: Optional[simpy.Process]) -> bool:
+        """随所属动作采样；动作外直接执行的活动单独采样"""
+        sampled = getattr(process, 'trace_sampled', None)
+        return sampled if sampled is not None else self.sampler.random() < self.sample_rate
+
+    # 记录区间
+    def span(self, entity: Any, name: str, category: str, sim_start: float, sim_end: float,
+             wall_start: float, wall_end: float, args: Dict = None):
+        """实体轨道上的完整区间，同时写入仿真时间和墙钟时间两个视图"""
+        with self.lock:
+            tid = self._tid(getattr(entity, 'id', 'unknown'), getattr(entity, 'name', 'Unknown'))
+            self.buffer.append({'name': name, 'cat': category, 'ph': 'X', 'pid': self.SIM_PID, 'tid': tid,
+                                'ts': sim_start * 1e6, 'dur': (sim_end - sim_start) * 1e6, 'args': args or {}})
+            self.buffer.append({'name': name, 'cat': category, 'ph': 'X', 'pid': self.WALL_PID, 'tid': tid,
+                                'ts': (wall_start - self.wall_origin) * 1e6, 'dur': (wall_end - wall_start) * 1e6,
+                                'args': dict(args or {}, sim_start=sim_start, sim_end=sim_end)})
+            if len(self.buffer) >= self.buffer_events:
+                self._flush_locked()
+
+    def server_span(self, track: str, name: str, wall_start: float, wall_end: float, args: Dict = None):
+        """服务线程区间（只有墙钟时间视图）"""
+        with self.lock:
+            tid = self._tid(f'__{track}', self.SERVER_TRACKS.get(track, track), (self.WALL_PID,))
+            self.buffer.append({'name': name, 'cat': track, 'ph': 'X', 'pid': self.WALL_PID, 'tid': tid,
+                                'ts': (wall_start - self.wall_origin) * 1e6, 'dur': (wall_end - wall_start) * 1e6,
+                                'args': args or {}})
+            if len(self.buffer) >= self.buffer_events:
+                self._flush_locked()
+
+    def end_action(self, entity: Any, action: 'ActionBase', process: Optional[simpy.Process],
+                   outer_sampled: Optional[bool], sim_start: float, wall_start: float):
+        if process is None:
+            return
+        sampled = process.trace_sampled
+        process.trace_sampled = outer_sampled
+        if not sampled:
+            return
+        self.span(entity, action.name, 'action', sim_start, action.env.now, wall_start, time.perf_counter(),
+                  {'action': action.id, 'chinese_name': action.chinese_name, 'interrupted': action.interrupted})
+
+    def trace_activity(self, env: simpy.Environment, entity: Any, meta: 'ActivityMeta', body):
+        if not self.sample_activity(env.active_process):
+            return (yield from body)
+        sim_start, wall_start = env.now, time.perf_counter()
+        try:
+            return (yield from body)
+        finally:
+            self.span(entity, meta.activity_name, 'activity', sim_start, env.now, wall_start, time.perf_counter(),
+                      {'activity': meta.activity_id, 'chinese_name': meta.chinese_name})
+
+trace_exporter: Optional[TraceExporter] = None
+
+def start_tracing(path: str = TRACE_FILE, sample_rate: float = TRACE_SAMPLE_RATE) -> TraceExporter:
+    """开始导出追踪（已在导出时先结束原文件）"""
+    global trace_exporter
+    stop_tracing()
+    trace_exporter = TraceExporter(path, sample_rate)
+    atexit.unregister(stop_tracing)  # 多次开始导出时只保留一个退出处理函数
+    atexit.register(stop_tracing)
+    logging.info(f'追踪导出到 {path}（采样比例 {sample_rate}）')
+    return trace_exporter
+
+def stop_tracing():
+    global trace_exporter
+    if trace_exporter is not None:
+        trace_exporter.close()
+        trace_exporter = None
+
+def detach_tracing():
+    """fork出的分支子进程不写父进程的追踪文件"""
+    global trace_exporter
+    trace_exporter = None
+
+# 消息包装器（紧凑表示：槽位对象、单调时钟纳秒时间戳、按共享键表存放的数据值）
+MESSAGE_KEY_TABLES: Dict[tuple, tuple] = {}  # 字段名元组的驻留表，字段相同的消息共享同一个键元组
+INTERNED_MESSAGE_FIELDS = frozenset({'level', 'entity', 'entity_name', 'activity', 'activity_name',
+                                     'activity_chinese_name', 'action', 'action_name', 'state', 'mode'})
+MONOTONIC_WALL_OFFSET_NS = time.time_ns() - time.monotonic_ns()  # 单调时钟到墙钟的换算偏移
+
+def monotonic_ns_to_datetime(timestamp_ns: int) -> datetime:
+    return datetime.fromtimestamp((timestamp_ns + MONOTONIC_WALL_OFFSET_NS) / 1e9)
+
+def datetime_to_monotonic_ns(timestamp: datetime) -> int:
+    return int(timestamp.timestamp() * 1e9) - MONOTONIC_WALL_OFFSET_NS
+
+class SimulationMessage:
+    """仿真消息
+
+    时间戳为 time.monotonic_ns() 整数，只在输出时格式化；字典数据拆成驻留的键元组和值元组，
+    实体id与常见的名称类字段值驻留，同名字符串只保留一份。
+    """
+    __slots__ = ('type', 'keys', 'values', 'timestamp_ns', 'entity_id', 'log_id')
+
+    def __init__(self, type: MessageType, data: Any, timestamp: datetime = None,
+                 entity_id: Optional[str] = None, log_id: int = 0):
+        self.type = type
+        self.timestamp_ns = time.monotonic_ns() if timestamp is None else datetime_to_monotonic_ns(timestamp)
+        self.entity_id = sys.intern(entity_id) if entity_id.__class__ is str else entity_id
+        self.log_id = log_id  # 日志唯一ID
+        if isinstance(data, dict):
+            keys = tuple(data)
+            self.keys = MESSAGE_KEY_TABLES.setdefault(keys, keys)
+            self.values = tuple(sys.intern(value) if value.__class__ is str and key in INTERNED_MESSAGE_FIELDS
+                                else value for key, value in data.items())
+        else:
+            self.keys = None
+            self.values = data
+
+    @property
+    def data(self) -> Any:
+        return dict(zip(self.keys, self.values)) if self.keys is not None else self.values
+
+    @property
+    def timestamp(self) -> datetime:
+        return monotonic_ns_to_datetime(self.timestamp_ns)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """读取单个数据字段，不重建字典"""
+        if self.keys is None:
+            return self.values.get(key, default) if isinstance(self.values, dict) else default
+        try:
+            return self.values[self.keys.index(key)]
+        except ValueError:
+            return default
+
     def to_dict(self):
+        data = self.data
+        if isinstance(data, dict) and isinstance(data.get('message'), LazyLogRecord):
+            data['message'] = data['message'].text
         result = {
             'type': self.type.value,
             'timestamp': self.timestamp.isoformat(),
             'entity_id': self.entity_id,
-            'data': self.data
+            'data': data
         }
         if self.log_id > 0:
             result['log_id'] = self.log_id
@@ -234,8 +938,12 @@ class SimulationMessage:
 
 # 消息收集器（增强版，支持推送和增量）
 class MessageCollector:
-    """消息收集器 - 存储消息供查询和推送"""
-    def __init__(self, max_messages=1000):
+    """消息收集器 - 存储消息供查询和推送
+
+    每条消息只有一个对象：按类型分组与日志缓存中保存的都是同一对象的引用，
+    LOG_MESSAGE 的分组就是日志缓存本身。
+    """
+    def __init__(self, max_messages=MESSAGE_HISTORY, max_per_type=MESSAGE_HISTORY_PER_TYPE, max_logs=LOG_HISTORY):
         self.messages = deque(maxlen=max_messages)  # 限制消息数量
         self.messages_by_type = {}  # 按类型分组的消息
         self.lock = threading.Lock()
@@ -250,48 +958,63 @@ class MessageCollector:
             'CRITICAL': 4
         }
         
+        # 日志消息缓存（用于推送），同时作为LOG_MESSAGE类型的分组
+        self.log_messages_buffer = deque(maxlen=max_logs)
+        
         # 初始化各类型的消息队列
         for msg_type in MessageType:
-            self.messages_by_type[msg_type] = deque(maxlen=100)
-        
-        # 日志消息缓存（用于推送）
-        self.log_messages_buffer = deque(maxlen=500)
+            self.messages_by_type[msg_type] = deque(maxlen=max_per_type)
+        self.messages_by_type[MessageType.LOG_MESSAGE] = self.log_messages_buffer
         self.last_push_time = {}  # 记录每个客户端的最后推送时间
+        
+        # 日志关注级别：历史保留级别与已连接客户端过滤级别中的最低者，低于它的日志不收集
+        self.retention_level = self.log_levels.get(LOG_RETENTION_LEVEL, 1)
+        self.min_interest_level = self.retention_level
+    
+    def update_log_interest(self, subscriber_levels: List[str]):
+        """根据订阅者的日志级别过滤更新关注级别"""
+        levels = [self.log_levels.get(level, 1) for level in subscriber_levels]
+        self.min_interest_level = min([self.retention_level] + levels)
+    
+    def wants_log(self, level: str) -> bool:
+        """是否有消费者关注该级别的日志"""
+        return self.log_levels.get(level, 1) >= self.min_interest_level
     
     def add_message(self, message: SimulationMessage):
         """添加消息到收集器"""
+        collector_messages_total.inc(message.type.value)
         with self.lock:
             self.messages.append(message)
-            self.messages_by_type[message.type].append(message)
             
-            # 如果是日志消息，加入日志缓存并分配ID
-            if message.type == MessageType.LOG_MESSAGE:
+            # 如果是日志消息，分配ID（日志缓存即LOG_MESSAGE分组）
+            if message.type is MessageType.LOG_MESSAGE:
                 self.log_id_counter += 1
                 message.log_id = self.log_id_counter
-                self.log_messages_buffer.append(message)
+            self.messages_by_type[message.type].append(message)
     
     def get_messages(self, msg_type: MessageType = None, count: int = 50) -> List[Dict]:
         """获取消息"""
         with self.lock:
-            if msg_type:
-                messages = list(self.messages_by_type.get(msg_type, []))[-count:]
-            else:
-                messages = list(self.messages)[-count:]
-            
+            source = self.messages_by_type.get(msg_type, ()) if msg_type else self.messages
+            messages = itertools.islice(source, max(0, len(source) - count), None)
             return [msg.to_dict() for msg in messages]
     
     def get_messages_since(self, timestamp: datetime, msg_type: MessageType = None) -> List[Dict]:
         """获取指定时间后的消息"""
+        threshold = datetime_to_monotonic_ns(timestamp)
         with self.lock:
             if msg_type:
                 source = self.messages_by_type.get(msg_type, [])
             else:
                 source = self.messages
             
+            # 消息按时间顺序追加，从新到旧扫描到阈值即可
             result = []
-            for msg in source:
-                if msg.timestamp > timestamp:
-                    result.append(msg.to_dict())
+            for msg in reversed(source):
+                if msg.timestamp_ns <= threshold:
+                    break
+                result.append(msg.to_dict())
+            result.reverse()
             return result
     
     def get_incremental_logs(self, last_id: int, level_filter: str = "INFO", 
@@ -302,35 +1025,37 @@ class MessageCollector:
             new_last_id = last_id
             filter_level = self.log_levels.get(level_filter, 1)
             
-            for msg in self.log_messages_buffer:
-                if msg.log_id > last_id:
-                    log_level = self.log_levels.get(msg.data.get('level', 'INFO'), 1)
+            for msg in self.logs_after(last_id):
+                log_level = self.log_levels.get(msg.get('level', 'INFO'), 1)
+                
+                # 级别过滤：只返回filter_level及以上的日志
+                if log_level >= filter_level:
+                    result.append(msg.to_dict())
+                    new_last_id = max(new_last_id, msg.log_id)
                     
-                    # 级别过滤：只返回filter_level及以上的日志
-                    if log_level >= filter_level:
-                        result.append(msg.to_dict())
-                        new_last_id = max(new_last_id, msg.log_id)
-                        
-                        if len(result) >= max_count:
-                            break
+                    if len(result) >= max_count:
+                        break
             
             return result, new_last_id
     
+    def logs_after(self, last_id: int):
+        """日志缓存中ID大于last_id的日志（调用方持有锁）；缓存内日志ID连续，直接跳过已推送部分"""
+        buffer = self.log_messages_buffer
+        start = last_id + 1 - buffer[0].log_id if buffer else 0
+        return itertools.islice(buffer, max(0, start), None)
+
     def clear_old_messages(self, before_timestamp: datetime):
         """清理旧消息"""
+        threshold = datetime_to_monotonic_ns(before_timestamp)
         with self.lock:
             # 清理总消息队列
-            while self.messages and self.messages[0].timestamp < before_timestamp:
+            while self.messages and self.messages[0].timestamp_ns < threshold:
                 self.messages.popleft()
             
-            # 清理分类消息队列
+            # 清理分类消息队列（含日志缓存）
             for msg_list in self.messages_by_type.values():
-                while msg_list and msg_list[0].timestamp < before_timestamp:
+                while msg_list and msg_list[0].timestamp_ns < threshold:
                     msg_list.popleft()
-            
-            # 清理日志缓存
-            while self.log_messages_buffer and self.log_messages_buffer[0].timestamp < before_timestamp:
-                self.log_messages_buffer.popleft()
 
 # 全局消息收集器
 message_collector = MessageCollector()
@@ -368,6 +1093,7 @@ class WebSocketManager:
         with self.lock:
             client_info = ClientInfo(websocket=websocket, log_push_interval=log_push_interval)
             self.clients[websocket] = client_info
+            self._refresh_log_interest()
             logging.info(f'客户端连接: {websocket.remote_address}, 日志推送间隔: {log_push_interval}秒, 当前连接数: {len(self.clients)}')
             return client_info
     
@@ -380,6 +1106,7 @@ class WebSocketManager:
                 if client_info.push_task and not client_info.push_task.done():
                     client_info.push_task.cancel()
                 del self.clients[websocket]
+                self._refresh_log_interest()
             logging.info(f'客户端断开: {websocket.remote_address}, 当前连接数: {len(self.clients)}')
     
     def get_client(self, websocket) -> Optional[ClientInfo]:
@@ -387,6 +1114,16 @@ class WebSocketManager:
         with self.lock:
             return self.clients.get(websocket)
     
+    def set_log_level_filter(self, client_info: ClientInfo, level: str):
+        """更新客户端的日志级别过滤"""
+        with self.lock:
+            client_info.log_level_filter = level
+            self._refresh_log_interest()
+    
+    def _refresh_log_interest(self):
+        """同步订阅者关注级别到消息收集器（调用方持有锁）"""
+        message_collector.update_log_interest([c.log_level_filter for c in self.clients.values()])
+    
     def update_push_interval(self, websocket, interval: float):
         """更新客户端的推送间隔"""
         with self.lock:
@@ -397,23 +1134,73 @@ class WebSocketManager:
 # 全局WebSocket管理器
 ws_manager = WebSocketManager()
 
+def _collector_occupancy() -> Dict[str, int]:
+    with message_collector.lock:
+        occupancy = {'messages': len(message_collector.messages),
+                     'log_messages': len(message_collector.log_messages_buffer)}
+        occupancy.update((msg_type.value, len(messages))
+                         for msg_type, messages in message_collector.messages_by_type.items())
+    return occupancy
+
+def _client_lag() -> Dict[str, float]:
+    """各客户端最早一条待推送日志（满足其级别过滤）已等待的秒数"""
+    with ws_manager.lock:
+        clients = list(ws_manager.clients.values())
+    now = time.monotonic_ns()
+    lag = {}
+    with message_collector.lock:
+        for client in clients:
+            filter_level = message_collector.log_levels.get(client.log_level_filter, 1)
+            pending = next((msg for msg in message_collector.logs_after(client.last_log_id)
+                            if message_collector.log_levels.get(msg.get('level', 'INFO'), 1) >= filter_level), None)
+            address = client.websocket.remote_address
+            label = f'{address[0]}:{address[1]}' if address else str(id(client.websocket))
+            lag[label] = (now - pending.timestamp_ns) / 1e9 if pending is not None else 0.0
+    return lag
+
+metrics.gauge('collector_buffer_occupancy', '消息收集器各缓冲区的消息数', 'buffer', collector=_collector_occupancy)
+metrics.gauge('ws_client_lag_seconds', '客户端最早待推送日志的等待时间（秒）', 'client', collector=_client_lag)
+
+async def ws_send(websocket, payload: str):
+    """发送文本消息并统计发送字节数"""
+    await websocket.send(payload)
+    ws_messages_sent_total.inc()
+    ws_bytes_sent_total.inc(amount=len(payload) if payload.isascii() else len(payload.encode('utf-8')))
+
 # 日志和消息收集
-def log_and_collect(level: str, message: str, entity: str = None, msg_type: MessageType = MessageType.LOG_MESSAGE, **kwargs):
-    """记录日志并收集消息"""
-    # 标准日志
-    if level == 'INFO':
-        logging.info(message)
-    elif level == 'DEBUG':
-        logging.debug(message)
-    elif level == 'WARNING':
-        logging.warning(message)
-    elif level == 'ERROR':
-        logging.error(message)
+LOG_LEVEL_NUMBERS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR
+}
+
+def log_and_collect(level: str, message: str, *args, entity: str = None,
+                    msg_type: MessageType = MessageType.LOG_MESSAGE, **kwargs):
+    """记录日志并收集消息
+
+    message可以是%格式模板，配合args使用；先检查日志级别和订阅者关注度，
+    两者都不需要时直接返回，不做任何格式化。
+    """
+    levelno = LOG_LEVEL_NUMBERS.get(level)
+    log_enabled = levelno is not None and logging.root.isEnabledFor(levelno)
+    collect = msg_type != MessageType.LOG_MESSAGE or message_collector.wants_log(level)
+    if not log_enabled and not collect:
+        return
+    
+    record = LazyLogRecord(message, args)
+    
+    # 标准日志（由logging在真正输出时格式化）
+    if log_enabled:
+        logging.log(levelno, record)
+    
+    if not collect:
+        return
     
     # 收集消息供查询和推送
     msg_data = {
         'level': level,
-        'message': message,
+        'message': record,
         'entity': entity
     }
     msg_data.update(kwargs)
@@ -432,6 +1219,7 @@ async def log_push_task(client_info: ClientInfo):
         
         while True:
             await asyncio.sleep(client_info.log_push_interval)
+            push_start = time.perf_counter()
             
             # 获取增量日志（只获取INFO及以上级别）
             logs, new_last_id = message_collector.get_incremental_logs(
@@ -442,7 +1230,7 @@ async def log_push_task(client_info: ClientInfo):
             
             if logs:
                 # 推送日志
-                await client_info.websocket.send(json.dumps({
+                await ws_send(client_info.websocket, json.dumps({
                     'type': MessageType.LOG_BATCH.value,
                     'data': {
                         'logs': logs,
@@ -457,6 +1245,9 @@ async def log_push_task(client_info: ClientInfo):
                 # 更新最后推送的日志ID
                 client_info.last_log_id = new_last_id
                 empty_push_count = 0
+                if trace_exporter is not None:
+                    trace_exporter.server_span('ws_push', 'log_batch', push_start, time.perf_counter(),
+                                               {'count': len(logs), 'client': str(client_info.websocket.remote_address)})
                 
             else:
                 empty_push_count += 1
@@ -472,23 +1263,118 @@ async def log_push_task(client_info: ClientInfo):
     except Exception as e:
         logging.error(f"日志推送任务错误: {e}")
 
+# 指标推送任务
+async def metrics_publish_task(interval: float = METRICS_PUBLISH_INTERVAL):
+    """定期计算速率并以METRIC_UPDATE加入消息收集器、推送给所有客户端"""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            push_start = time.perf_counter()
+            metrics.update_rates()
+            snapshot = metrics.snapshot()
+            message_collector.add_message(SimulationMessage(type=MessageType.METRIC_UPDATE, data=snapshot))
+            payload = json.dumps({'type': MessageType.METRIC_UPDATE.value, 'data': snapshot}, default=str)
+            with ws_manager.lock:
+                clients = list(ws_manager.clients)
+            for websocket in clients:
+                try:
+                    await ws_send(websocket, payload)
+                except websockets.exceptions.ConnectionClosed:
+                    pass
+            if trace_exporter is not None:
+                trace_exporter.server_span('ws_push', 'metric_update', push_start, time.perf_counter(),
+                                           {'clients': len(clients), 'bytes': len(payload)})
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logging.error(f"指标推送任务错误: {e}")
+
+# Activity元数据（装饰时一次性计算）
+@dataclass
+class ActivityMeta:
+    """Activity元数据"""
+    activity_id: str  # 完整的函数名，例如: activity_move_patrol
+    activity_name: str  # 不带activity_前缀的名称，例如: move_patrol
+    chinese_name: str  # 中文名称，从文档字符串"活动：XXX"提取
+
+    @classmethod
+    def from_function(cls, activity_func: Callable) -> 'ActivityMeta':
+        activity_chinese_name = "未知活动"
+        if activity_func.__doc__:
+            doc_lines = activity_func.__doc__.strip().split('\n')
+            if doc_lines and doc_lines[0].startswith('活动：'):
+                activity_chinese_name = doc_lines[0].replace('活动：', '').strip()
+        return cls(
+            activity_id=activity_func.__name__,
+            activity_name=activity_func.__name__.replace('activity_', ''),
+            chinese_name=activity_chinese_name
+        )
+
+# Activity埋点级别（全局级别 + 按Activity覆盖）
+instrumentation_level = InstrumentationLevel(INSTRUMENTATION_LEVEL)
+activity_instrumentation_levels: Dict[str, InstrumentationLevel] = {}
+
+def set_instrumentation_level(level, activity: str = None):
+    """设置埋点级别；指定activity（不带activity_前缀的名称）时只覆盖该Activity，level为None时取消覆盖"""
+    global instrumentation_level
+    if activity:
+        if level is None:
+            activity_instrumentation_levels.pop(activity, None)
+        else:
+            activity_instrumentation_levels[activity] = InstrumentationLevel(level)
+    else:
+        instrumentation_level = InstrumentationLevel(level)
+
+def _set_current_activity(entity: Any, meta: ActivityMeta, notify: bool):
+    """更新实体当前Activity；notify为False时不产生ENTITY_UPDATE消息"""
+    if hasattr(entity, 'update_status'):
+        if notify:
+            entity.update_status(activity=meta.activity_id)
+        else:
+            entity.current_activity = meta.activity_id
+        # 添加额外的属性来存储名称信息
+        entity.current_activity_name = meta.activity_name
+        entity.current_activity_chinese_name = meta.chinese_name
+    simulation = getattr(entity, 'simulation', None)
+    if simulation is not None and simulation.breakpoints.activities:
+        simulation.breakpoints.notify_activity_start(meta.activity_name, entity)
+
 # 增强的Activity装饰器（增加了activity_name输出）
 def enhanced_activity_wrapper(activity_func: Callable) -> Callable:
-    """增强的Activity装饰器 - 自动记录执行时间线并发送完成消息"""
+    """增强的Activity装饰器 - 自动记录执行时间线并发送完成消息
+
+    按埋点级别决定记录内容：OFF只更新实体当前Activity，COUNTERS统计调用次数，
+    SUMMARY额外汇总耗时，FULL记录完整时间线、运行日志和开始/完成消息。
+    """
+    meta = ActivityMeta.from_function(activity_func)
+    activity_id = meta.activity_id
+    activity_name = meta.activity_name
+    activity_chinese_name = meta.chinese_name
     
     @functools.wraps(activity_func)
     def wrapper(env, entity, context):
-        # 获取Activity名称（从函数名提取）
-        activity_id = activity_func.__name__  # 例如: activity_move_patrol
-        activity_name = activity_func.__name__.replace('activity_', '')  # 例如: move_patrol
+        level = activity_instrumentation_levels.get(activity_name, instrumentation_level)
+        body = activity_func(env, entity, context)
+        if METRICS_ENABLED:
+            body = timed_activity(activity_name, body)
+        if trace_exporter is not None:
+            body = trace_exporter.trace_activity(env, entity, meta, body)
         
-        # 获取Activity的中文名称（从函数文档字符串提取）
-        activity_chinese_name = "未知活动"
-        if activity_func.__doc__:
-            # 从文档字符串中提取中文名称，格式为"活动：XXX"
-            doc_lines = activity_func.__doc__.strip().split('\n')
-            if doc_lines and doc_lines[0].startswith('活动：'):
-                activity_chinese_name = doc_lines[0].replace('活动：', '').strip()
+        if level is not InstrumentationLevel.FULL:
+            _set_current_activity(entity, meta, notify=False)
+            if level is InstrumentationLevel.OFF:
+                return (yield from body)
+            
+            activity_logger.count_invocation(activity_name)
+            if level is InstrumentationLevel.COUNTERS:
+                return (yield from body)
+            
+            start_sim_time = env.now
+            try:
+                return (yield from body)
+            finally:
+                activity_logger.record_execution(activity_name, getattr(entity, 'name', 'Unknown'),
+                                                 env.now - start_sim_time, env.now)
         
         entity_name = getattr(entity, 'name', 'Unknown')
         entity_id = getattr(entity, 'id', 'unknown')
@@ -500,8 +1386,8 @@ def enhanced_activity_wrapper(activity_func: Callable) -> Callable:
         activity_logger.log_activity_start(activity_name, entity_name, entity_id, start_sim_time)
         
         # 记录到运行日志
-        log_and_collect('INFO', f'[Activity开始] {entity_name} - {activity_chinese_name} (仿真时间: {start_sim_time:.1f}s)', 
-                       entity=entity_name)
+        log_and_collect('INFO', '[Activity开始] %s - %s (仿真时间: %.1fs)',
+                       entity_name, activity_chinese_name, start_sim_time, entity=entity_name)
         
         # 发送Activity开始消息（增加activity_name和activity_chinese_name字段）
         message_collector.add_message(SimulationMessage(
@@ -517,15 +1403,11 @@ def enhanced_activity_wrapper(activity_func: Callable) -> Callable:
         ))
         
         # 更新实体状态（同时存储ID和名称）
-        if hasattr(entity, 'update_status'):
-            entity.update_status(activity=activity_id)
-            # 添加额外的属性来存储名称信息
-            entity.current_activity_name = activity_name
-            entity.current_activity_chinese_name = activity_chinese_name
+        _set_current_activity(entity, meta, notify=True)
         
         try:
             # 执行原始Activity函数
-            result = yield from activity_func(env, entity, context)
+            result = yield from body
             
             # 记录结束时间
             end_sim_time = env.now
@@ -537,8 +1419,8 @@ def enhanced_activity_wrapper(activity_func: Callable) -> Callable:
             
             # 记录到运行日志
             log_and_collect('INFO', 
-                          f'[Activity完成] {entity_name} - {activity_chinese_name} '
-                          f'(仿真时间: {end_sim_time:.1f}s, 耗时: {duration:.1f}s)', 
+                          '[Activity完成] %s - %s (仿真时间: %.1fs, 耗时: %.1fs)',
+                          entity_name, activity_chinese_name, end_sim_time, duration,
                           entity=entity_name)
             
             # 发送Activity完成消息（增加activity_name和activity_chinese_name字段）
@@ -566,7 +1448,8 @@ def enhanced_activity_wrapper(activity_func: Callable) -> Callable:
                                            end_sim_time, start_sim_time, f"Error: {str(e)}")
             
             log_and_collect('ERROR', 
-                          f'[Activity异常] {entity_name} - {activity_chinese_name} - 错误: {str(e)}', 
+                          '[Activity异常] %s - %s - 错误: %s',
+                          entity_name, activity_chinese_name, e,
                           entity=entity_name)
             
             # 发送Activity异常消息（增加activity_name和activity_chinese_name字段）
@@ -587,6 +1470,7 @@ def enhanced_activity_wrapper(activity_func: Callable) -> Callable:
             
             raise
     
+    wrapper.activity_meta = meta
     return wrapper
 
 # Helper Classes
@@ -603,10 +1487,11 @@ class ExpressionEvaluator:
             'calculate_patrol_route': self._calculate_patrol_route,
             'analyze_enemy_info': self._analyze_enemy_info
         }
-        safe_dict.update(self.context)
+        # 上下文可能是懒读取的视图，用ChainMap避免整体展开
+        namespace = ChainMap(self.context, safe_dict)
         
         try:
-            return eval(expression, {'__builtins__': {}}, safe_dict)
+            return eval(expression, {'__builtins__': {}}, namespace)
         except Exception as e:
             logging.error(f'表达式计算错误: {e}, 表达式: {expression}')
             return None
@@ -631,22 +1516,364 @@ class ExpressionEvaluator:
                 return 0.3
         return 0.5
 
+# 批量表达式计算（向量化）
+class EntityAttributeBatch:
+    """实体属性批 - 将多个实体的同名属性按列存放到NumPy数组中"""
+    def __init__(self, entities: List[Any], fields: List[str]):
+        self.entities = list(entities)
+        self.fields = list(fields)
+        self.columns: Dict[str, Any] = {}
+        self.dict_fields: Dict[str, List[str]] = {}  # 字典型属性（如position）的键列表
+
+        for field in self.fields:
+            values = [getattr(entity, field, None) for entity in self.entities]
+            if values and all(isinstance(value, dict) for value in values):
+                keys = list(values[0].keys())
+                self.dict_fields[field] = keys
+                for key in keys:
+                    self.columns[f'{field}.{key}'] = np.array([value.get(key) for value in values])
+            else:
+                self.columns[field] = np.array(values)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def namespace(self) -> Any:
+        """构造 self.xxx / self.position.x 形式访问的列命名空间"""
+        ns = types.SimpleNamespace()
+        for field in self.fields:
+            if field in self.dict_fields:
+                setattr(ns, field, types.SimpleNamespace(**{
+                    key: self.columns[f'{field}.{key}'] for key in self.dict_fields[field]
+                }))
+            else:
+                setattr(ns, field, self.columns[field])
+        return ns
+
+    def set_column(self, column: str, values: Any):
+        """更新一列数据（标量自动广播）"""
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = np.full(len(self.entities), values.item())
+        if values.shape != (len(self.entities),):
+            raise ValueError(f'列 {column} 的结果形状 {values.shape} 与实体数 {len(self.entities)} 不符')
+        self.columns[column] = values
+        field = column.split('.', 1)[0]
+        if field not in self.fields:
+            self.fields.append(field)
+
+    def write_back(self, columns: List[str] = None):
+        """将列数据写回实体属性"""
+        for column in (columns if columns is not None else list(self.columns)):
+            values = self.columns[column].tolist()
+            if '.' in column:
+                field, key = column.split('.', 1)
+                for entity, value in zip(self.entities, values):
+                    current = dict(getattr(entity, field, None) or {})
+                    current[key] = value
+                    setattr(entity, field, current)
+            else:
+                for entity, value in zip(self.entities, values):
+                    setattr(entity, column, value)
+
+class _VectorizeTransformer(ast.NodeTransformer):
+    """将标量表达式改写为NumPy逐元素运算"""
+    FUNCTION_MAP = {
+        'abs': 'np.abs',
+        'min': 'np.minimum',
+        'max': 'np.maximum',
+        'pow': 'np.power',
+        'round': 'np.round'
+    }
+
+    def _np(self, dotted: str) -> ast.expr:
+        node = ast.Name(id='np', ctx=ast.Load())
+        for part in dotted.split('.')[1:]:
+            node = ast.Attribute(value=node, attr=part, ctx=ast.Load())
+        return node
+
+    def _reduce(self, func: str, values: List[ast.expr]) -> ast.expr:
+        result = values[0]
+        for value in values[1:]:
+            result = ast.Call(func=self._np(func), args=[result, value], keywords=[])
+        return result
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return ast.Call(func=self._np('np.where'), args=[node.test, node.body, node.orelse], keywords=[])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = 'np.logical_and' if isinstance(node.op, ast.And) else 'np.logical_or'
+        return self._reduce(func, node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(func=self._np('np.logical_not'), args=[node.operand], keywords=[])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        # 链式比较 a < b < c 拆分为逐元素与运算
+        operands = [node.left] + node.comparators
+        parts = [ast.Compare(left=operands[i], ops=[op], comparators=[operands[i + 1]])
+                 for i, op in enumerate(node.ops)]
+        return self._reduce('np.logical_and', parts)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if isinstance(node.func, ast.Name):
+            if node.func.id in self.FUNCTION_MAP:
+                func = self.FUNCTION_MAP[node.func.id]
+                if node.func.id in ('min', 'max') and len(node.args) > 2:
+                    return self._reduce(func, node.args)
+                node.func = self._np(func)
+            elif node.func.id == 'random' and not node.args:
+                # 每个实体各抽一次，与逐实体计算共用 random 模块的随机数序列
+                return ast.Call(func=ast.Name(id='__random__', ctx=ast.Load()),
+                                args=[ast.Name(id='__batch_size__', ctx=ast.Load())], keywords=[])
+        return node
+
+def _batch_random(size: int) -> np.ndarray:
+    """按实体顺序从 random 模块抽样（与逐实体计算时 random() 的抽样顺序相同）"""
+    draw = random.random
+    return np.array([draw() for _ in range(size)])
+
+class BatchExpressionEvaluator:
+    """批量表达式计算器 - 对一组实体一次性向量化计算同一表达式
+
+    无法向量化的表达式（调用了自定义函数、下标访问等）自动退回逐实体计算：默认使用ExpressionEvaluator，
+    也可以传入 fallback(entity) 按调用方自己的语义逐实体求值（如模型解释器的公式作用域）。
+    random() 只在每个实体恰好抽样一次时向量化，抽样顺序与逐实体计算相同，同一随机种子下两条路径结果一致。
+    and/or 只在各操作数都是布尔值时向量化（Python 返回操作数本身而不是布尔值）；除零、溢出等浮点异常
+    在向量化计算中直接报错并退回逐实体计算，与逐实体计算出错时返回 None 一致。
+    """
+    ALLOWED_NODES = (
+        ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+        ast.Call, ast.Name, ast.Attribute, ast.Constant, ast.Load,
+        ast.operator, ast.unaryop, ast.boolop, ast.cmpop
+    )
+    VECTOR_FUNCTIONS = set(_VectorizeTransformer.FUNCTION_MAP) | {'random'}
+
+    def __init__(self, batch: EntityAttributeBatch, context: Dict[str, Any] = None,
+                 fallback: Callable[[Any], Any] = None):
+        self.batch = batch
+        self.context = context or {}
+        self.fallback = fallback
+        self._compiled: Dict[str, Any] = {}  # 表达式 -> 向量化代码对象（None表示不可向量化）
+
+    def _compile(self, expression: str):
+        if expression in self._compiled:
+            return self._compiled[expression]
+
+        code = None
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+            if self._is_vectorizable(tree):
+                tree = ast.fix_missing_locations(_VectorizeTransformer().visit(tree))
+                code = compile(tree, '<batch-expression>', 'eval')
+        except SyntaxError as e:
+            logging.error(f'表达式解析错误: {e}, 表达式: {expression}')
+
+        self._compiled[expression] = code
+        return code
+
+    def _is_vectorizable(self, tree: ast.AST) -> bool:
+        for node in ast.walk(tree):
+            if not isinstance(node, self.ALLOWED_NODES):
+                return False
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in self.VECTOR_FUNCTIONS:
+                    return False
+                if node.keywords:
+                    return False
+            if isinstance(node, ast.BoolOp) and not self._is_boolean(node):
+                return False
+        return self._draws_once_per_entity(tree)
+
+    @staticmethod
+    def _is_boolean(node: ast.AST) -> bool:
+        """结果一定是布尔值的表达式：比较、not、布尔常量以及由它们组成的 and/or"""
+        if isinstance(node, ast.Compare):
+            return True
+        if isinstance(node, ast.UnaryOp):
+            return isinstance(node.op, ast.Not)
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, bool)
+        if isinstance(node, ast.BoolOp):
+            return all(BatchExpressionEvaluator._is_boolean(value) for value in node.values)
+        return False
+
+    @staticmethod
+    def _draws_once_per_entity(tree: ast.AST) -> bool:
+        """random() 至多调用一次且一定会执行（不在 and/or 的后续操作数、条件表达式分支或链式比较的后续项中）"""
+        calls = [node for node in ast.walk(tree)
+                 if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'random']
+        if len(calls) > 1:
+            return False
+        if not calls:
+            return True
+        for node in ast.walk(tree):
+            if isinstance(node, ast.BoolOp):
+                branches = node.values[1:]
+            elif isinstance(node, ast.IfExp):
+                branches = [node.body, node.orelse]
+            elif isinstance(node, ast.Compare):
+                branches = node.comparators[1:]
+            else:
+                continue
+            if any(child is calls[0] for branch in branches for child in ast.walk(branch)):
+                return False
+        return True
+
+    def evaluate(self, expression: str) -> Any:
+        """计算表达式，返回与实体一一对应的结果数组"""
+        code = self._compile(expression)
+        if code is not None:
+            namespace = {'np': np, '__batch_size__': len(self.batch), '__random__': _batch_random}
+            namespace.update(self.context)
+            namespace['self'] = self.batch.namespace()
+            # 向量化失败时恢复随机数状态，逐实体计算重新按原顺序抽样
+            random_state = random.getstate() if '__random__' in code.co_names else None
+            try:
+                with np.errstate(all='raise'):
+                    result = np.asarray(eval(code, {'__builtins__': {}}, namespace))
+                if result.ndim == 0:
+                    result = np.full(len(self.batch), result.item())
+                if result.shape == (len(self.batch),):
+                    return result
+            except Exception as e:
+                logging.debug(f'向量化计算失败，退回逐实体计算: {e}, 表达式: {expression}')
+            if random_state is not None:
+                random.setstate(random_state)
+
+        return self.evaluate_per_entity(expression)
+
+    def evaluate_per_entity(self, expression: str) -> Any:
+        """逐实体计算（兼容路径）"""
+        results = []
+        for entity in self.batch.entities:
+            if self.fallback is not None:
+                results.append(self.fallback(entity))
+                continue
+            context = entity.get_context() if hasattr(entity, 'get_context') else {'self': entity}
+            context.update(self.context)
+            results.append(ExpressionEvaluator(context).evaluate(expression))
+
+        result = np.empty(len(results), dtype=object)
+        result[:] = results
+        return result
+
+    def evaluate_assignment(self, target: str, expression: str, write_back: bool = True) -> Any:
+        """计算 Assignment（如 Target=self.rounds_fired）并写回实体"""
+        column = target[len('self.'):] if target.startswith('self.') else target
+        result = self.evaluate(expression)
+        self.batch.set_column(column, result)
+        if write_back:
+            self.batch.write_back([column])
+        return result
+
 class TimeDistribution:
-    """基于概率分布生成时间值"""
+    """基于概率分布生成时间值
+
+    generate逐次抽样；sample为numpy批量抽样，cdf为有解析式的分布函数，供静态时长分析使用，
+    三者的参数约定相同（exponential的rate按均值使用，normal截去负值）。
+    """
+    @staticmethod
+    def parameters(dist_type: str, params: Dict[str, float]) -> Tuple[str, tuple]:
+        """规范化分布参数，兼容XML中的 mu/sigma、low/high 写法；未知分布按常数1.0"""
+        get = params.get
+        if dist_type == 'constant':
+            return dist_type, (get('value', 1.0),)
+        if dist_type == 'exponential':
+            return dist_type, (get('rate', 1.0),)
+        if dist_type == 'normal':
+            return dist_type, (get('mean', get('mu', 1.0)), get('std', get('sigma', 0.1)))
+        if dist_type == 'uniform':
+            return dist_type, (get('min', 0.0), get('max', 1.0))
+        if dist_type == 'triangular':
+            low, high = get('low', get('min', 0.0)), get('high', get('max', 1.0))
+            return dist_type, (low, high, get('mode', (low + high) / 2))
+        if dist_type == 'gamma':
+            return dist_type, (get('shape', 1.0), get('scale', 1.0))
+        return 'constant', (1.0,)
+
     @staticmethod
     def generate(dist_type: str, params: Dict[str, float]) -> float:
+        dist_type, args = TimeDistribution.parameters(dist_type, params)
         if dist_type == 'constant':
-            return params.get('value', 1.0)
+            return args[0]
         elif dist_type == 'exponential':
-            return random.expovariate(1.0 / params.get('rate', 1.0))
+            return random.expovariate(1.0 / args[0])
         elif dist_type == 'normal':
-            return max(0, random.normalvariate(params.get('mean', 1.0), params.get('std', 0.1)))
+            return max(0, random.normalvariate(*args))
         elif dist_type == 'uniform':
-            return random.uniform(params.get('min', 0.0), params.get('max', 1.0))
+            return random.uniform(*args)
+        elif dist_type == 'triangular':
+            return random.triangular(*args)
         else:
-            return 1.0
+            return random.gammavariate(*args)
 
-# 改进的单步暂停检查（增加了activity名称记录）
+    @staticmethod
+    def sample(dist_type: str, params: Dict[str, float], size: int, rng: np.random.Generator) -> np.ndarray:
+        dist_type, args = TimeDistribution.parameters(dist_type, params)
+        if dist_type == 'constant':
+            return np.full(size, float(args[0]))
+        elif dist_type == 'exponential':
+            return rng.exponential(args[0], size)
+        elif dist_type == 'normal':
+            return np.maximum(0.0, rng.normal(args[0], args[1], size))
+        elif dist_type == 'uniform':
+            return rng.uniform(args[0], args[1], size)
+        elif dist_type == 'triangular':
+            low, high, mode = args
+            return rng.triangular(low, mode, high, size) if high > low else np.full(size, float(low))
+        else:
+            return rng.gamma(args[0], args[1], size)
+
+    @staticmethod
+    def cdf(dist_type: str, params: Dict[str, float], x: np.ndarray) -> Optional[np.ndarray]:
+        """分布函数在x处的取值；没有初等解析式的分布（gamma）返回None"""
+        dist_type, args = TimeDistribution.parameters(dist_type, params)
+        if dist_type == 'constant':
+            return (x >= args[0]).astype(np.float64)
+        elif dist_type == 'exponential':
+            return np.where(x < 0, 0.0, 1.0 - np.exp(-np.maximum(x, 0) / args[0]))
+        elif dist_type == 'normal':
+            erf = np.vectorize(math.erf, otypes=[np.float64])
+            return np.where(x < 0, 0.0, 0.5 * (1.0 + erf((x - args[0]) / (args[1] * math.sqrt(2)))))
+        elif dist_type == 'uniform':
+            low, high = args
+            return np.clip((x - low) / (high - low), 0.0, 1.0) if high > low else (x >= low).astype(np.float64)
+        elif dist_type == 'triangular':
+            low, high, mode = args
+            if high <= low:
+                return (x >= low).astype(np.float64)
+            left = (x - low) ** 2 / ((high - low) * (mode - low)) if mode > low else np.ones_like(x)
+            right = 1.0 - (high - x) ** 2 / ((high - low) * (high - mode)) if high > mode else np.ones_like(x)
+            return np.where(x <= low, 0.0, np.where(x >= high, 1.0, np.where(x <= mode, left, right)))
+        return None
+
+    @staticmethod
+    def upper_bound(dist_type: str, params: Dict[str, float]) -> Optional[float]:
+        """离散化时使用的上界（有界分布取最大值，正态/指数取极小尾部概率处）；未知时返回None"""
+        dist_type, args = TimeDistribution.parameters(dist_type, params)
+        if dist_type == 'constant':
+            return args[0]
+        elif dist_type == 'exponential':
+            return args[0] * 30
+        elif dist_type == 'normal':
+            return max(0.0, args[0] + 8 * args[1])
+        elif dist_type == 'uniform':
+            return args[1]
+        elif dist_type == 'triangular':
+            return args[1]
+        return None
+
+# 改进的单步暂停检查（增加了activity名称记录）
 def check_pause(env: simpy.Environment, entity: Any):
     """检查是否需要暂停 - 改进版"""
     simulation = env.simulation
@@ -665,348 +1892,2165 @@ def check_pause(env: simpy.Environment, entity: Any):
         
         # 等待下一步指令
         while simulation.run_state == RunState.STEPPING and not simulation.step_continue:
-            yield env.timeout(0.01)  # 更短的检查间隔
+            yield step_wait(env, 0.01)  # 更短的检查间隔
         
         # 重置继续标志
         simulation.step_continue = False
     
     # 暂停模式处理
     while simulation.run_state == RunState.PAUSED:
-        yield env.timeout(0.1)
+        yield step_wait(env, 0.1)
 
-# 基础实体类（增加了activity名称属性）
-class BaseEntity:
-    """基础实体类"""
-    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
-        self.env = env
-        self.id = entity_id
-        self.simulation = simulation
-        self.current_action = None
-        self.current_activity = None
-        self.current_activity_name = None  # 新增：存储activity名称
-        self.current_activity_chinese_name = None  # 新增：存储activity中文名称
-        self.message_queue = simpy.Store(env)
-        
-    def update_status(self, action: str = None, activity: str = None):
-        """更新当前状态"""
-        old_action = self.current_action
-        old_activity = self.current_activity
-        
-        if action:
-            self.current_action = action
-        if activity:
-            self.current_activity = activity
-        
-        # 收集状态更新消息（增加activity名称信息）
-        if action != old_action or activity != old_activity:
-            message_collector.add_message(SimulationMessage(
-                type=MessageType.ENTITY_UPDATE,
-                entity_id=self.id,
-                data={
-                    'entity_name': self.name,
-                    'current_action': self.current_action,
-                    'current_activity': self.current_activity,
-                    'current_activity_name': self.current_activity_name,  # 新增
-                    'current_activity_chinese_name': self.current_activity_chinese_name,  # 新增
-                    'position': getattr(self, 'position', None)
-                }
-            ))
-    
-    def get_context(self) -> Dict:
-        """获取当前上下文"""
-        context = {
-            'self': self,
-            'env': self.env,
-            'time': self.env.now,
-            'global': self.simulation.global_vars
-        }
-        
-        for attr in dir(self):
-            if not attr.startswith('_') and hasattr(self, attr):
-                value = getattr(self, attr)
-                if isinstance(value, (int, float, str, bool)):
-                    context[attr] = value
-        
-        return context
+def step_wait(env: simpy.Environment, delay: float) -> simpy.Event:
+    """单步/暂停等待的轮询事件（带标记，按事件单步时跳过）"""
+    event = env.timeout(delay)
+    event.step_wait = True
+    return event
 
-# 实体类定义（继承改进的基类）
+def child_process(env: simpy.Environment, generator) -> simpy.Process:
+    """启动子进程，沿用当前进程的所属实体（按实体单步时据此判断事件归属）和追踪采样标志"""
+    parent = env.active_process
+    process = env.process(generator)
+    process.owner = getattr(parent, 'owner', None)
+    process.trace_sampled = getattr(parent, 'trace_sampled', None)
+    return process
 
-class CommandPost(BaseEntity):
-    """指挥所实体"""
-    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
-        super().__init__(env, entity_id, simulation)
-        self.name = '指挥所'
-        self.type = 'passive'
-        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
-        self.attributes = {
-            'unit_type': 'command',
-            'call_sign': 'Eagle'
-        }
-        self.alert_level = 1
-        self.actions = []
+# 动作执行组合（嵌套子进程 / 单进程扁平执行）
+def _yield_needed(env: simpy.Environment, priority: int) -> bool:
+    """事件表中是否已有当前时刻、优先级不低于 priority 的事件
 
-    def start(self):
-        """启动实体进程"""
-        log_and_collect('INFO', f'{self.name} ({self.attributes["call_sign"]}) 开始运行', entity=self.name)
-        self.env.process(self.message_handler())
+    嵌套执行时子进程的启动（URGENT）和结束（NORMAL）事件会排在这些事件之后，扁平执行必须在同一位置让出一次，
+    两种方式处理事件的先后（以及随之而来的随机数抽取顺序）才完全相同；没有这类事件时直接继续即可。
+    """
+    entry = peek_entry(env)
+    return entry is not None and entry[0] <= env.now and entry[1] <= priority
 
-    def message_handler(self):
-        """处理消息"""
-        while True:
-            try:
-                msg = yield self.message_queue.get()
-                log_and_collect('INFO', f'{self.name} 收到消息: {msg.get("type", "unknown")}', 
-                               entity=self.name)
-                
-                if msg.get('type') == 'enemy_report':
-                    self.env.process(self.run_action('act_process_intel', msg))
-                    
-            except simpy.Interrupt:
+def run_step(env: simpy.Environment, generator):
+    """执行一个子步骤：扁平模式下在当前进程内 yield from，否则作为子进程等待其完成"""
+    if not getattr(env, 'flat_execution', FLAT_ACTION_EXECUTION):
+        return (yield child_process(env, generator))
+    if _yield_needed(env, simpy.events.URGENT):
+        yield urgent_event(env)
+    result = yield from generator
+    if _yield_needed(env, simpy.events.NORMAL):
+        yield env.timeout(0)
+    return result
+
+def pause_point(env: simpy.Environment, entity: Any):
+    """单步/暂停检查点：扁平模式下连续运行时通常不产生任何事件"""
+    yield from run_step(env, check_pause(env, entity))
+
+# 实体上下文（基于属性模式的懒读取视图）
+CONTEXT_SCALAR_TYPES = (int, float, str, bool)
+
+class EntityContext(MutableMapping):
+    """实体上下文视图 - 按实体类预先计算的字段表懒读取属性，写入保存在覆盖层中
+
+    time 与原字典上下文一致，是创建上下文时的仿真时间快照（动作执行期间不随 env.now 变化）。
+    """
+    __slots__ = ('entity', 'overrides', 'time')
+
+    BUILTIN_KEYS = ('self', 'env', 'time', 'global')
+
+    def __init__(self, entity: 'BaseEntity'):
+        self.entity = entity
+        self.overrides: Dict[str, Any] = {}
+        self.time = entity.env.now
+
+    def _builtin(self, key: str) -> Any:
+        if key == 'self':
+            return self.entity
+        if key == 'env':
+            return self.entity.env
+        if key == 'time':
+            return self.time
+        return self.entity.simulation.global_vars
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.overrides:
+            return self.overrides[key]
+        if key in self.BUILTIN_KEYS:
+            return self._builtin(key)
+        if key in self.entity._context_field_set:
+            value = getattr(self.entity, key, None)
+            if isinstance(value, CONTEXT_SCALAR_TYPES):
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any):
+        self.overrides[key] = value
+
+    def __delitem__(self, key: str):
+        del self.overrides[key]
+
+    def __iter__(self):
+        yield from self.overrides
+        for key in self.BUILTIN_KEYS:
+            if key not in self.overrides:
+                yield key
+        for key in self.entity._context_fields:
+            if key not in self.overrides and isinstance(getattr(self.entity, key, None), CONTEXT_SCALAR_TYPES):
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __contains__(self, key) -> bool:
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def snapshot(self) -> Dict:
+        """生成当前时刻的普通字典副本"""
+        return dict(self)
+
+class EATIXmlSource:
+    """EATI XML流式读取源 - 转义公式中未转义的比较运算符 '<'（如 random() < 0.3）"""
+    BARE_LT = re.compile(rb'<(?=[\s=0-9(\-.])')
+
+    def __init__(self, path: str, chunk_size: int = 64 * 1024):
+        self.file = open(path, 'rb')
+        self.chunk_size = chunk_size
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size if size and size > 0 else self.chunk_size)
+        # 块末尾的 '<' 需要看到下一个字节才能判断
+        while data.endswith(b'<'):
+            extra = self.file.read(1)
+            if not extra:
                 break
+            data += extra
+        return self.BARE_LT.sub(b'&lt;', data)
 
-    def run_action(self, action_id: str, context_data: Dict = None):
-        """执行动作"""
-        self.update_status(action=action_id)
-        if action_id in actions:
-            context = self.get_context()
-            if context_data:
-                context.update(context_data)
-            yield self.env.process(actions[action_id].execute(self, context))
+    def close(self):
+        self.file.close()
 
-class ArtilleryBattalion(BaseEntity):
-    """炮兵营实体"""
-    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
-        super().__init__(env, entity_id, simulation)
-        self.name = '炮兵营'
-        self.type = 'agent'
-        self.position = {'x': -500.0, 'y': -200.0, 'z': 0.0}
-        self.attributes = {
-            'unit_type': 'artillery',
-            'call_sign': 'Thunder',
-            'guns_count': '18'
-        }
-        self.fire_status = 'ready'
-        self.rounds_fired = 0
-        self.actions = []
+    def __enter__(self):
+        return self
 
-    def start(self):
-        """启动实体进程"""
-        log_and_collect('INFO', 
-                       f'{self.name} ({self.attributes["call_sign"]}) 准备就绪，火炮数量: {self.attributes["guns_count"]}', 
-                       entity=self.name)
-        self.env.process(self.message_handler())
+    def __exit__(self, *exc):
+        self.close()
 
-    def message_handler(self):
-        """处理消息"""
+def load_state_variable_schema(xml_path: str) -> Dict[str, List[str]]:
+    """从EATI XML的 Attribute/StateVariable 元素读取各实体的属性模式"""
+    schema = {}
+    with EATIXmlSource(xml_path) as source:
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag.rsplit('}', 1)[-1] != 'Entity':
+                continue
+            fields = []
+            for child in elem.iter():
+                tag = child.tag.rsplit('}', 1)[-1]
+                if tag == 'Attribute' and child.get('name'):
+                    fields.append(child.get('name'))
+                elif tag == 'StateVariable' and child.get('id'):
+                    sv_id = child.get('id')
+                    fields.append(sv_id[3:] if sv_id.startswith('sv_') else sv_id)
+            schema[elem.get('id')] = fields
+            elem.clear()
+    return schema
+
+# 分层定时轮（集中的周期回调服务）
+class PeriodicTimer:
+    """定时轮中的周期回调登记项"""
+    __slots__ = ('callback', 'period_ticks', 'expire_tick', 'owner', 'seq', 'cancelled')
+
+    def __init__(self, callback: Callable, period_ticks: int, expire_tick: int, owner: Any, seq: int):
+        self.callback = callback
+        self.period_ticks = period_ticks
+        self.expire_tick = expire_tick
+        self.owner = owner
+        self.seq = seq
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel:
+    """分层定时轮 - 所有周期回调共用一个SimPy进程
+
+    第0层每个槽对应一个刻度，上层每个槽覆盖下层一整圈，到期前逐层下放。
+    同一刻度到期的回调由一次唤醒按登记顺序执行，开销只与到期回调数成正比；
+    第0层一圈内没有到期项时直接跳到下一个下放点。
+    """
+    def __init__(self, env: simpy.Environment, resolution: float = TIMER_WHEEL_RESOLUTION,
+                 slot_bits: int = 6, levels: int = 4):
+        self.env = env
+        self.resolution = resolution
+        self.slot_bits = slot_bits
+        self.slot_count = 1 << slot_bits
+        self.slot_mask = self.slot_count - 1
+        self.wheels = [[[] for _ in range(self.slot_count)] for _ in range(levels)]
+        self.overflow = []  # 超出最高层范围的定时项
+        self.current_tick = self._tick_at(env.now)
+        self.active = 0
+        self.next_seq = 0
+        self.fired_count = 0
+        self.process = None
+        self.sleep_until = None
+
+    def _tick_at(self, sim_time: float) -> int:
+        return math.ceil(sim_time / self.resolution - 1e-9)
+
+    def register(self, callback: Callable, period: float, owner: Any = None,
+                 first_delay: float = None) -> PeriodicTimer:
+        """登记周期回调 callback(now)，首次在 first_delay（默认一个周期）后触发"""
+        period_ticks = max(1, round(period / self.resolution))
+        delay = period if first_delay is None else first_delay
+        expire_tick = max(self._tick_at(self.env.now + delay), self.current_tick + 1)
+        timer = PeriodicTimer(callback, period_ticks, expire_tick, owner, self.next_seq)
+        self.next_seq += 1
+        self.active += 1
+        self._insert(timer)
+        # 定时轮进程休眠到更晚的刻度时中断它以重新计算唤醒时刻
+        if (self.process is not None and self.sleep_until is not None and expire_tick < self.sleep_until
+                and self.env.active_process is not self.process):
+            self.sleep_until = None
+            self.process.interrupt()
+        return timer
+
+    def cancel_owner(self, owner: Any):
+        """取消某个实体登记的全部回调"""
+        for level in self.wheels:
+            for slot in level:
+                for timer in slot:
+                    if timer.owner is owner:
+                        timer.cancel()
+        for timer in self.overflow:
+            if timer.owner is owner:
+                timer.cancel()
+
+    def _insert(self, timer: PeriodicTimer):
+        delta = timer.expire_tick - self.current_tick
+        for level, wheel in enumerate(self.wheels):
+            if delta < (1 << (self.slot_bits * (level + 1))):
+                wheel[(timer.expire_tick >> (self.slot_bits * level)) & self.slot_mask].append(timer)
+                return
+        self.overflow.append(timer)
+
+    def _cascade(self, tick: int):
+        """在第0层转满一圈时把上层到期槽下放"""
+        for level in range(1, len(self.wheels)):
+            shift = self.slot_bits * level
+            if tick & ((1 << shift) - 1):
+                break
+            index = (tick >> shift) & self.slot_mask
+            timers = self.wheels[level][index]
+            self.wheels[level][index] = []
+            for timer in timers:
+                self._insert(timer)
+        else:
+            if self.overflow and not tick & ((1 << (self.slot_bits * len(self.wheels))) - 1):
+                timers, self.overflow = self.overflow, []
+                for timer in timers:
+                    self._insert(timer)
+
+    def _next_tick(self) -> int:
+        """下一个需要唤醒的刻度：第0层一圈内最近的非空槽，否则为下一个下放点"""
+        wheel = self.wheels[0]
+        tick = self.current_tick + 1
+        boundary = (tick | self.slot_mask) + 1
+        while tick < boundary:
+            if wheel[tick & self.slot_mask]:
+                return tick
+            tick += 1
+        return boundary
+
+    def run(self):
+        """定时轮进程"""
+        self.process = self.env.active_process
         while True:
             try:
-                msg = yield self.message_queue.get()
-                log_and_collect('INFO', f'{self.name} 收到命令: {msg.get("type", "unknown")}', 
-                               entity=self.name)
+                if not self.active:
+                    self.sleep_until = math.inf
+                    yield self.env.event()
+                    continue
                 
-                if msg.get('type') == 'fire_order':
-                    self.env.process(self.run_action('act_execute_fire_mission', msg))
-                elif msg.get('type') == 'cease_fire':
-                    self.env.process(self.run_action('act_cease_fire', msg))
-                    
+                next_tick = self._next_tick()
+                self.sleep_until = next_tick
+                yield self.env.timeout(max(0.0, next_tick * self.resolution - self.env.now))
             except simpy.Interrupt:
-                break
+                continue
+            self.sleep_until = None
+            
+            # 推进到目标刻度（跳过的刻度在第0层均为空槽，只需处理下放点）
+            self.current_tick = next_tick
+            if not next_tick & self.slot_mask:
+                self._cascade(next_tick)
+            
+            slot_index = next_tick & self.slot_mask
+            due = self.wheels[0][slot_index]
+            self.wheels[0][slot_index] = []
+            due.sort(key=lambda t: t.seq)
+            for timer in due:
+                if timer.cancelled:
+                    self.active -= 1
+                    continue
+                self.fired_count += 1
+                timer.callback(self.env.now)
+                if timer.cancelled:
+                    self.active -= 1
+                    continue
+                timer.expire_tick = next_tick + timer.period_ticks
+                self._insert(timer)
 
-    def run_action(self, action_id: str, context_data: Dict = None):
-        """执行动作"""
-        self.update_status(action=action_id)
-        if action_id in actions:
-            context = self.get_context()
-            if context_data:
-                context.update(context_data)
-            yield self.env.process(actions[action_id].execute(self, context))
+# 日历队列事件表（可选实现；CPython下基准仍慢于heapq二叉堆，默认不启用）
+class CalendarQueue:
+    """日历队列 - 按时间分桶的事件表
 
-class ReconSquad(BaseEntity):
-    """步兵侦察班实体"""
-    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
-        super().__init__(env, entity_id, simulation)
-        self.name = '步兵侦察班'
-        self.type = 'agent'
-        self.position = {'x': 100.0, 'y': 100.0, 'z': 0.0}
-        self.attributes = {
-            'unit_type': 'recon',
-            'call_sign': 'Scout',
-            'squad_size': '8'
-        }
-        self.patrol_status = 'patrolling'
-        self.enemy_contact = False
-        self.actions = []
+    条目与SimPy堆中相同，为 (时间, 优先级, 事件ID, 事件) 元组，桶内有序，
+    因此出队顺序与二叉堆完全一致。每个桶带读游标，出队只移动游标，
+    前移的条目写回已消费的位置，游标过半时压缩，避免 list.pop(0) 的O(k)搬移。
+    桶宽取最早若干事件中相邻不同时刻的平均间隔，使每个桶只含O(1)个不同时刻，
+    同一时刻的事件按事件ID递增直接追加到桶尾。规模翻倍或减半时重建并重新估计桶宽。
+    """
+    MIN_BUCKETS = 16
+    SAMPLE_SIZE = 25
+    COMPACT_AT = 32
 
-    def start(self):
-        """启动实体进程"""
-        log_and_collect('INFO', 
-                       f'{self.name} ({self.attributes["call_sign"]}) 开始执行侦察任务，人员: {self.attributes["squad_size"]}人', 
-                       entity=self.name)
-        self.env.process(self.run_action('act_patrol'))
-        self.env.process(self.monitor_conditions())
-        self.env.process(self.message_handler())
+    def __init__(self, start_time: float = 0.0, bucket_width: float = 1.0):
+        self.size = 0
+        self.far = []  # 时间为无穷大的条目（小根堆）
+        self._rebuild(self.MIN_BUCKETS, bucket_width, start_time, [])
 
-    def monitor_conditions(self):
-        """监控触发条件"""
-        while True:
-            yield self.env.timeout(1)
-            
-            if self.enemy_contact and self.current_action != 'act_report_enemy':
-                self.env.process(self.run_action('act_report_enemy'))
-            
-            if self.simulation.global_vars.get('StrikeCompleted', False) and self.current_action != 'act_assess_damage':
-                self.env.process(self.run_action('act_assess_damage'))
+    def __len__(self) -> int:
+        return self.size
 
-    def run_action(self, action_id: str):
-        """执行动作"""
-        self.update_status(action=action_id)
-        if action_id in actions:
-            yield self.env.process(actions[action_id].execute(self, self.get_context()))
+    def _rebuild(self, bucket_count: int, width: float, start_time: float, entries: List[tuple]):
+        self.bucket_count = bucket_count
+        self.mask = bucket_count - 1  # 桶数始终为2的幂
+        self.width = width
+        self.scale = 1.0 / width
+        self.buckets = [[] for _ in range(bucket_count)]
+        self.heads = [0] * bucket_count  # 各桶读游标
+        self.cursor = int(start_time * self.scale)  # 当前虚拟桶号，不大于最早条目所在的虚拟桶号
+        scale, mask, buckets = self.scale, self.mask, self.buckets
+        entries.sort()
+        for entry in entries:
+            buckets[int(entry[0] * scale) & mask].append(entry)
+        self.grow_at = 2 * bucket_count
+        self.shrink_at = bucket_count // 2 if bucket_count > self.MIN_BUCKETS else -1
 
-    def message_handler(self):
-        """处理消息"""
-        while True:
-            try:
-                msg = yield self.message_queue.get()
-                log_and_collect('INFO', f'{self.name} 收到消息: {msg}', entity=self.name)
-            except simpy.Interrupt:
-                break
+    def push(self, entry: tuple):
+        sim_time = entry[0]
+        if sim_time == math.inf:
+            heapq.heappush(self.far, entry)
+        else:
+            slot = int(sim_time * self.scale)
+            index = slot & self.mask
+            bucket = self.buckets[index]
+            if not bucket or entry > bucket[-1]:
+                bucket.append(entry)
+            else:
+                head = self.heads[index]
+                if head and entry < bucket[head]:
+                    head -= 1
+                    bucket[head] = entry
+                    self.heads[index] = head
+                else:
+                    bisect.insort(bucket, entry, head)
+            if slot < self.cursor:
+                self.cursor = slot
+        self.size += 1
+        if self.size > self.grow_at:
+            self._resize(2 * self.bucket_count)
 
-# 活动函数定义（全部使用装饰器）
+    def _locate(self) -> int:
+        """返回最早条目所在桶的下标（无有限时间条目时返回-1）"""
+        if self.size == len(self.far):
+            return -1
+        buckets, heads, mask, scale = self.buckets, self.heads, self.mask, self.scale
+        slot = self.cursor
+        for _ in range(self.bucket_count):
+            index = slot & mask
+            bucket = buckets[index]
+            head = heads[index]
+            if head < len(bucket) and int(bucket[head][0] * scale) <= slot:
+                self.cursor = slot
+                return index
+            slot += 1
+        # 一整圈都没有落在当前年份的条目：直接搜索各桶首条目
+        earliest = min(bucket[head] for bucket, head in zip(buckets, heads) if head < len(bucket))
+        self.cursor = int(earliest[0] * scale)
+        return self.cursor & mask
 
-@enhanced_activity_wrapper
-def activity_move_patrol(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：巡逻移动"""
-    yield env.process(check_pause(env, entity))
-    
-    evaluator = ExpressionEvaluator(context)
-    current_position = entity.position
-    new_position = evaluator.evaluate('calculate_patrol_route(current_position, time)')
-    
-    if new_position:
-        old_pos = entity.position.copy()
-        entity.position = new_position
-        log_and_collect('INFO', 
-                       f'{entity.name} 移动到新位置: ({new_position["x"]:.1f}, {new_position["y"]:.1f})', 
-                       entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 30})
-    yield env.timeout(delay_time)
+    def peek(self) -> Optional[tuple]:
+        index = self._locate()
+        if index >= 0:
+            return self.buckets[index][self.heads[index]]
+        return self.far[0] if self.far else None
 
-@enhanced_activity_wrapper
-def activity_scan_area(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：扫描区域"""
-    yield env.process(check_pause(env, entity))
-    
-    evaluator = ExpressionEvaluator(context)
-    enemy_detected = evaluator.evaluate('random() < 0.3')
-    
-    entity.enemy_contact = enemy_detected
-    
-    if enemy_detected:
-        log_and_collect('WARNING', f'{entity.name} 发现敌情！', entity=entity.name,
-                       msg_type=MessageType.ALERT)
-        entity.simulation.global_vars['EnemyDetected'] = True
+    def pop(self) -> tuple:
+        index = self._locate()
+        if index >= 0:
+            bucket = self.buckets[index]
+            head = self.heads[index]
+            entry = bucket[head]
+            head += 1
+            if head == len(bucket):
+                bucket.clear()
+                head = 0
+            elif head >= self.COMPACT_AT and 2 * head >= len(bucket):
+                del bucket[:head]
+                head = 0
+            self.heads[index] = head
+        elif self.far:
+            entry = heapq.heappop(self.far)
+        else:
+            raise IndexError('pop from empty calendar queue')
+        self.size -= 1
+        if self.size < self.shrink_at:
+            self._resize(self.bucket_count // 2)
+        return entry
+
+    def _resize(self, bucket_count: int):
+        entries = [entry for bucket, head in zip(self.buckets, self.heads) for entry in bucket[head:]]
+        if not entries:
+            self._rebuild(bucket_count, self.width, self.cursor * self.width, entries)
+            return
+        sample = heapq.nsmallest(min(len(entries), self.SAMPLE_SIZE), entries)
+        width = self._estimate_width([entry[0] for entry in sample]) or self.width
+        self._rebuild(bucket_count, width, sample[0][0], entries)
+
+    @staticmethod
+    def _estimate_width(times: List[float]) -> float:
+        """以样本中相邻不同时刻的平均间隔为桶宽（剔除大于2倍平均间隔的离群间隔）"""
+        distinct = sorted(set(times))
+        gaps = [b - a for a, b in zip(distinct, distinct[1:])]
+        if not gaps:
+            return 0.0
+        mean = sum(gaps) / len(gaps)
+        kept = [gap for gap in gaps if gap <= 2 * mean]
+        return sum(kept) / len(kept) if kept else mean
+
+class CalendarQueueEnvironment(simpy.Environment):
+    """使用日历队列事件表的SimPy环境，排序与并列规则（时间、优先级、事件ID）与默认环境一致"""
+    def __init__(self, initial_time: float = 0):
+        super().__init__(initial_time)
+        self._calendar = CalendarQueue(initial_time)
+
+    def schedule(self, event: simpy.Event, priority: int = simpy.events.NORMAL, delay: float = 0):
+        self._calendar.push((self._now + delay, priority, next(self._eid), event))
+
+    def peek(self) -> float:
+        entry = self._calendar.peek()
+        return entry[0] if entry is not None else simpy.core.Infinity
+
+    def peek_entry(self) -> Optional[tuple]:
+        return self._calendar.peek()
+
+    def step(self):
+        try:
+            self._now, _, _, event = self._calendar.pop()
+        except IndexError:
+            raise simpy.core.EmptySchedule() from None
+        
+        callbacks, event.callbacks = event.callbacks, None
+        try:
+            for callback in callbacks:
+                callback(event)
+        except simpy.core.StopSimulation:
+            event.callbacks = callbacks[callbacks.index(callback) + 1:]
+            self.schedule(event, simpy.events.URGENT - 1)
+            raise
+        
+        if not event._ok and not hasattr(event, '_defused'):
+            exc = type(event._value)(*event._value.args)
+            exc.__cause__ = event._value
+            raise exc
+
+def peek_entry(env: simpy.Environment) -> Optional[tuple]:
+    """返回下一个待处理的 (时间, 优先级, 事件ID, 事件) 条目，兼容两种事件表
+
+    SimPy只公开下一个事件的时间（env.peek()），默认环境的条目取自私有堆 env._queue（SimPy 4.1.x）。
+    """
+    if isinstance(env, CalendarQueueEnvironment):
+        return env.peek_entry()
+    return env._queue[0] if env._queue else None
+
+def urgent_event(env: simpy.Environment, delay: float = 0) -> simpy.Event:
+    """以URGENT优先级调度一个已成功的事件，与 env.run(until=...) 的停止事件排序规则相同
+
+    SimPy的公开接口只能以NORMAL优先级调度已成功的事件（env.timeout），这里与 Environment.run 的实现一样
+    直接设置私有字段 _ok/_value（SimPy 4.1.x，升级SimPy时需核对），本模块只在此处写入这两个字段。
+    """
+    event = env.event()
+    event._ok = True
+    event._value = None
+    env.schedule(event, simpy.events.URGENT, delay)
+    return event
+
+def pending_event_count(env: simpy.Environment) -> int:
+    """事件表中待处理的事件数，兼容两种事件表"""
+    if isinstance(env, CalendarQueueEnvironment):
+        return len(env._calendar)
+    return len(env._queue)
+
+def create_environment(kind: str = None, flat_execution: bool = None) -> simpy.Environment:
+    """按配置创建仿真环境，flat_execution 为该环境中动作的执行方式（默认取 FLAT_ACTION_EXECUTION）"""
+    kind = kind or EVENT_QUEUE
+    if kind == 'calendar':
+        env = CalendarQueueEnvironment()
     else:
-        logging.info(f'{entity.name} 区域安全，未发现敌情')
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 10})
-    yield env.timeout(delay_time)
-    
-    return {'enemy_detected': enemy_detected}
+        if kind != 'heap':
+            logging.warning(f'未知的事件表类型: {kind}，使用默认二叉堆')
+        env = simpy.Environment()
+    env.flat_execution = FLAT_ACTION_EXECUTION if flat_execution is None else flat_execution
+    return env
 
-@enhanced_activity_wrapper
-def activity_gather_intel(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：收集情报"""
-    log_and_collect('INFO', f'{entity.name} 开始收集敌情详细信息', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    enemy_info = {
-        'position': {'x': 800, 'y': 600},
-        'strength': 'company',
-        'type': 'mechanized'
+def benchmark_event_queues(pending_counts: List[int] = (100, 1000, 10000, 100000),
+                           operations: int = 200000, seed: int = RANDOM_SEED) -> Dict:
+    """事件表基准测试（hold模型）：保持N个待处理超时，每处理一个事件再调度一个新事件
+
+    exponential 负载的新事件延迟服从指数分布；tick 负载以固定步长推进，大量事件落在同一时刻。
+    """
+    workloads = {
+        'exponential': lambda rng: rng.expovariate(1.0),
+        'tick': lambda rng: 1.0,
     }
-    
-    context['enemy_info'] = enemy_info
-    
-    log_and_collect('INFO', f'{entity.name} 收集到敌情: 位置({enemy_info["position"]["x"]}, {enemy_info["position"]["y"]}), '
-                          f'规模: {enemy_info["strength"]}, 类型: {enemy_info["type"]}', 
-                   entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('uniform', {'min': 20, 'max': 40})
-    yield env.timeout(delay_time)
-    
-    return enemy_info
+    results = {}
+    for workload, next_delay in workloads.items():
+        results[workload] = {}
+        for pending in pending_counts:
+            results[workload][pending] = {}
+            for kind in ('heap', 'calendar'):
+                env = create_environment(kind)
+                rng = random.Random(seed)
+                
+                def hold(event):
+                    env.timeout(next_delay(rng)).callbacks.append(hold)
+                
+                for _ in range(pending):
+                    env.timeout(rng.expovariate(1.0)).callbacks.append(hold)
+                
+                start = time.perf_counter()
+                for _ in range(operations):
+                    env.step()
+                elapsed = time.perf_counter() - start
+                results[workload][pending][kind] = elapsed / operations * 1e9
+            
+            print(f"{workload:>11} 待处理事件 {pending:>7}: "
+                  f"二叉堆 {results[workload][pending]['heap']:8.1f} ns/事件, "
+                  f"日历队列 {results[workload][pending]['calendar']:8.1f} ns/事件")
+    return results
 
-@enhanced_activity_wrapper
-def activity_send_enemy_report(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：发送敌情报告"""
-    log_and_collect('INFO', f'{entity.name} 发送敌情报告到指挥所', entity=entity.name)
+def benchmark_action_execution(end_time: float = 600, seed: int = RANDOM_SEED) -> Dict:
+    """动作执行基准：分别以嵌套子进程和扁平执行运行到任务完成，统计每个完成任务处理的事件数
+
+    两种方式必须是同一条仿真轨迹（Activity时间线、全局变量、结束时刻和随机数状态都相同），否则不报告对比结果。
+    """
+    saved_level = logging.root.level
+    logging.root.setLevel(logging.CRITICAL)
+    results = {}
+    trajectories = []
+    try:
+        for flat in (False, True):
+            random.seed(seed)
+            np.random.seed(seed)
+            simulation = EATISimulation(flat_execution=flat)
+            simulation.run_state = RunState.RUNNING
+            simulation.setup(enable_websocket=False)
+            env = simulation.env
+            first_record = len(activity_logger.timeline_records)
+            
+            events = 0
+            start = time.perf_counter()
+            while env.peek() <= end_time and 'evt_mission_complete' not in simulation.event_scheduler.events:
+                env.step()
+                events += 1
+            elapsed = time.perf_counter() - start
+            
+            missions = 1 if 'evt_mission_complete' in simulation.event_scheduler.events else 0
+            results['flat' if flat else 'nested'] = {
+                'events': events,
+                'missions_completed': missions,
+                'events_per_mission': events / missions if missions else None,
+                'sim_time': env.now,
+                'wall_time': elapsed
+            }
+            trajectories.append((
+                env.now,
+                dict(simulation.global_vars),
+                [(r['event_type'], r['activity_name'], r['entity_id'], r['sim_time'])
+                 for r in activity_logger.timeline_records[first_record:]],
+                random.getstate(),
+                hashlib.sha1(pickle.dumps(np.random.get_state())).hexdigest()
+            ))
+    finally:
+        logging.root.setLevel(saved_level)
     
-    yield env.process(check_pause(env, entity))
+    labels = ('结束时刻', '全局变量', 'Activity时间线', 'random状态', 'numpy随机数状态')
+    differences = [label for label, nested, flat in zip(labels, *trajectories) if nested != flat]
+    if differences:
+        raise RuntimeError(f'扁平执行与嵌套执行的仿真轨迹不一致（{", ".join(differences)}），事件数不可比较')
     
-    if 'ent_command_post' in entity.simulation.entities:
-        command_post = entity.simulation.entities['ent_command_post']
-        enemy_info = context.get('enemy_info', {})
+    for mode, r in results.items():
+        print(f"{mode:>6}: 事件数 {r['events']:>7}, 完成任务 {r['missions_completed']}, "
+              f"仿真时间 {r['sim_time']:.1f}s, 耗时 {r['wall_time'] * 1000:.1f}ms")
+    print(f"轨迹一致（{len(trajectories[0][2])} 条Activity记录）")
+    return results
+
+# 空间索引（均匀网格，支持范围查询与k近邻查询）
+class SpatialGrid:
+    """均匀网格空间索引 - 位置变化时增量更新，查询只访问覆盖范围内的网格单元
+
+    指定 locator(obj) 时查询从对象读取实时坐标，对象在同一单元内移动无需更新索引。
+    """
+    def __init__(self, cell_size: float = SPATIAL_CELL_SIZE, locator: Callable = None):
+        self.cell_size = cell_size
+        self.locator = locator
+        self.cells: Dict[tuple, Dict[str, Any]] = {}
+        self.items: Dict[str, tuple] = {}  # key -> (x, y, cell, obj)
+
+    def _coords(self, key: str, obj: Any) -> tuple:
+        if self.locator is not None:
+            return self.locator(obj)
+        return self.items[key][:2]
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _cell(self, x: float, y: float) -> tuple:
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def update(self, key: str, x: float, y: float, obj: Any):
+        """插入或移动一个对象"""
+        cell = self._cell(x, y)
+        old = self.items.get(key)
+        if old is None or old[2] != cell:
+            if old is not None:
+                self._remove_from_cell(key, old[2])
+            self.cells.setdefault(cell, {})[key] = obj
+        self.items[key] = (x, y, cell, obj)
+
+    def remove(self, key: str):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self._remove_from_cell(key, old[2])
+
+    def _remove_from_cell(self, key: str, cell: tuple):
+        bucket = self.cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self.cells[cell]
+
+    def query_range(self, x: float, y: float, radius: float, predicate: Callable = None) -> List[tuple]:
+        """返回半径内的 (距离, key, 对象) 列表，按距离升序"""
+        cx0, cy0 = self._cell(x - radius, y - radius)
+        cx1, cy1 = self._cell(x + radius, y + radius)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            cells = [bucket for cell, bucket in self.cells.items()
+                     if cx0 <= cell[0] <= cx1 and cy0 <= cell[1] <= cy1]
+        else:
+            cells = [self.cells[(cx, cy)] for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+                     if (cx, cy) in self.cells]
         
-        message = {
-            'type': 'enemy_report',
-            'source': entity.id,
-            'enemy_position': str(enemy_info.get('position', 'unknown')),
-            'enemy_strength': enemy_info.get('strength', 'unknown'),
-            'report_time': env.now,
-            'enemy_info': enemy_info
+        radius_sq = radius * radius
+        result = []
+        for bucket in cells:
+            for key, obj in bucket.items():
+                ox, oy = self._coords(key, obj)
+                dist_sq = (ox - x) ** 2 + (oy - y) ** 2
+                if dist_sq <= radius_sq and (predicate is None or predicate(obj)):
+                    result.append((math.sqrt(dist_sq), key, obj))
+        result.sort(key=lambda item: item[0])
+        return result
+
+    def nearest(self, x: float, y: float, k: int = 1, predicate: Callable = None) -> List[tuple]:
+        """k近邻：由内向外逐圈扫描网格，直到第k个结果不超过已覆盖半径"""
+        cx, cy = self._cell(x, y)
+        found = []
+        seen = 0
+        ring = 0
+        while seen < len(self.items):
+            if ring == 0:
+                ring_cells = [(cx, cy)]
+            else:
+                ring_cells = [(cx + dx, cy + dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)]
+                ring_cells += [(cx + dx, cy + dy) for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+            for cell in ring_cells:
+                bucket = self.cells.get(cell)
+                if not bucket:
+                    continue
+                for key, obj in bucket.items():
+                    seen += 1
+                    if predicate is None or predicate(obj):
+                        ox, oy = self._coords(key, obj)
+                        found.append((math.hypot(ox - x, oy - y), key, obj))
+            # 已扫描的圈数保证半径 ring * cell_size 内的对象都已找到
+            if len(found) >= k:
+                found.sort(key=lambda item: item[0])
+                if found[k - 1][0] <= ring * self.cell_size:
+                    break
+            ring += 1
+        found.sort(key=lambda item: item[0])
+        return found[:k]
+
+# 时间加权统计监视器（取值变化时增量累积，不做周期采样）
+class TimeWeightedStat:
+    """时间加权统计量：每次变化累加 上一取值 × 持续时间，更新与查询均为O(1)"""
+    __slots__ = ('start_time', 'last_time', 'value', 'area', 'minimum', 'maximum', 'changes')
+
+    def __init__(self, now: float, value: float = 0.0):
+        self.start_time = self.last_time = now
+        self.value = value
+        self.area = 0.0
+        self.minimum = self.maximum = value
+        self.changes = 0
+
+    def update(self, now: float, value: float):
+        if value == self.value:
+            return
+        self.area += self.value * (now - self.last_time)
+        self.last_time = now
+        self.value = value
+        self.changes += 1
+        if value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+
+    def mean(self, now: float) -> float:
+        elapsed = now - self.start_time
+        if elapsed <= 0:
+            return self.value
+        return (self.area + self.value * (now - self.last_time)) / elapsed
+
+    def to_dict(self, now: float) -> Dict:
+        return {'current': self.value, 'mean': self.mean(now), 'min': self.minimum, 'max': self.maximum,
+                'changes': self.changes}
+
+class StateVariableStat:
+    """状态变量统计：各取值的驻留时间与转移次数，数值型取值另计时间加权均值"""
+    __slots__ = ('start_time', 'last_time', 'value', 'durations', 'transitions', 'area')
+
+    def __init__(self, now: float, value: Any):
+        self.start_time = self.last_time = now
+        self.value = value
+        self.durations = {}
+        self.transitions = 0
+        self.area = 0.0
+
+    def update(self, now: float, value: Any):
+        if value == self.value:
+            return
+        elapsed = now - self.last_time
+        self.durations[self.value] = self.durations.get(self.value, 0.0) + elapsed
+        if isinstance(self.value, (int, float)):
+            self.area += self.value * elapsed
+        self.last_time = now
+        self.value = value
+        self.transitions += 1
+
+    def to_dict(self, now: float) -> Dict:
+        durations = dict(self.durations)
+        durations[self.value] = durations.get(self.value, 0.0) + now - self.last_time
+        total = now - self.start_time
+        result = {
+            'current': self.value,
+            'transitions': self.transitions,
+            'time_in_state': {str(state): duration for state, duration in durations.items()},
+            'fraction_in_state': {str(state): (duration / total if total > 0 else 0.0)
+                                  for state, duration in durations.items()}
+        }
+        if all(isinstance(state, (int, float)) for state in durations):
+            area = self.area + (self.value * (now - self.last_time) if isinstance(self.value, (int, float)) else 0)
+            result['mean'] = area / total if total > 0 else self.value
+        return result
+
+class ResourceMonitor:
+    """资源监视器：占用量、等待队列长度的时间加权统计"""
+    __slots__ = ('env', 'level', 'put_queue', 'get_queue')
+
+    def __init__(self, env: simpy.Environment, resource: Any):
+        self.env = env
+        self.level = TimeWeightedStat(env.now, self.level_of(resource))
+        self.put_queue = TimeWeightedStat(env.now, 0)
+        self.get_queue = TimeWeightedStat(env.now, 0)
+
+    @staticmethod
+    def level_of(resource: Any) -> float:
+        if isinstance(resource, simpy.Container):
+            return resource.level
+        if isinstance(resource, simpy.Store):
+            return len(resource.items)
+        return resource.count
+
+    def record(self, resource: Any):
+        now = self.env.now
+        self.level.update(now, self.level_of(resource))
+        self.put_queue.update(now, len(resource.put_queue))
+        self.get_queue.update(now, len(resource.get_queue))
+
+    def to_dict(self, resource: Any) -> Dict:
+        now = self.env.now
+        capacity = resource.capacity
+        mean_level = self.level.mean(now)
+        # 容器的利用率按已消耗比例计，Resource/Store按占用比例计
+        if isinstance(resource, simpy.Container):
+            utilization = (capacity - mean_level) / capacity
+        else:
+            utilization = mean_level / capacity if capacity != float('inf') else None
+        return {
+            'level': self.level.to_dict(now),
+            'capacity': capacity,
+            'utilization': utilization,
+            'put_queue': self.put_queue.to_dict(now),
+            'get_queue': self.get_queue.to_dict(now)
+        }
+
+class MonitoredResourceMixin:
+    """在资源的put/get触发点记录变化（每次请求或完成时O(1)）"""
+    def __init__(self, env: simpy.Environment, *args, **kwargs):
+        super().__init__(env, *args, **kwargs)
+        self.monitor = ResourceMonitor(env, self)
+
+    def _trigger_put(self, get_event):
+        super()._trigger_put(get_event)
+        self.monitor.record(self)
+
+    def _trigger_get(self, put_event):
+        super()._trigger_get(put_event)
+        self.monitor.record(self)
+
+class MonitoredContainer(MonitoredResourceMixin, simpy.Container):
+    pass
+
+class MonitoredResource(MonitoredResourceMixin, simpy.Resource):
+    pass
+
+class MonitoredStore(MonitoredResourceMixin, simpy.Store):
+    pass
+
+class StateMonitor:
+    """实体状态变量监视器：由 BaseEntity.__setattr__ 在受监视字段写入时调用"""
+    def __init__(self, env: simpy.Environment, fields: frozenset = MONITORED_STATE_VARIABLES):
+        self.env = env
+        self.fields = fields
+        self.stats = {}
+
+    def record(self, entity: Any, name: str, value: Any):
+        key = (entity.id, name)
+        stat = self.stats.get(key)
+        if stat is None:
+            self.stats[key] = StateVariableStat(self.env.now, value)
+        else:
+            stat.update(self.env.now, value)
+
+    def to_dict(self) -> Dict:
+        now = self.env.now
+        result = {}
+        for (entity_id, name), stat in self.stats.items():
+            result.setdefault(entity_id, {})[name] = stat.to_dict(now)
+        return result
+
+# 实体状态存储（结构数组，位置/速度/状态码存放在连续的NumPy数组中）
+class EntityStateStore:
+    """实体状态存储 - 每个实体持有行号 state_index，批量移动、状态快照和距离查询可直接做向量运算"""
+    AXES = ('x', 'y', 'z')
+
+    def __init__(self, capacity: int = 64):
+        self.size = 0
+        self.ids: List[str] = []
+        self.entities: List[Any] = []
+        self.positions = np.zeros((capacity, 3))
+        self.velocities = np.zeros((capacity, 3))
+        self.grid_cells = np.full((capacity, 2), np.iinfo(np.int64).min, dtype=np.int64)  # 在空间索引中登记的网格单元
+        self.status_columns: Dict[str, np.ndarray] = {}  # 状态字段 -> 状态码数组（-1表示未设置）
+        self.status_tables: Dict[str, List[str]] = {}    # 状态字段 -> 状态码对应的取值
+        self.status_lookup: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def capacity(self) -> int:
+        return len(self.positions)
+
+    def allocate(self, entity: Any) -> int:
+        """为实体分配一行，容量不足时按倍数扩展"""
+        if self.size == self.capacity:
+            self._grow(2 * self.capacity)
+        index = self.size
+        self.size += 1
+        self.ids.append(entity.id)
+        self.entities.append(entity)
+        return index
+
+    def _grow(self, capacity: int):
+        def grow(array, fill=0):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+        self.positions = grow(self.positions)
+        self.velocities = grow(self.velocities)
+        self.grid_cells = grow(self.grid_cells, np.iinfo(np.int64).min)
+        for name, column in self.status_columns.items():
+            self.status_columns[name] = grow(column, -1)
+
+    def locate(self, entity: Any) -> tuple:
+        """空间索引使用的实时平面坐标"""
+        x, y = self.positions[entity.state_index, :2].tolist()
+        return x, y
+
+    def get_vector(self, array: np.ndarray, index: int) -> Dict:
+        x, y, z = array[index].tolist()
+        return {'x': x, 'y': y, 'z': z}
+
+    def set_vector(self, array: np.ndarray, index: int, value: Dict):
+        array[index] = (value.get('x', 0.0), value.get('y', 0.0), value.get('z', 0.0))
+
+    def _status_column(self, field: str) -> np.ndarray:
+        column = self.status_columns.get(field)
+        if column is None:
+            column = self.status_columns[field] = np.full(self.capacity, -1, dtype=np.int16)
+            self.status_tables[field] = []
+            self.status_lookup[field] = {}
+        return column
+
+    def encode_status(self, field: str, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        self._status_column(field)
+        lookup = self.status_lookup[field]
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(self.status_tables[field])
+            self.status_tables[field].append(value)
+        return code
+
+    def get_status(self, field: str, index: int) -> Optional[str]:
+        code = int(self._status_column(field)[index])
+        return self.status_tables[field][code] if code >= 0 else None
+
+    def set_status(self, field: str, index: int, value: Optional[str]):
+        code = self.encode_status(field, value)
+        self._status_column(field)[index] = code
+
+    def rows_with_status(self, field: str, value: str) -> np.ndarray:
+        """状态等于指定值的行号数组"""
+        code = self.status_lookup.get(field, {}).get(value)
+        if code is None:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(self.status_columns[field][:self.size] == code)
+
+    def advance(self, dt: float, rows: np.ndarray = None) -> np.ndarray:
+        """按速度批量推进位置，返回位置发生变化的行号"""
+        n = self.size
+        velocities = self.velocities[:n]
+        moving = np.flatnonzero(np.any(velocities != 0.0, axis=1))
+        if rows is not None:
+            moving = np.intersect1d(moving, rows, assume_unique=True)
+        if len(moving):
+            self.positions[moving] += velocities[moving] * dt
+        return moving
+
+    def distances_to(self, x: float, y: float) -> np.ndarray:
+        """所有实体到给定点的平面距离"""
+        positions = self.positions[:self.size]
+        return np.hypot(positions[:, 0] - x, positions[:, 1] - y)
+
+    def snapshot(self) -> Dict:
+        """状态快照（按列）"""
+        n = self.size
+        return {
+            'ids': list(self.ids),
+            'positions': self.positions[:n].tolist(),
+            'velocities': self.velocities[:n].tolist(),
+            'status': {field: [self.status_tables[field][c] if c >= 0 else None for c in column[:n].tolist()]
+                       for field, column in self.status_columns.items()}
         }
+
+# 运动学子系统（固定步长、全部运动单位一次向量更新）
+class KinematicsSystem:
+    """运动学积分器 - 挂在定时轮上每个步长回调一次，用NumPy同时推进全部运动中的单位
+
+    两种运动方式：航路点跟随（到达每个航路点后转向下一个，最后一个到达时触发到达事件）
+    和环形巡逻（目标点沿圆周以固定角速度移动）。两者都受单位最大速度限制。
+    """
+    IDLE, WAYPOINT, CIRCLE = 0, 1, 2
+
+    def __init__(self, simulation, tick: float = KINEMATICS_TICK):
+        self.simulation = simulation
+        self.store = simulation.entity_state
+        self.tick = tick
+        self.mode = np.zeros(0, dtype=np.int8)
+        self.max_speed = np.zeros(0)
+        self.target = np.zeros((0, 2))
+        self.center = np.zeros((0, 2))
+        self.radius = np.zeros(0)
+        self.omega = np.zeros(0)
+        self.phase = np.zeros(0)
+        self.waypoint_queues: Dict[int, deque] = {}
+        self.arrival_events: Dict[int, simpy.Event] = {}
+        self.arrivals = 0
+
+    def start(self):
+        self.simulation.timer_wheel.register(self.step, period=self.tick, owner=self)
+
+    def _ensure_capacity(self):
+        capacity = self.store.capacity
+        if capacity <= len(self.mode):
+            return
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+        for name in ('mode', 'max_speed', 'target', 'center', 'radius', 'omega', 'phase'):
+            setattr(self, name, grow(getattr(self, name)))
+
+    def is_moving(self, entity: Any) -> bool:
+        return entity.state_index < len(self.mode) and self.mode[entity.state_index] != self.IDLE
+
+    def move_to(self, entity: Any, waypoints: List[Dict], speed: float = None) -> simpy.Event:
+        """沿航路点移动，返回到达最后一个航路点时触发的事件"""
+        self._ensure_capacity()
+        row = entity.state_index
+        self._release(row)
+        queue_ = deque((w['x'], w['y']) for w in waypoints)
+        event = self.simulation.env.event()
+        if not queue_:
+            event.succeed(entity.position)
+            return event
+        self.target[row] = queue_.popleft()
+        self.waypoint_queues[row] = queue_
+        self.arrival_events[row] = event
+        self.max_speed[row] = speed if speed is not None else getattr(entity, 'max_speed', 10.0)
+        self.mode[row] = self.WAYPOINT
+        return event
+
+    def start_patrol(self, entity: Any, center: Dict, radius: float = PATROL_RADIUS,
+                     angular_speed: float = PATROL_ANGULAR_SPEED, speed: float = None):
+        """环形巡逻：从当前位置对应的方位角开始（位于圆心时按仿真时间取角度）"""
+        self._ensure_capacity()
+        row = entity.state_index
+        self._release(row)
+        x, y = self.store.positions[row, :2]
+        if math.hypot(x - center['x'], y - center['y']) > 1e-6:
+            phase = math.atan2(y - center['y'], x - center['x'])
+        else:
+            phase = self.simulation.env.now * angular_speed
+        self.center[row] = (center['x'], center['y'])
+        self.radius[row] = radius
+        self.omega[row] = angular_speed
+        self.phase[row] = phase
+        self.max_speed[row] = speed if speed is not None else getattr(entity, 'max_speed', 10.0)
+        self.mode[row] = self.CIRCLE
+
+    def stop(self, entity: Any):
+        if entity.state_index < len(self.mode):
+            self._release(entity.state_index)
+            self.mode[entity.state_index] = self.IDLE
+            self.store.velocities[entity.state_index] = 0.0
+
+    def _release(self, row: int):
+        """取消未完成的航路点移动（等待者收到 None）"""
+        self.waypoint_queues.pop(row, None)
+        event = self.arrival_events.pop(row, None)
+        if event is not None and not event.triggered:
+            event.succeed(None)
+
+    def step(self, now: float):
+        """一个积分步长：计算期望位置、按最大速度截断、写回位置和速度"""
+        rows = np.flatnonzero(self.mode)
+        if not len(rows):
+            return
+        dt = self.tick
+        positions = self.store.positions
+        mode = self.mode[rows]
+        waypoint = mode == self.WAYPOINT
+        circle = ~waypoint
         
-        yield command_post.message_queue.put(message)
-        log_and_collect('INFO', f'{entity.name} 敌情报告已发送', entity=entity.name)
-    
-    entity.simulation.global_vars['EnemyDetected'] = True
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 5})
-    yield env.timeout(delay_time)
+        desired = np.empty((len(rows), 2))
+        desired[waypoint] = self.target[rows[waypoint]]
+        if circle.any():
+            circle_rows = rows[circle]
+            self.phase[circle_rows] += self.omega[circle_rows] * dt
+            phase = self.phase[circle_rows]
+            desired[circle] = self.center[circle_rows] + self.radius[circle_rows, None] * np.column_stack(
+                (np.cos(phase), np.sin(phase)))
+        
+        delta = desired - positions[rows, :2]
+        distance = np.hypot(delta[:, 0], delta[:, 1])
+        max_step = self.max_speed[rows] * dt
+        reached = distance <= max_step
+        scale = np.where(reached, 1.0, max_step / np.maximum(distance, 1e-12))
+        movement = delta * scale[:, None]
+        positions[rows, :2] += movement
+        self.store.velocities[rows, :2] = movement / dt
+        
+        # 只对到达航路点的单位做逐个处理
+        for row in rows[waypoint & reached].tolist():
+            self._on_waypoint_reached(row)
+        
+        # 空间索引按实时坐标查询，只需为跨越网格单元的单位更新登记
+        unit_index = self.simulation.unit_index
+        cells = np.floor(positions[rows, :2] / unit_index.cell_size).astype(np.int64)
+        changed = np.any(cells != self.store.grid_cells[rows], axis=1)
+        if changed.any():
+            changed_rows = rows[changed]
+            self.store.grid_cells[changed_rows] = cells[changed]
+            entities = self.store.entities
+            for row, (x, y) in zip(changed_rows.tolist(), positions[changed_rows, :2].tolist()):
+                entity = entities[row]
+                unit_index.update(entity.id, x, y, entity)
 
-@enhanced_activity_wrapper
-def activity_analyze_report(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：分析报告"""
-    log_and_collect('INFO', f'{entity.name} 开始分析敌情报告', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    evaluator = ExpressionEvaluator(context)
-    enemy_info = context.get('enemy_info', {})
-    threat_level = evaluator.evaluate('analyze_enemy_info(enemy_info)')
-    
-    context['threat_level'] = threat_level
-    
-    threat_desc = '高' if threat_level > 0.7 else ('中' if threat_level > 0.4 else '低')
-    log_and_collect('INFO', f'{entity.name} 威胁评估完成: 威胁等级 - {threat_desc} ({threat_level:.2f})', 
-                   entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 30})
-    yield env.timeout(delay_time)
-    
-    return {'threat_level': threat_level, 'threat_desc': threat_desc}
+    def _on_waypoint_reached(self, row: int):
+        queue_ = self.waypoint_queues.get(row)
+        if queue_:
+            self.target[row] = queue_.popleft()
+            return
+        self.mode[row] = self.IDLE
+        self.store.velocities[row] = 0.0
+        self.waypoint_queues.pop(row, None)
+        self.arrivals += 1
+        event = self.arrival_events.pop(row, None)
+        if event is not None:
+            event.succeed(self.store.get_vector(self.store.positions, row))
 
-@enhanced_activity_wrapper
-def activity_make_decision(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：做出决策"""
-    log_and_collect('INFO', f'{entity.name} 开始决策是否开火', entity=entity.name)
+class StatusField:
+    """状态字段描述符：取值以状态码形式存放在 EntityStateStore 的列中"""
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.simulation.entity_state.get_status(self.name, obj.state_index)
+
+    def __set__(self, obj, value):
+        obj.simulation.entity_state.set_status(self.name, obj.state_index, value)
+
+# 地形与通视
+class TerrainGrid:
+    """高程栅格 - 以内存映射方式打开.npy文件，只有被采样到的页面才会读入内存"""
+    def __init__(self, elevation: Optional[np.ndarray] = None, cell_size: float = TERRAIN_CELL_SIZE,
+                 origin: tuple = TERRAIN_ORIGIN):
+        self.elevation = elevation
+        self.cell_size = cell_size
+        self.origin = origin
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'TerrainGrid':
+        """加载地形文件，未指定或文件不存在时返回平坦地形"""
+        if not path:
+            return cls()
+        if not os.path.exists(path):
+            logging.warning(f'地形文件不存在: {path}，使用平坦地形')
+            return cls()
+        elevation = np.load(path, mmap_mode='r')
+        logging.info(f'已映射地形文件 {path}: {elevation.shape[1]}x{elevation.shape[0]} 格，分辨率 {TERRAIN_CELL_SIZE}米')
+        return cls(elevation)
+
+    @property
+    def is_flat(self) -> bool:
+        return self.elevation is None
+
+    def cell_indices(self, xs: np.ndarray, ys: np.ndarray) -> tuple:
+        """世界坐标 -> (行, 列) 栅格索引（超出范围时取边缘格）"""
+        rows, cols = self.elevation.shape
+        col = np.clip(((np.asarray(xs) - self.origin[0]) // self.cell_size).astype(np.intp), 0, cols - 1)
+        row = np.clip(((np.asarray(ys) - self.origin[1]) // self.cell_size).astype(np.intp), 0, rows - 1)
+        return row, col
+
+    def cell_of(self, x: float, y: float) -> tuple:
+        return (math.floor((x - self.origin[0]) / self.cell_size), math.floor((y - self.origin[1]) / self.cell_size))
+
+    def elevation_at(self, xs, ys) -> np.ndarray:
+        """按最近格取高程（向量化）"""
+        if self.elevation is None:
+            return np.zeros(np.shape(xs))
+        row, col = self.cell_indices(xs, ys)
+        return np.asarray(self.elevation[row, col], dtype=float)
+
+class LineOfSightService:
+    """通视服务 - 批量检查观察者-目标对，对每条视线等间隔采样地形高程
+
+    结果按 (观察者, 目标) 缓存并记录双方所在的地形格，任一方移入其他格后缓存失效。
+    """
+    def __init__(self, terrain: TerrainGrid, observer_height: float = OBSERVER_HEIGHT,
+                 target_height: float = TARGET_HEIGHT, max_samples: int = LOS_MAX_SAMPLES):
+        self.terrain = terrain
+        self.observer_height = observer_height
+        self.target_height = target_height
+        self.max_samples = max_samples
+        self.cache: Dict[tuple, tuple] = {}  # (观察者id, 目标id) -> (观察者格, 目标格, 是否通视)
+        self.checks = 0
+        self.cache_hits = 0
+
+    def check_pairs(self, observers: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """批量通视判定：observers/targets 为 (n, 2) 平面坐标，返回长度为n的布尔数组"""
+        observers = np.asarray(observers, dtype=float).reshape(-1, 2)
+        targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+        if self.terrain.is_flat or not len(observers):
+            return np.ones(len(observers), dtype=bool)
+        
+        terrain = self.terrain
+        distance = np.hypot(*(targets - observers).T)
+        samples = int(min(self.max_samples, max(2, math.ceil(distance.max() / terrain.cell_size) + 1)))
+        t = np.linspace(0.0, 1.0, samples)[1:-1]  # 不含两端点
+        
+        observer_z = terrain.elevation_at(observers[:, 0], observers[:, 1]) + self.observer_height
+        target_z = terrain.elevation_at(targets[:, 0], targets[:, 1]) + self.target_height
+        xs = observers[:, 0, None] + t * (targets[:, 0] - observers[:, 0])[:, None]
+        ys = observers[:, 1, None] + t * (targets[:, 1] - observers[:, 1])[:, None]
+        ray_z = observer_z[:, None] + t * (target_z - observer_z)[:, None]
+        return np.all(terrain.elevation_at(xs, ys) <= ray_z, axis=1)
+
+    def visible(self, observer: Any, targets: List[Any]) -> List[bool]:
+        """单个观察者对多个目标的通视结果（使用缓存，未命中的对一次批量计算）"""
+        self.checks += len(targets)
+        if self.terrain.is_flat:
+            return [True] * len(targets)
+        
+        observer_position = observer.position
+        observer_cell = self.terrain.cell_of(observer_position['x'], observer_position['y'])
+        results: List[Optional[bool]] = []
+        pending = []
+        for i, target in enumerate(targets):
+            position = target.position
+            target_cell = self.terrain.cell_of(position['x'], position['y'])
+            cached = self.cache.get((observer.id, target.id))
+            if cached is not None and cached[0] == observer_cell and cached[1] == target_cell:
+                self.cache_hits += 1
+                results.append(cached[2])
+            else:
+                results.append(None)
+                pending.append((i, target, target_cell, (position['x'], position['y'])))
+        
+        if pending:
+            origins = np.repeat([[observer_position['x'], observer_position['y']]], len(pending), axis=0)
+            visible = self.check_pairs(origins, [p[3] for p in pending])
+            for (i, target, target_cell, _), value in zip(pending, visible.tolist()):
+                self.cache[(observer.id, target.id)] = (observer_cell, target_cell, value)
+                results[i] = value
+        return results
+
+    def can_see(self, observer: Any, target: Any) -> bool:
+        return self.visible(observer, [target])[0]
+
+@dataclass
+class HostileTarget:
+    """敌方目标（只参与探测与火力打击，不运行进程）"""
+    id: str
+    position: Dict
+    strength: str = 'company'
+    type: str = 'mechanized'
+    elements: np.ndarray = field(default=None, repr=False)
+    alive: np.ndarray = field(default=None, repr=False)
+    ROLE = 'hostile_target'
+    # 目标要素数量与展开正面（宽, 纵深，米）
+    FOOTPRINTS = {'platoon': (4, 100.0, 60.0), 'company': (12, 250.0, 150.0), 'battalion': (36, 600.0, 400.0)}
+
+    def __post_init__(self):
+        if self.elements is None:
+            # 要素布局按目标id确定，保证同一场景多次运行一致
+            count, width, depth = self.footprint
+            rng = np.random.default_rng(zlib.crc32(self.id.encode('utf-8')))
+            offsets = (rng.random((count, 2)) - 0.5) * np.array([width, depth])
+            self.elements = offsets + np.array([self.position['x'], self.position['y']])
+        if self.alive is None:
+            self.alive = np.ones(len(self.elements), dtype=bool)
+
+    @property
+    def footprint(self) -> tuple:
+        return self.FOOTPRINTS.get(self.strength, self.FOOTPRINTS['company'])
+
+    @property
+    def damage(self) -> float:
+        """已毁伤要素比例"""
+        return 1.0 - float(self.alive.mean()) if len(self.alive) else 0.0
+
+    def to_intel(self) -> Dict:
+        return {'target_id': self.id, 'position': {'x': self.position['x'], 'y': self.position['y']},
+                'strength': self.strength, 'type': self.type}
+
+# 火力毁伤模型
+class FireEffectsModel:
+    """蒙特卡洛火力毁伤模型
+
+    一次齐射的全部弹着点一次性采样：各炮诸元误差 + 沿射向旋转的散布椭圆；
+    弹着点与目标要素的距离矩阵经Carleton毁伤函数得到每发弹对每个要素的杀伤概率，
+    按要素连乘求存活概率。整个计算只有数组运算，不随弹数做Python循环。
+    """
+    def __init__(self, aim_error: float = FIRE_AIM_ERROR, range_dispersion: float = FIRE_RANGE_DISPERSION,
+                 deflection_dispersion: float = FIRE_DEFLECTION_DISPERSION,
+                 lethal_radius: tuple = LETHAL_RADIUS):
+        self.aim_error = aim_error
+        self.range_dispersion = range_dispersion
+        self.deflection_dispersion = deflection_dispersion
+        self.lethal_radius = np.asarray(lethal_radius, dtype=np.float64)
+
+    @staticmethod
+    def sheaf_offsets(guns: int, sheaf: tuple) -> np.ndarray:
+        """各炮瞄准点相对瞄准中心的偏移（沿射向, 垂直射向），按 (纵深, 宽度) 排成均匀网格"""
+        depth, width = sheaf
+        if guns <= 1 or width <= 0:
+            return np.zeros((guns, 2))
+        rows = max(1, min(guns, round(math.sqrt(guns * depth / width))))
+        cols = math.ceil(guns / rows)
+        row, col = np.divmod(np.arange(guns), cols)
+        return np.stack([((row + 0.5) / rows - 0.5) * depth, ((col + 0.5) / cols - 0.5) * width], axis=1)
+
+    def sample_impacts(self, origin: Dict, aim: Dict, rounds: int, guns: int, sheaf: tuple = (0.0, 0.0)) -> tuple:
+        """返回 (弹着点数组(rounds, 2), 射向单位向量)；各发弹依次分配给各门火炮"""
+        guns = max(1, min(int(guns), rounds))
+        line = np.array([aim['x'] - origin['x'], aim['y'] - origin['y']], dtype=np.float64)
+        distance = float(np.hypot(*line))
+        axis = line / distance if distance > 0 else np.array([1.0, 0.0])
+        rotation = np.array([[axis[0], -axis[1]], [axis[1], axis[0]]])
+        
+        sigma = np.maximum([distance * self.range_dispersion, distance * self.deflection_dispersion],
+                           FIRE_MIN_DISPERSION)
+        gun_bias = np.random.standard_normal((guns, 2)) * self.aim_error + self.sheaf_offsets(guns, sheaf)
+        spread = np.random.standard_normal((rounds, 2)) * sigma
+        impacts = ((spread + gun_bias[np.arange(rounds) % guns]) @ rotation.T
+                   + np.array([aim['x'], aim['y']]))
+        return impacts, axis
+
+    def resolve(self, impacts: np.ndarray, axis: np.ndarray, target: 'HostileTarget') -> Dict:
+        """结算一批弹着点对目标的毁伤，更新目标要素存活状态"""
+        _, width, depth = target.footprint
+        center = np.array([target.position['x'], target.position['y']])
+        in_footprint = np.all(np.abs(impacts - center) <= np.array([width, depth]) / 2, axis=1)
+        
+        # 要素相对弹着点的偏移投影到射向坐标系 (rounds, elements, 2)
+        offsets = target.elements[None, :, :] - impacts[:, None, :]
+        local = np.stack([offsets @ axis, offsets @ np.array([-axis[1], axis[0]])], axis=-1)
+        kill = np.exp(-np.sum((local / self.lethal_radius) ** 2, axis=-1))
+        survive = np.exp(np.log1p(-np.minimum(kill, 1 - 1e-12)).sum(axis=0))
+        
+        was_alive = target.alive.copy()
+        target.alive &= np.random.random(len(survive)) < survive
+        return {
+            'target_id': target.id,
+            'impacts_in_footprint': int(in_footprint.sum()),
+            'expected_kills': float((1 - survive)[was_alive].sum()),
+            'kills': int((was_alive & ~target.alive).sum()),
+            'damage': target.damage
+        }
+
+    def fire_salvo(self, origin: Dict, aim: Dict, rounds: int, guns: int, targets: List['HostileTarget'],
+                   sheaf: tuple = (0.0, 0.0)) -> Dict:
+        """对瞄准点射击一次齐射，结算波及范围内所有目标；sheaf为射向束覆盖的 (纵深, 宽度)"""
+        impacts, axis = self.sample_impacts(origin, aim, rounds, guns, sheaf)
+        return {'rounds': rounds, 'impacts': impacts,
+                'targets': [self.resolve(impacts, axis, target) for target in targets]}
+
+    def targets_near(self, hostile_index: 'SpatialGrid', aim: Dict) -> List['HostileTarget']:
+        """瞄准点附近可能被波及的目标（以最大展开正面加散布余量为半径）"""
+        reach = max(max(w, d) for _, w, d in HostileTarget.FOOTPRINTS.values()) + 4 * self.aim_error
+        return [target for _, _, target in hostile_index.query_range(aim['x'], aim['y'], reach)]
+
+# 消息总线（实体间通信及信道模型）
+@dataclass
+class ChannelModel:
+    """交互信道模型，QoS取自XML的 Interaction/QualityOfService 与 ExecutionSemantics"""
+    interaction_id: str
+    message_type: str
+    max_delivery_time: float = None
+    reliable: bool = True
+    guarantee: str = 'at-least-once'
+    priority: int = 1
+    latency: float = CHANNEL_LATENCY
+    bandwidth: float = CHANNEL_BANDWIDTH
+    loss_probability: float = CHANNEL_LOSS_PROBABILITY
+
+    @property
+    def retry_timeout(self) -> float:
+        """重传超时：有交付时限时取时限的一半，否则取基础时延的4倍"""
+        return self.max_delivery_time / 2 if self.max_delivery_time else self.latency * 4
+
+def load_channel_models(xml_path: str) -> Dict[str, ChannelModel]:
+    """从EATI XML的 Interactions 读取各交互的信道模型，按消息类型（去掉 int_ 前缀的交互id）索引"""
+    channels = {}
+    with EATIXmlSource(xml_path) as source:
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag.rsplit('}', 1)[-1] != 'Interaction' or not elem.get('id'):
+                continue
+            values = {}
+            for section in elem:
+                if section.tag.rsplit('}', 1)[-1] in ('ExecutionSemantics', 'QualityOfService'):
+                    values.update((child.tag.rsplit('}', 1)[-1], (child.text or '').strip()) for child in section)
+            interaction_id = elem.get('id')
+            message_type = interaction_id[4:] if interaction_id.startswith('int_') else interaction_id
+            channel = ChannelModel(interaction_id, message_type)
+            if values.get('MaxDeliveryTime'):
+                channel.max_delivery_time = float(values['MaxDeliveryTime'])
+            if values.get('DeliveryReliability'):
+                channel.reliable = values['DeliveryReliability'] != 'best-effort'
+            if values.get('DeliveryGuarantee'):
+                channel.guarantee = values['DeliveryGuarantee']
+            if values.get('Priority', '').isdigit():
+                channel.priority = int(values['Priority'])
+            if values.get('LossProbability'):
+                channel.loss_probability = float(values['LossProbability'])
+            channels[message_type] = channel
+            elem.clear()
+    return channels
+
+class ChannelStats:
+    """单个信道的计数器"""
+    __slots__ = ('sent', 'delivered', 'dropped', 'retransmissions', 'late', 'bytes_delivered',
+                 'queue_delay_total', 'queue_delay_max', 'latency_total', 'busy_until')
+
+    def __init__(self):
+        self.sent = self.delivered = self.dropped = self.retransmissions = self.late = 0
+        self.bytes_delivered = 0
+        self.queue_delay_total = self.queue_delay_max = self.latency_total = 0.0
+        self.busy_until = 0.0
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'retransmissions': self.retransmissions,
+            'late': self.late,
+            'throughput_bps': self.bytes_delivered * 8 / now if now > 0 else 0.0,
+            'avg_queue_delay': self.queue_delay_total / self.sent if self.sent else 0.0,
+            'max_queue_delay': self.queue_delay_max,
+            'avg_latency': self.latency_total / self.delivered if self.delivered else 0.0
+        }
+
+class MessageBus:
+    """消息总线 - 点对点、广播与按角色投递
+
+    路由表在实体创建后一次性建立：每个实体分配整数端点号(entity.endpoint)，
+    角色与广播目标预先展开为端点元组，发送时不再按字符串id查找实体。
+    每类消息走对应交互的信道：先按带宽在链路上排队串行发送，再叠加基础时延；
+    丢失的报文在可靠信道上按重传超时重发，非可靠信道直接丢弃。
+    投递以定时事件的回调完成，不为每条消息创建仿真进程。
+    丢包抽样使用总线自己的随机数发生器，不影响全局 random 的序列。
+    """
+    def __init__(self, env: simpy.Environment, channels: Dict[str, ChannelModel] = None, seed: int = RANDOM_SEED):
+        self.env = env
+        self.rng = random.Random(seed)
+        self.channels = dict(channels or {})
+        self.default_channel = ChannelModel('default', 'default')
+        self.stats = {}
+        self.endpoints = []
+        self.role_routes = {}
+        self.broadcast_route = ()
+
+    @classmethod
+    def from_xml(cls, env: simpy.Environment, xml_path: str = INTERACTION_MODEL_FILE,
+                 seed: int = RANDOM_SEED) -> 'MessageBus':
+        channels = {}
+        if xml_path and os.path.exists(xml_path):
+            try:
+                channels = load_channel_models(xml_path)
+            except (ET.ParseError, ValueError) as e:
+                logging.error(f'读取交互信道模型失败 {xml_path}: {e}')
+        return cls(env, channels, seed)
+
+    def build_routes(self, entities: Dict[str, Any]):
+        """建立路由表（实体集合变化后需重新调用）"""
+        self.endpoints = []
+        roles = {}
+        for entity in entities.values():
+            entity.endpoint = len(self.endpoints)
+            self.endpoints.append(entity.message_queue)
+            roles.setdefault(entity.ROLE, []).append(entity.endpoint)
+        self.role_routes = {role: tuple(route) for role, route in roles.items()}
+        self.broadcast_route = tuple(range(len(self.endpoints)))
+
+    def channel(self, message_type: str) -> ChannelModel:
+        return self.channels.get(message_type, self.default_channel)
+
+    def send(self, sender: Any, target: Any, message: Dict):
+        """点对点投递"""
+        self._dispatch(sender, (target.endpoint,), message)
+
+    def send_role(self, sender: Any, role: str, message: Dict):
+        """投递给某一角色的全部实体"""
+        self._dispatch(sender, self.role_routes.get(role, ()), message)
+
+    def broadcast(self, sender: Any, message: Dict):
+        """投递给除发送者以外的全部实体"""
+        route = tuple(endpoint for endpoint in self.broadcast_route if endpoint != sender.endpoint)
+        self._dispatch(sender, route, message)
+
+    def _dispatch(self, sender: Any, route: tuple, message: Dict):
+        channel = self.channel(message.get('type', 'default'))
+        stats = self.stats.get(channel.message_type)
+        if stats is None:
+            stats = self.stats[channel.message_type] = ChannelStats()
+        size = len(json.dumps(message, ensure_ascii=False, default=str).encode('utf-8'))
+        now = self.env.now
+        for endpoint in route:
+            stats.sent += 1
+            # 链路按FIFO串行发送，排队时延为等待链路空闲的时间
+            start = max(now, stats.busy_until)
+            stats.busy_until = start + size * 8 / channel.bandwidth
+            queue_delay = start - now
+            stats.queue_delay_total += queue_delay
+            stats.queue_delay_max = max(stats.queue_delay_max, queue_delay)
+            
+            attempts = 1
+            while self.rng.random() < channel.loss_probability:
+                if not channel.reliable or attempts > CHANNEL_MAX_RETRIES:
+                    attempts = 0
+                    break
+                attempts += 1
+            if attempts == 0:
+                stats.dropped += 1
+                log_and_collect('WARNING', '消息丢失: %s -> 端点%s (%s)', sender.id, endpoint, channel.interaction_id)
+                continue
+            stats.retransmissions += attempts - 1
+            
+            delay = stats.busy_until - now + channel.latency + (attempts - 1) * channel.retry_timeout
+            if channel.max_delivery_time is not None and delay > channel.max_delivery_time:
+                stats.late += 1
+            stats.latency_total += delay
+            stats.delivered += 1
+            stats.bytes_delivered += size
+            delivery = self.env.timeout(delay)
+            delivery.callbacks.append(functools.partial(self._deliver, self.endpoints[endpoint], message))
+
+    @staticmethod
+    def _deliver(store: simpy.Store, message: Dict, _event: simpy.Event):
+        store.put(message)
+
+    def get_statistics(self) -> Dict:
+        now = self.env.now
+        return {message_type: stats.to_dict(now) for message_type, stats in self.stats.items()}
+
+# 基础实体类（增加了activity名称属性）
+class BaseEntity:
+    """基础实体类"""
+    # 上下文字段模式：所有实体共有的字段，子类通过 STATE_VARIABLES 声明自身状态变量
+    CONTEXT_FIELDS = ('id', 'name', 'type', 'current_action', 'current_activity',
+                      'current_activity_name', 'current_activity_chinese_name')
+    STATE_VARIABLES = ()
+    _context_fields = CONTEXT_FIELDS
+    _context_field_set = frozenset(CONTEXT_FIELDS)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._rebuild_context_fields()
+
+    @classmethod
+    def _rebuild_context_fields(cls):
+        """沿MRO合并字段声明，生成预计算字段表"""
+        fields = []
+        for klass in reversed(cls.__mro__):
+            for name in getattr(klass, 'CONTEXT_FIELDS', ()) + tuple(klass.__dict__.get('STATE_VARIABLES', ())):
+                if name not in fields:
+                    fields.append(name)
+        cls._context_fields = tuple(fields)
+        cls._context_field_set = frozenset(fields)
+
+    @classmethod
+    def declare_state_variables(cls, names: List[str]):
+        """追加状态变量声明（例如来自 load_state_variable_schema 的结果）"""
+        cls.STATE_VARIABLES = tuple(cls.__dict__.get('STATE_VARIABLES', ())) + tuple(
+            name for name in names if name not in cls._context_field_set)
+        cls._rebuild_context_fields()
+
+    ROLE = None
+
+    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
+        self.env = env
+        self.id = entity_id
+        self.simulation = simulation
+        self.parent_id = None  # 上级实体（由场景模板按就近原则分配）
+        self.state_index = simulation.entity_state.allocate(self)
+        self.current_action = None
+        self.current_activity = None
+        self.current_activity_name = None  # 新增：存储activity名称
+        self.current_activity_chinese_name = None  # 新增：存储activity中文名称
+        self.message_queue = simpy.Store(env)
+        
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # 上下文字段（含状态变量）写入时更新状态统计并通知条件断点
+        if name in self._context_field_set:
+            simulation = self.__dict__.get('simulation')
+            if simulation is None:
+                return
+            if name in simulation.state_monitor.fields:
+                simulation.state_monitor.record(self, name, value)
+            if simulation.breakpoints.watching:
+                simulation.breakpoints.notify_state_change()
+
+    @property
+    def position(self) -> Dict:
+        """位置（兼容原字典形式，返回的是快照，修改需整体赋值）"""
+        store = self.simulation.entity_state
+        return store.get_vector(store.positions, self.state_index)
+
+    @position.setter
+    def position(self, value: Dict):
+        """整体赋值位置时写入状态存储并同步更新空间索引"""
+        store = self.simulation.entity_state
+        store.set_vector(store.positions, self.state_index, value)
+        unit_index = self.simulation.unit_index
+        unit_index.update(self.id, value['x'], value['y'], self)
+        store.grid_cells[self.state_index] = unit_index.items[self.id][2]
+
+    @property
+    def velocity(self) -> Dict:
+        store = self.simulation.entity_state
+        return store.get_vector(store.velocities, self.state_index)
+
+    @velocity.setter
+    def velocity(self, value: Dict):
+        store = self.simulation.entity_state
+        store.set_vector(store.velocities, self.state_index, value)
+
+    def update_status(self, action: str = None, activity: str = None):
+        """更新当前状态"""
+        old_action = self.current_action
+        old_activity = self.current_activity
+        
+        if action:
+            self.current_action = action
+        if activity:
+            self.current_activity = activity
+        
+        # 收集状态更新消息（增加activity名称信息）
+        if action != old_action or activity != old_activity:
+            message_collector.add_message(SimulationMessage(
+                type=MessageType.ENTITY_UPDATE,
+                entity_id=self.id,
+                data={
+                    'entity_name': self.name,
+                    'current_action': self.current_action,
+                    'current_activity': self.current_activity,
+                    'current_activity_name': self.current_activity_name,  # 新增
+                    'current_activity_chinese_name': self.current_activity_chinese_name,  # 新增
+                    'position': getattr(self, 'position', None)
+                }
+            ))
     
-    yield env.process(check_pause(env, entity))
+    def get_context(self) -> 'EntityContext':
+        """获取当前上下文（按类声明的字段懒读取）"""
+        return EntityContext(self)
     
-    threat_level = context.get('threat_level', 0.5)
-    fire_decision = threat_level > 0.6
+    def start_process(self, generator) -> simpy.Process:
+        """启动属于本实体的进程（其子进程沿用该归属，按实体单步时据此筛选事件）"""
+        process = self.env.process(generator)
+        process.owner = self
+        return process
+
+# 实体类定义（继承改进的基类）
+
+class CommandPost(BaseEntity):
+    """指挥所实体"""
+    ROLE = 'command_post'
+    STATE_VARIABLES = ('alert_level',)
+
+    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
+        super().__init__(env, entity_id, simulation)
+        self.name = '指挥所'
+        self.type = 'passive'
+        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
+        self.attributes = {
+            'unit_type': 'command',
+            'call_sign': 'Eagle'
+        }
+        self.alert_level = 1
+        self.tasked_battalions = set()  # 已下达射击命令的炮兵营
+        self.actions = []
+
+    def start(self):
+        """启动实体进程"""
+        log_and_collect('INFO', '%s (%s) 开始运行', self.name, self.attributes["call_sign"], entity=self.name)
+        self.start_process(self.message_handler())
+
+    def message_handler(self):
+        """处理消息"""
+        while True:
+            try:
+                msg = yield self.message_queue.get()
+                log_and_collect('INFO', '%s 收到消息: %s', self.name, msg.get("type", "unknown"),
+                               entity=self.name)
+                
+                if msg.get('type') == 'enemy_report':
+                    self.start_process(self.run_action('act_process_intel', msg))
+                    
+            except simpy.Interrupt:
+                break
+
+    def run_action(self, action_id: str, context_data: Dict = None):
+        """执行动作"""
+        self.update_status(action=action_id)
+        if action_id in actions:
+            context = self.get_context()
+            if context_data:
+                context.update(context_data)
+            yield from run_step(self.env, actions[action_id].execute(self, context))
+
+class ArtilleryBattalion(BaseEntity):
+    """炮兵营实体"""
+    ROLE = 'artillery_battalion'
+    STATE_VARIABLES = ('fire_status', 'rounds_fired')
+    fire_status = StatusField()
+
+    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
+        super().__init__(env, entity_id, simulation)
+        self.name = '炮兵营'
+        self.type = 'agent'
+        self.position = {'x': -500.0, 'y': -200.0, 'z': 0.0}
+        self.attributes = {
+            'unit_type': 'artillery',
+            'call_sign': 'Thunder',
+            'guns_count': '18'
+        }
+        self.fire_status = 'ready'
+        self.rounds_fired = 0
+        self.actions = []
+
+    def start(self):
+        """启动实体进程"""
+        log_and_collect('INFO', 
+                       '%s (%s) 准备就绪，火炮数量: %s',
+                       self.name, self.attributes["call_sign"], self.attributes["guns_count"],
+                       entity=self.name)
+        self.start_process(self.message_handler())
+
+    def message_handler(self):
+        """处理消息"""
+        while True:
+            try:
+                msg = yield self.message_queue.get()
+                log_and_collect('INFO', '%s 收到命令: %s', self.name, msg.get("type", "unknown"),
+                               entity=self.name)
+                
+                if msg.get('type') == 'fire_order':
+                    self.start_process(self.run_action('act_execute_fire_mission', msg))
+                elif msg.get('type') == 'cease_fire':
+                    self.start_process(self.run_action('act_cease_fire', msg))
+                    
+            except simpy.Interrupt:
+                break
+
+    def run_action(self, action_id: str, context_data: Dict = None):
+        """执行动作"""
+        self.update_status(action=action_id)
+        if action_id in actions:
+            context = self.get_context()
+            if context_data:
+                context.update(context_data)
+            yield from run_step(self.env, actions[action_id].execute(self, context))
+
+class ReconSquad(BaseEntity):
+    """步兵侦察班实体"""
+    ROLE = 'recon_squad'
+    CONTEXT_FIELDS = BaseEntity.CONTEXT_FIELDS + ('sensor_range', 'max_speed')
+    STATE_VARIABLES = ('patrol_status', 'enemy_contact')
+    patrol_status = StatusField()
+
+    def __init__(self, env: simpy.Environment, entity_id: str, simulation):
+        super().__init__(env, entity_id, simulation)
+        self.name = '步兵侦察班'
+        self.type = 'agent'
+        self.position = {'x': 100.0, 'y': 100.0, 'z': 0.0}
+        self.attributes = {
+            'unit_type': 'recon',
+            'call_sign': 'Scout',
+            'squad_size': '8'
+        }
+        self.patrol_status = 'patrolling'
+        self.enemy_contact = False
+        self.sensor_range = DEFAULT_SENSOR_RANGE
+        self.max_speed = 5.0  # 米/秒
+        self.patrol_center = None
+        self.contact = None  # 最近一次发现的目标情报
+        self.actions = []
+
+    def start(self):
+        """启动实体进程"""
+        log_and_collect('INFO', 
+                       '%s (%s) 开始执行侦察任务，人员: %s人',
+                       self.name, self.attributes["call_sign"], self.attributes["squad_size"],
+                       entity=self.name)
+        self.start_process(self.run_action('act_patrol'))
+        self.simulation.timer_wheel.register(self.monitor_conditions, period=1, owner=self)
+        self.start_process(self.message_handler())
+
+    def monitor_conditions(self, now: float):
+        """监控触发条件（定时轮每秒回调）"""
+        if self.enemy_contact and self.current_action != 'act_report_enemy':
+            self.start_process(self.run_action('act_report_enemy'))
+        
+        if self.simulation.global_vars.get('StrikeCompleted', False) and self.current_action != 'act_assess_damage':
+            self.start_process(self.run_action('act_assess_damage'))
+
+    def run_action(self, action_id: str):
+        """执行动作"""
+        self.update_status(action=action_id)
+        if action_id in actions:
+            yield from run_step(self.env, actions[action_id].execute(self, self.get_context()))
+
+    def message_handler(self):
+        """处理消息"""
+        while True:
+            try:
+                msg = yield self.message_queue.get()
+                log_and_collect('INFO', '%s 收到消息: %s', self.name, msg, entity=self.name)
+            except simpy.Interrupt:
+                break
+
+# 场景模板（按模板批量实例化实体）
+ENTITY_CLASSES = {cls.ROLE: cls for cls in (CommandPost, ArtilleryBattalion, ReconSquad)}
+_declared_schema_paths = set()
+
+def declare_entity_schema(xml_path: str = ENTITY_SCHEMA_FILE):
+    """把模型XML中各实体的 Attribute/StateVariable 并入对应场景实体类的上下文字段（每个文件只读取一次）"""
+    if not xml_path or xml_path in _declared_schema_paths or not os.path.exists(xml_path):
+        return
+    try:
+        schema = load_state_variable_schema(xml_path)
+    except (ET.ParseError, ValueError) as e:
+        logging.error(f'读取实体属性模式失败 {xml_path}: {e}')
+        return
+    _declared_schema_paths.add(xml_path)
+    for entity_id, fields in schema.items():
+        role = entity_id[4:] if entity_id and entity_id.startswith('ent_') else entity_id
+        if role in ENTITY_CLASSES:
+            ENTITY_CLASSES[role].declare_state_variables(fields)
+
+@dataclass
+class EntityTemplate:
+    """实体模板：角色、数量、编号规则和布设规则
+
+    布设规则 placement:
+      {'type': 'fixed', 'positions': [{'x':..,'y':..}, ...]}
+      {'type': 'line', 'origin': {...}, 'spacing': {'x':..,'y':..}}
+      {'type': 'grid', 'origin': {...}, 'spacing': 200.0, 'columns': 8}
+      {'type': 'random', 'center': {...}, 'radius': 500.0}
+    """
+    role: str
+    count: int = 1
+    ids: Optional[List[str]] = None  # 显式指定编号，否则按 id_prefix 生成
+    id_prefix: Optional[str] = None
+    placement: Optional[Dict] = None
+
+    def generate_ids(self) -> List[str]:
+        if self.ids:
+            return list(self.ids[:self.count])
+        prefix = self.id_prefix or f'ent_{self.role}'
+        return [f'{prefix}_{i + 1:03d}' for i in range(self.count)]
+
+    def generate_positions(self, rng: random.Random) -> List[Optional[Dict]]:
+        rule = self.placement or {}
+        kind = rule.get('type')
+        origin = rule.get('origin', {'x': 0.0, 'y': 0.0})
+        positions = []
+        for i in range(self.count):
+            if kind == 'fixed':
+                fixed = rule['positions']
+                position = dict(fixed[i % len(fixed)])
+            elif kind == 'line':
+                spacing = rule.get('spacing', {'x': 0.0, 'y': 500.0})
+                position = {'x': origin['x'] + i * spacing.get('x', 0.0), 'y': origin['y'] + i * spacing.get('y', 0.0)}
+            elif kind == 'grid':
+                spacing = rule.get('spacing', 200.0)
+                columns = rule.get('columns', max(1, int(math.ceil(math.sqrt(self.count)))))
+                position = {'x': origin['x'] + (i % columns) * spacing, 'y': origin['y'] + (i // columns) * spacing}
+            elif kind == 'random':
+                center = rule.get('center', origin)
+                radius = rule.get('radius', 500.0) * math.sqrt(rng.random())
+                angle = rng.random() * 2 * math.pi
+                position = {'x': center['x'] + radius * math.cos(angle), 'y': center['y'] + radius * math.sin(angle)}
+            else:
+                positions.append(None)  # 使用实体类的默认位置
+                continue
+            position.setdefault('z', 0.0)
+            positions.append({k: float(v) for k, v in position.items()})
+        return positions
+
+class ScenarioSpec:
+    """场景规格：一组实体模板"""
+    DEFAULT_TARGET = {'id': 'tgt_enemy_company', 'position': {'x': 800.0, 'y': 600.0},
+                      'strength': 'company', 'type': 'mechanized'}
+
+    def __init__(self, templates: List[EntityTemplate], seed: int = RANDOM_SEED, targets: List[Dict] = None):
+        self.templates = templates
+        self.seed = seed
+        self.targets = targets if targets is not None else [self.DEFAULT_TARGET]
+
+    @classmethod
+    def default(cls) -> 'ScenarioSpec':
+        """原有的三实体场景（保持原编号与位置）"""
+        return cls([
+            EntityTemplate('command_post', ids=['ent_command_post']),
+            EntityTemplate('artillery_battalion', ids=['ent_artillery_battalion']),
+            EntityTemplate('recon_squad', ids=['ent_recon_squad']),
+        ])
+
+    @classmethod
+    def from_counts(cls, command_post: int = 1, artillery_battalion: int = 1, recon_squad: int = 1,
+                    hostile_target: int = 1) -> 'ScenarioSpec':
+        """按数量生成：指挥所沿后方纵线展开，炮兵营在其前方，侦察班在前沿网格布设，敌方目标散布在前方区域"""
+        rng = random.Random(RANDOM_SEED)
+        targets = [dict(cls.DEFAULT_TARGET, id=f'tgt_enemy_{i + 1:03d}',
+                        position={'x': 800.0 + rng.uniform(0, 1500.0), 'y': 600.0 + rng.uniform(-500.0, 1500.0)})
+                   for i in range(hostile_target)] if hostile_target != 1 else None
+        return cls(targets=targets, templates=[
+            EntityTemplate('command_post', command_post,
+                           placement={'type': 'line', 'origin': {'x': 0.0, 'y': 0.0}, 'spacing': {'x': 0.0, 'y': 2000.0}}),
+            EntityTemplate('artillery_battalion', artillery_battalion,
+                           placement={'type': 'line', 'origin': {'x': -500.0, 'y': -200.0}, 'spacing': {'x': 0.0, 'y': 800.0}}),
+            EntityTemplate('recon_squad', recon_squad,
+                           placement={'type': 'grid', 'origin': {'x': 100.0, 'y': 100.0}, 'spacing': 250.0}),
+        ])
+
+    @classmethod
+    def from_string(cls, spec: str) -> 'ScenarioSpec':
+        """解析 "recon_squad=48,artillery_battalion=6,command_post=2" 形式的配置"""
+        counts = {}
+        for item in spec.split(','):
+            if item.strip():
+                role, _, count = item.partition('=')
+                if role.strip() not in ENTITY_CLASSES and role.strip() != HostileTarget.ROLE:
+                    raise ValueError(f'未知的实体角色: {role.strip()}')
+                counts[role.strip()] = int(count)
+        return cls.from_counts(**counts)
+
+    def instantiate(self, simulation) -> Dict[str, 'BaseEntity']:
+        """按模板创建实体，单个实例保留类的默认名称，多个实例在名称后加序号"""
+        rng = random.Random(self.seed)
+        entities = {}
+        for template in self.templates:
+            entity_class = ENTITY_CLASSES[template.role]
+            ids = template.generate_ids()
+            for index, (entity_id, position) in enumerate(zip(ids, template.generate_positions(rng))):
+                entity = entity_class(simulation.env, entity_id, simulation)
+                if len(ids) > 1:
+                    entity.name = f'{entity.name}-{index + 1}'
+                if position is not None:
+                    entity.position = position
+                entities[entity_id] = entity
+        return entities
+
+    def create_targets(self) -> List[HostileTarget]:
+        return [HostileTarget(t['id'], dict(t['position']), t.get('strength', 'company'), t.get('type', 'mechanized'))
+                for t in self.targets]
+
+class EntityIndex:
+    """实体索引：按角色寻址（最近的炮兵营、上级指挥所），替代按固定编号查找
+
+    上下级关系在实例化后由 rebuild 一次性预计算，发送消息时的寻址只做字典查找。
+    """
+    def __init__(self):
+        self.by_role: Dict[str, List[Any]] = {}
+        self.entities = {}
+        self.spatial = None
+        self.parents: Dict[str, Any] = {}  # 实体编号 → 上级实体
+        self.subordinates: Dict[str, Dict[Optional[str], List[Any]]] = {}  # 上级编号 → 角色（None为全部）→ 下级
+
+    def rebuild(self, entities: Dict[str, Any], spatial: 'SpatialGrid' = None):
+        self.spatial = spatial
+        self.by_role = {}
+        for entity in entities.values():
+            self.by_role.setdefault(entity.ROLE, []).append(entity)
+        self.entities = entities
+        # 下级实体归属最近的指挥所
+        for entity in entities.values():
+            if entity.ROLE != CommandPost.ROLE and entity.parent_id is None:
+                parent = self.nearest(CommandPost.ROLE, entity.position)
+                entity.parent_id = parent.id if parent else None
+        self.parents = {}
+        self.subordinates = {}
+        for entity in entities.values():
+            parent = entities.get(entity.parent_id) if entity.parent_id else None
+            if parent is None:
+                continue
+            self.parents[entity.id] = parent
+            by_role = self.subordinates.setdefault(parent.id, {})
+            by_role.setdefault(None, []).append(entity)
+            by_role.setdefault(entity.ROLE, []).append(entity)
+
+    def role(self, role: str) -> List[Any]:
+        return self.by_role.get(role, [])
+
+    def first(self, role: str) -> Optional[Any]:
+        members = self.by_role.get(role)
+        return members[0] if members else None
+
+    def nearest(self, role: str, position: Optional[Dict], candidates: List[Any] = None) -> Optional[Any]:
+        members = candidates if candidates is not None else self.by_role.get(role, [])
+        if not members:
+            return None
+        if not position:
+            return members[0]
+        px, py = position.get('x', 0.0), position.get('y', 0.0)
+        if candidates is None and self.spatial is not None:
+            hits = self.spatial.nearest(px, py, 1, lambda e: e.ROLE == role)
+            return hits[0][2] if hits else None
+        return min(members, key=lambda e: (e.position['x'] - px) ** 2 + (e.position['y'] - py) ** 2)
+
+    def parent(self, entity: Any) -> Optional[Any]:
+        return self.parents.get(entity.id)
+
+    def children(self, entity: Any, role: str = None) -> List[Any]:
+        return self.subordinates.get(entity.id, {}).get(role, [])
+
+    def parent_command_post(self, entity: Any) -> Optional[Any]:
+        return self.parent(entity) or self.nearest(CommandPost.ROLE, getattr(entity, 'position', None))
+
+    def nearest_battalion(self, command_post: Any, target: Optional[Dict]) -> Optional[Any]:
+        """距目标最近的下属炮兵营（无下属时在全部炮兵营中选择）"""
+        subordinates = self.children(command_post, ArtilleryBattalion.ROLE)
+        return self.nearest(ArtilleryBattalion.ROLE, target, subordinates or None)
+
+# 活动函数定义（全部使用装饰器）
+
+@enhanced_activity_wrapper
+def activity_move_patrol(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：巡逻移动"""
+    yield from pause_point(env, entity)
+    
+    # 由运动学子系统沿环形路线连续移动（以首次巡逻时的位置为圆心）
+    kinematics = entity.simulation.kinematics
+    if not kinematics.is_moving(entity):
+        if entity.patrol_center is None:
+            entity.patrol_center = entity.position
+        kinematics.start_patrol(entity, entity.patrol_center)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 30})
+    yield env.timeout(delay_time)
+    
+    new_position = entity.position
+    log_and_collect('INFO', 
+                   '%s 移动到新位置: (%.1f, %.1f)', entity.name, new_position["x"], new_position["y"],
+                   entity=entity.name)
+
+@enhanced_activity_wrapper
+def activity_scan_area(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：扫描区域"""
+    yield from pause_point(env, entity)
+    
+    # 传感器覆盖范围内的目标由近及远逐个判定，发现概率随距离衰减
+    position = entity.position
+    sensor_range = entity.sensor_range
+    detected = None
+    candidates = entity.simulation.hostile_index.query_range(position['x'], position['y'], sensor_range)
+    line_of_sight = entity.simulation.los.visible(entity, [target for _, _, target in candidates])
+    for (distance, _, target), visible in zip(candidates, line_of_sight):
+        if not visible:
+            continue
+        if random.random() < DETECTION_BASE_PROBABILITY * (1 - (distance / sensor_range) ** 2):
+            detected = target
+            entity.contact = dict(target.to_intel(), distance=distance, detect_time=env.now)
+            break
+    enemy_detected = detected is not None
+    
+    entity.enemy_contact = enemy_detected
+    
+    if enemy_detected:
+        log_and_collect('WARNING', '%s 发现敌情！目标 %s，距离 %.0f米', entity.name, detected.id,
+                       entity.contact['distance'], entity=entity.name,
+                       msg_type=MessageType.ALERT)
+        entity.simulation.global_vars['EnemyDetected'] = True
+    else:
+        logging.info('%s 区域安全，未发现敌情', entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 10})
+    yield env.timeout(delay_time)
+    
+    return {'enemy_detected': enemy_detected}
+
+@enhanced_activity_wrapper
+def activity_gather_intel(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：收集情报"""
+    log_and_collect('INFO', '%s 开始收集敌情详细信息', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    # 使用扫描时发现的目标情报
+    contact = getattr(entity, 'contact', None)
+    if contact:
+        enemy_info = {k: contact[k] for k in ('target_id', 'position', 'strength', 'type')}
+    else:
+        enemy_info = {
+            'position': {'x': 800, 'y': 600},
+            'strength': 'company',
+            'type': 'mechanized'
+        }
+    
+    context['enemy_info'] = enemy_info
+    
+    log_and_collect('INFO', '%s 收集到敌情: 位置(%s, %s), 规模: %s, 类型: %s',
+                   entity.name, enemy_info["position"]["x"], enemy_info["position"]["y"],
+                   enemy_info["strength"], enemy_info["type"],
+                   entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('uniform', {'min': 20, 'max': 40})
+    yield env.timeout(delay_time)
+    
+    return enemy_info
+
+@enhanced_activity_wrapper
+def activity_send_enemy_report(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：发送敌情报告"""
+    log_and_collect('INFO', '%s 发送敌情报告到指挥所', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    command_post = entity.simulation.entity_index.parent_command_post(entity)
+    if command_post is not None:
+        enemy_info = context.get('enemy_info', {})
+        
+        message = {
+            'type': 'enemy_report',
+            'source': entity.id,
+            'enemy_position': str(enemy_info.get('position', 'unknown')),
+            'enemy_strength': enemy_info.get('strength', 'unknown'),
+            'report_time': env.now,
+            'enemy_info': enemy_info
+        }
+        
+        entity.simulation.message_bus.send(entity, command_post, message)
+        log_and_collect('INFO', '%s 敌情报告已发送', entity.name, entity=entity.name)
+    
+    entity.simulation.global_vars['EnemyDetected'] = True
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 5})
+    yield env.timeout(delay_time)
+
+@enhanced_activity_wrapper
+def activity_analyze_report(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：分析报告"""
+    log_and_collect('INFO', '%s 开始分析敌情报告', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    evaluator = ExpressionEvaluator(context)
+    enemy_info = context.get('enemy_info', {})
+    threat_level = evaluator.evaluate('analyze_enemy_info(enemy_info)')
+    
+    context['threat_level'] = threat_level
+    
+    threat_desc = '高' if threat_level > 0.7 else ('中' if threat_level > 0.4 else '低')
+    log_and_collect('INFO', '%s 威胁评估完成: 威胁等级 - %s (%.2f)', entity.name, threat_desc, threat_level,
+                   entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 30})
+    yield env.timeout(delay_time)
+    
+    return {'threat_level': threat_level, 'threat_desc': threat_desc}
+
+@enhanced_activity_wrapper
+def activity_make_decision(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：做出决策"""
+    log_and_collect('INFO', '%s 开始决策是否开火', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    threat_level = context.get('threat_level', 0.5)
+    fire_decision = threat_level > 0.6
     
     context['fire_decision'] = fire_decision
     
     if fire_decision:
-        log_and_collect('WARNING', f'{entity.name} 决定实施火力打击！', entity=entity.name,
+        log_and_collect('WARNING', '%s 决定实施火力打击！', entity.name, entity=entity.name,
                        msg_type=MessageType.ALERT)
-        entity.env.process(entity.run_action('act_issue_fire_order', context))
+        entity.start_process(entity.run_action('act_issue_fire_order', context))
     else:
-        log_and_collect('INFO', f'{entity.name} 决定继续观察，暂不开火', entity=entity.name)
+        log_and_collect('INFO', '%s 决定继续观察，暂不开火', entity.name, entity=entity.name)
     
     delay_time = TimeDistribution.generate('constant', {'value': 20})
     yield env.timeout(delay_time)
@@ -1016,9 +4060,9 @@ def activity_make_decision(env: simpy.Environment, entity: Any, context: Dict) -
 @enhanced_activity_wrapper
 def activity_prepare_fire_order(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
     """活动：准备火力命令"""
-    log_and_collect('INFO', f'{entity.name} 准备火力打击命令', entity=entity.name)
+    log_and_collect('INFO', '%s 准备火力打击命令', entity.name, entity=entity.name)
     
-    yield env.process(check_pause(env, entity))
+    yield from pause_point(env, entity)
     
     enemy_info = context.get('enemy_info', {})
     fire_order = {
@@ -1029,8 +4073,8 @@ def activity_prepare_fire_order(env: simpy.Environment, entity: Any, context: Di
     
     context['fire_order'] = fire_order
     
-    log_and_collect('INFO', f'{entity.name} 火力命令准备完成: 目标位置({fire_order["target"]["x"]}, {fire_order["target"]["y"]}), '
-                          f'弹药数量: {fire_order["rounds"]}发', 
+    log_and_collect('INFO', '%s 火力命令准备完成: 目标位置(%s, %s), 弹药数量: %s发',
+                   entity.name, fire_order["target"]["x"], fire_order["target"]["y"], fire_order["rounds"],
                    entity=entity.name)
     
     delay_time = TimeDistribution.generate('constant', {'value': 15})
@@ -1038,391 +4082,2440 @@ def activity_prepare_fire_order(env: simpy.Environment, entity: Any, context: Di
     
     return fire_order
 
-@enhanced_activity_wrapper
-def activity_transmit_order(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：传送命令"""
-    log_and_collect('INFO', f'{entity.name} 传送火力命令到炮兵营', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    if 'ent_artillery_battalion' in entity.simulation.entities:
-        artillery = entity.simulation.entities['ent_artillery_battalion']
-        fire_order = context.get('fire_order', {})
+@enhanced_activity_wrapper
+def activity_transmit_order(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：传送命令"""
+    log_and_collect('INFO', '%s 传送火力命令到炮兵营', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    fire_order = context.get('fire_order', {})
+    artillery = entity.simulation.entity_index.nearest_battalion(entity, fire_order.get('target'))
+    if artillery is not None:
+        entity.tasked_battalions.add(artillery.id)
+        
+        message = {
+            'type': 'fire_order',
+            'source': entity.id,
+            'target_position': str(fire_order.get('target', 'unknown')),
+            'fire_type': fire_order.get('type', 'suppression'),
+            'rounds_count': fire_order.get('rounds', 36),
+            'fire_order': fire_order
+        }
+        
+        entity.simulation.message_bus.send(entity, artillery, message)
+        log_and_collect('INFO', '%s 火力命令已发送', entity.name, entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 5})
+    yield env.timeout(delay_time)
+
+@enhanced_activity_wrapper
+def activity_prepare_guns(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：准备火炮"""
+    log_and_collect('INFO', '%s 开始准备火炮', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    entity.fire_status = 'preparing'
+    
+    log_and_collect('INFO', '%s 火炮装填中，%s门火炮准备就绪', entity.name, entity.attributes["guns_count"],
+                   entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 60})
+    
+    for i in range(6):
+        yield env.timeout(delay_time / 6)
+        progress = (i + 1) * 100 / 6
+        if i % 2 == 0:
+            log_and_collect('INFO', '%s 准备进度: %.0f%%', entity.name, progress, entity=entity.name)
+
+@enhanced_activity_wrapper
+def activity_fire_barrage(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：火力齐射"""
+    log_and_collect('WARNING', '%s 开始火力齐射！', entity.name, entity=entity.name,
+                   msg_type=MessageType.ALERT)
+    
+    yield from pause_point(env, entity)
+    
+    entity.fire_status = 'firing'
+    fire_order = context.get('fire_order', {})
+    rounds_fired = int(fire_order.get('rounds', 36))
+    entity.rounds_fired += rounds_fired
+    
+    if 'res_artillery_rounds' in resources:
+        ammo = resources['res_artillery_rounds']
+        if ammo.level >= rounds_fired:
+            yield ammo.get(rounds_fired)
+            logging.info('%s 消耗弹药 %s 发，剩余: %s', entity.name, rounds_fired, ammo.level)
+            
+            message_collector.add_message(SimulationMessage(
+                type=MessageType.RESOURCE_UPDATE,
+                data={
+                    'resource_id': 'res_artillery_rounds',
+                    'level': ammo.level,
+                    'capacity': ammo.capacity,
+                    'utilization': ((ammo.capacity - ammo.level) / ammo.capacity) * 100
+                }
+            ))
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 120})
+    
+    # 分4个波次射击，每个波次的全部弹着点由毁伤模型一次结算
+    fire_effects = entity.simulation.fire_effects
+    aim = fire_order.get('target', {'x': 800, 'y': 600})
+    guns = int(entity.attributes.get('guns_count', 1))
+    targets = fire_effects.targets_near(entity.simulation.hostile_index, aim)
+    sheaf = (targets[0].footprint[2], targets[0].footprint[1]) if targets else (0.0, 0.0)  # 射向束覆盖最近目标的展开正面
+    effects = {}
+    volleys = 4
+    for i in range(volleys):
+        yield env.timeout(delay_time / volleys)
+        volley_rounds = rounds_fired // volleys + (1 if i < rounds_fired % volleys else 0)
+        if volley_rounds and targets:
+            salvo = fire_effects.fire_salvo(entity.position, aim, volley_rounds, guns, targets, sheaf)
+            for result in salvo['targets']:
+                total = effects.setdefault(result['target_id'], {'impacts_in_footprint': 0, 'kills': 0})
+                total['impacts_in_footprint'] += result['impacts_in_footprint']
+                total['kills'] += result['kills']
+                total['damage'] = result['damage']
+        if i == volleys - 1:
+            logging.info('%s 齐射完成', entity.name)
+    
+    entity.simulation.global_vars['StrikeCompleted'] = True
+    
+    log_and_collect('INFO', '%s 火力齐射完成，共发射 %s 发炮弹', entity.name, rounds_fired, entity=entity.name)
+    for target_id, total in effects.items():
+        if total['impacts_in_footprint'] or total['kills']:
+            log_and_collect('INFO', '%s 对目标 %s: 落入目标区 %s 发，毁伤要素 %s 个，累计毁伤 %.2f',
+                           entity.name, target_id, total['impacts_in_footprint'], total['kills'],
+                           total['damage'], entity=entity.name)
+    
+    return {'rounds_fired': rounds_fired, 'result': '齐射完成', 'effects': effects}
+
+@enhanced_activity_wrapper
+def activity_observe_impact(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：观察打击效果"""
+    log_and_collect('INFO', '%s 开始观察火力打击效果', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    # 观察评估以目标实际毁伤为基础，叠加观察误差
+    contact = getattr(entity, 'contact', None)
+    target = entity.simulation.targets.get(contact.get('target_id')) if contact else None
+    true_damage = target.damage if target is not None else 0.0
+    damage_level = min(1.0, max(0.0, true_damage + random.gauss(0, 0.05)))
+    
+    # 与目标不通视时只能依据间接迹象评估，无法确认严重毁伤
+    if target is not None and not entity.simulation.los.can_see(entity, target):
+        damage_level = min(damage_level, 0.7)
+        log_and_collect('WARNING', '%s 与目标 %s 不通视，毁伤评估置信度低', entity.name, target.id, entity=entity.name)
+    context['damage_level'] = damage_level
+    
+    damage_desc = '严重' if damage_level > 0.85 else ('中等' if damage_level > 0.7 else '轻微')
+    log_and_collect('INFO', '%s 初步评估: 目标受损程度 - %s (%.2f)', entity.name, damage_desc, damage_level,
+                   entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 60})
+    yield env.timeout(delay_time)
+    
+    return {'damage_level': damage_level, 'damage_desc': damage_desc}
+
+@enhanced_activity_wrapper
+def activity_report_bda(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：报告毁伤评估"""
+    log_and_collect('INFO', '%s 发送毁伤评估报告', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    damage_level = context.get('damage_level', 0.0)
+    entity.simulation.global_vars['DamageAssessment'] = damage_level
+    
+    message_collector.add_message(SimulationMessage(
+        type=MessageType.GLOBAL_VAR_UPDATE,
+        data={'DamageAssessment': damage_level}
+    ))
+    
+    command_post = entity.simulation.entity_index.parent_command_post(entity)
+    if command_post is not None:
+        message = {
+            'type': 'bda_report',
+            'source': entity.id,
+            'damage_assessment': damage_level,
+            'target_status': '摧毁' if damage_level > 0.8 else '重创'
+        }
+        
+        entity.simulation.message_bus.send(entity, command_post, message)
+    
+    log_and_collect('INFO', '%s 毁伤评估报告已发送: 毁伤程度 %.2f%%', entity.name, damage_level * 100, entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 10})
+    yield env.timeout(delay_time)
+
+@enhanced_activity_wrapper
+def activity_evaluate_results(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：评估结果"""
+    log_and_collect('INFO', '%s 评估任务执行结果', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    damage_assessment = entity.simulation.global_vars.get('DamageAssessment', 0.0)
+    mission_success = damage_assessment >= 0.8
+    
+    context['mission_success'] = mission_success
+    
+    if mission_success:
+        log_and_collect('INFO', '%s 任务成功！目标已被有效打击', entity.name, entity=entity.name)
+    else:
+        log_and_collect('WARNING', '%s 任务未完全达成，可能需要补充打击', entity.name, entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 20})
+    yield env.timeout(delay_time)
+    
+    return {'mission_success': mission_success}
+
+@enhanced_activity_wrapper
+def activity_send_cease_fire(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：发送停火命令"""
+    log_and_collect('INFO', '%s 发送停火命令', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    # 向本指挥所下达过射击命令的炮兵营发送停火
+    for artillery_id in sorted(entity.tasked_battalions):
+        artillery = entity.simulation.entities[artillery_id]
+        
+        message = {
+            'type': 'cease_fire',
+            'source': entity.id
+        }
+        
+        entity.simulation.message_bus.send(entity, artillery, message)
+        log_and_collect('INFO', '%s 停火命令已发送', entity.name, entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 5})
+    yield env.timeout(delay_time)
+
+@enhanced_activity_wrapper
+def activity_stop_firing(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：停止射击"""
+    log_and_collect('INFO', '%s 执行停火命令', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    entity.fire_status = 'ceased'
+    
+    log_and_collect('INFO', '%s 已停止射击，共发射 %s 发炮弹', entity.name, entity.rounds_fired, entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 10})
+    yield env.timeout(delay_time)
+
+@enhanced_activity_wrapper
+def activity_report_status(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+    """活动：报告状态"""
+    log_and_collect('INFO', '%s 报告当前状态', entity.name, entity=entity.name)
+    
+    yield from pause_point(env, entity)
+    
+    entity.fire_status = 'ready'
+    
+    remaining_ammo = 0
+    if 'res_artillery_rounds' in resources:
+        remaining_ammo = resources['res_artillery_rounds'].level
+    
+    log_and_collect('INFO', '%s 状态: 就绪，剩余弹药: %s 发', entity.name, remaining_ammo, entity=entity.name)
+    
+    delay_time = TimeDistribution.generate('constant', {'value': 5})
+    yield env.timeout(delay_time)
+    
+    return {'status': 'ready', 'remaining_ammo': remaining_ammo}
+
+# 动作类定义
+class ActionBase:
+    """动作基类"""
+    def __init__(self, env: simpy.Environment, action_id: str, name: str, chinese_name: str):
+        self.env = env
+        self.id = action_id
+        self.name = name
+        self.chinese_name = chinese_name
+        self.interrupted = False
+
+    def execute(self, entity: Any, context: Dict):
+        """执行动作"""
+        tracer = trace_exporter
+        process = self.env.active_process
+        if tracer is not None:
+            outer_sampled = tracer.begin_action(process)
+        sim_start, wall_start = self.env.now, time.perf_counter()
+        entity.update_status(action=self.id)
+        
+        # 收集动作开始消息
+        message_collector.add_message(SimulationMessage(
+            type=MessageType.ACTION_STARTED,
+            entity_id=entity.id,
+            data={
+                'entity_name': entity.name,
+                'action': self.id,
+                'action_name': self.chinese_name
+            }
+        ))
+        
+        try:
+            yield from run_step(self.env, self.do_execute(entity, context))
+            
+            # 收集动作完成消息
+            message_collector.add_message(SimulationMessage(
+                type=MessageType.ACTION_COMPLETED,
+                entity_id=entity.id,
+                data={
+                    'entity_name': entity.name,
+                    'action': self.id,
+                    'action_name': self.chinese_name
+                }
+            ))
+        except simpy.Interrupt:
+            self.interrupted = True
+            logging.info(f'动作 {self.chinese_name} 被中断')
+        finally:
+            if tracer is not None:
+                tracer.end_action(entity, self, process, outer_sampled, sim_start, wall_start)
+
+    def do_execute(self, entity: Any, context: Dict):
+        """具体执行逻辑 - 子类实现"""
+        yield self.env.timeout(0)
+
+class ActionPatrol(ActionBase):
+    """动作：巡逻"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'Patrol', '巡逻')
+
+    def do_execute(self, entity: Any, context: Dict):
+        """循环执行巡逻"""
+        while entity.patrol_status == 'patrolling' and not entity.enemy_contact:
+            yield from run_step(self.env, activity_move_patrol(self.env, entity, context))
+            yield from run_step(self.env, activity_scan_area(self.env, entity, context))
+            yield from pause_point(self.env, entity)
+        entity.simulation.kinematics.stop(entity)
+
+class ActionReportEnemy(ActionBase):
+    """动作：报告敌情"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'ReportEnemy', '报告敌情')
+
+    def do_execute(self, entity: Any, context: Dict):
+        yield from run_step(self.env, activity_gather_intel(self.env, entity, context))
+        yield from run_step(self.env, activity_send_enemy_report(self.env, entity, context))
+
+class ActionAssessDamage(ActionBase):
+    """动作：评估毁伤"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'AssessDamage', '评估毁伤')
+
+    def do_execute(self, entity: Any, context: Dict):
+        yield from run_step(self.env, activity_observe_impact(self.env, entity, context))
+        yield from run_step(self.env, activity_report_bda(self.env, entity, context))
+
+class ActionProcessIntel(ActionBase):
+    """动作：处理情报"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'ProcessIntel', '处理情报')
+
+    def do_execute(self, entity: Any, context: Dict):
+        yield from run_step(self.env, activity_analyze_report(self.env, entity, context))
+        yield from run_step(self.env, activity_make_decision(self.env, entity, context))
+
+class ActionIssueFireOrder(ActionBase):
+    """动作：下达开火命令"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'IssueFireOrder', '下达开火命令')
+
+    def do_execute(self, entity: Any, context: Dict):
+        yield from run_step(self.env, activity_prepare_fire_order(self.env, entity, context))
+        yield from run_step(self.env, activity_transmit_order(self.env, entity, context))
+
+class ActionCeaseFireOrder(ActionBase):
+    """动作：下达停火命令"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'CeaseFireOrder', '下达停火命令')
+
+    def do_execute(self, entity: Any, context: Dict):
+        yield from run_step(self.env, activity_evaluate_results(self.env, entity, context))
+        yield from run_step(self.env, activity_send_cease_fire(self.env, entity, context))
+
+class ActionExecuteFireMission(ActionBase):
+    """动作：执行火力任务"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'ExecuteFireMission', '执行火力任务')
+
+    def do_execute(self, entity: Any, context: Dict):
+        rounds_needed = context.get('fire_order', {}).get('rounds', 36)
+        if 'res_artillery_rounds' in resources:
+            if resources['res_artillery_rounds'].level < rounds_needed:
+                log_and_collect('ERROR', '%s 弹药不足，需要 %s 发，剩余 %s 发', entity.name, rounds_needed, resources["res_artillery_rounds"].level,
+                               entity=entity.name)
+                return
+        
+        yield from run_step(self.env, activity_prepare_guns(self.env, entity, context))
+        yield from run_step(self.env, activity_fire_barrage(self.env, entity, context))
+
+class ActionCeaseFire(ActionBase):
+    """动作：停止射击"""
+    def __init__(self, env: simpy.Environment, action_id: str):
+        super().__init__(env, action_id, 'CeaseFire', '停止射击')
+
+    def do_execute(self, entity: Any, context: Dict):
+        yield from run_step(self.env, activity_stop_firing(self.env, entity, context))
+        yield from run_step(self.env, activity_report_status(self.env, entity, context))
+
+# XML模型解释器（直接由EATI XML构建实体/动作/活动，编译结果按文件哈希缓存）
+class ModelValidationError(ValueError):
+    """模型校验失败：引用缺失、公式语法错误等"""
+
+class CompiledFormula:
+    """编译后的XML公式
+
+    XML公式语法（true/false/null、global.X、字典字面量中的裸键）先按词法转换为Python表达式再编译，
+    'name = expr' 形式记录赋值目标。code对象不能直接pickle，序列化时保存marshal字节，
+    从缓存加载后无需重新编译。
+    """
+    __slots__ = ('source', 'target', 'code')
+    KEYWORDS = {'true': 'True', 'false': 'False', 'null': 'None', 'global': 'global_'}
+    reported_errors = set()
+
+    def __init__(self, source: str, where: str = 'formula'):
+        self.source = source.strip()
+        try:
+            tree = ast.parse(self.translate(self.source), mode='exec')
+        except (SyntaxError, tokenize.TokenError) as e:
+            raise ModelValidationError(f'{where}: 公式语法错误 {self.source!r} ({e})') from None
+        statement = tree.body[0] if len(tree.body) == 1 else None
+        self.target = None
+        if (isinstance(statement, ast.Assign) and len(statement.targets) == 1
+                and isinstance(statement.targets[0], ast.Name)):
+            self.target = statement.targets[0].id
+            expression = ast.Expression(statement.value)
+        elif isinstance(statement, ast.Expr):
+            expression = ast.Expression(statement.value)
+        else:
+            raise ModelValidationError(f'{where}: 公式只能是表达式或单个赋值 {self.source!r}')
+        self.code = compile(ast.fix_missing_locations(expression), f'<{where}>', 'eval')
+
+    @classmethod
+    def translate(cls, source: str) -> str:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+        result = []
+        brackets = []
+        previous = None
+        for i, token in enumerate(tokens):
+            text = token.string
+            if token.type == tokenize.OP and text in '([{':
+                brackets.append(text)
+            elif token.type == tokenize.OP and text in ')]}':
+                if brackets:
+                    brackets.pop()
+            elif token.type == tokenize.NAME and previous != '.':
+                following = tokens[i + 1].string if i + 1 < len(tokens) else ''
+                if brackets and brackets[-1] == '{' and following == ':' and previous in ('{', ','):
+                    text = repr(text)
+                else:
+                    text = cls.KEYWORDS.get(text, text)
+            result.append((token.type, text))
+            if token.type not in (tokenize.NL, tokenize.NEWLINE, tokenize.COMMENT):
+                previous = token.string
+        return tokenize.untokenize(result)
+
+    def evaluate(self, scope: 'FormulaScope', default: Any = None) -> Any:
+        """求值；出错时记录一次日志并返回default"""
+        try:
+            return eval(self.code, FORMULA_GLOBALS, scope)
+        except Exception as e:
+            if self.source not in self.reported_errors:
+                self.reported_errors.add(self.source)
+                logging.warning(f'公式求值错误: {e}, 公式: {self.source}')
+            return default
+
+    def __getstate__(self):
+        return self.source, self.target, marshal.dumps(self.code)
+
+    def __setstate__(self, state):
+        self.source, self.target, code = state
+        self.code = marshal.loads(code)
+
+class CompiledProcess:
+    """编译后的SimPyFunction代码块
+
+    代码块包装为 process(env, entity, context) 生成器函数的函数体，与公式一样以marshal字节缓存。
+    """
+    __slots__ = ('source', 'code')
+
+    def __init__(self, source: str, where: str = 'process'):
+        self.source = textwrap.dedent(source).strip('\n')
+        body = textwrap.indent(self.source, '    ')
+        # 末尾的 yield from () 保证不含yield的代码块也是生成器
+        wrapper = f'def process(env, entity, context):\n{body}\n    yield from ()\n'
+        try:
+            module = compile(wrapper, f'<{where}>', 'exec')
+        except SyntaxError as e:
+            raise ModelValidationError(f'{where}: 代码块语法错误 ({e})') from None
+        self.code = next(const for const in module.co_consts if isinstance(const, types.CodeType))
+
+    def bind(self) -> Callable:
+        return types.FunctionType(self.code, PROCESS_GLOBALS, 'process')
+
+    def __getstate__(self):
+        return self.source, marshal.dumps(self.code)
+
+    def __setstate__(self, state):
+        self.source, code = state
+        self.code = marshal.loads(code)
+
+class FormulaValue(dict):
+    """公式中的字典值，支持 a.b 形式读取键（缺失为None）"""
+    __slots__ = ()
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _formula_value(self.get(name))
+
+class FormulaEntity:
+    """公式中的 self：读取实体属性，字典型属性可继续用 .x 访问"""
+    __slots__ = ('entity',)
+
+    def __init__(self, entity: Any):
+        self.entity = entity
+
+    def __getattr__(self, name: str) -> Any:
+        return _formula_value(getattr(self.entity, name, None))
+
+class FormulaRandom:
+    """公式中的 random：既可 random() 也可 random.random()/random.uniform(a, b)"""
+    def __call__(self) -> float:
+        return random.random()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(random, name)
+
+def _formula_value(value: Any) -> Any:
+    return FormulaValue(value) if isinstance(value, dict) and not isinstance(value, FormulaValue) else value
+
+def _plain_value(value: Any) -> Any:
+    """公式结果写回模型状态前去掉包装"""
+    if isinstance(value, FormulaValue):
+        return {key: _plain_value(item) for key, item in value.items()}
+    if isinstance(value, FormulaEntity):
+        return value.entity
+    return value
+
+_formula_helpers = ExpressionEvaluator({})
+_order_ids = iter(range(1, sys.maxsize))
+FORMULA_GLOBALS = {'__builtins__': {}}
+FORMULA_FAILED = object()  # evaluate的默认值哨兵，区分求值失败与结果为None
+FORMULA_FUNCTIONS = {
+    'abs': abs, 'min': min, 'max': max, 'pow': pow, 'round': round, 'sum': sum, 'len': len,
+    'int': int, 'float': float, 'str': str, 'bool': bool, 'np': np, 'math': math,
+    'random': FormulaRandom(),
+    'calculate_patrol_route': _formula_helpers._calculate_patrol_route,
+    'calculate_path': lambda start, end: [start, end],
+    'analyze_enemy_info': _formula_helpers._analyze_enemy_info,
+    'assess_threat': _formula_helpers._analyze_enemy_info,
+    'generate_order_id': lambda: f'order_{next(_order_ids):04d}'
+}
+# SimPyFunction代码块与生成代码中的手写activity使用相同的模块
+PROCESS_GLOBALS = {'random': random, 'logging': logging, 'math': math, 'np': np, 'simpy': simpy, **FORMULA_FUNCTIONS}
+
+class FormulaScope(Mapping):
+    """公式求值的名字空间：本次执行上下文 → 实体记忆(context.X) → self/global/env/message → 资源 → 函数"""
+    __slots__ = ('entity', 'simulation', 'context')
+
+    def __init__(self, simulation: Any, entity: Any = None, context: Dict = None):
+        self.simulation = simulation
+        self.entity = entity
+        self.context = context if context is not None else {}
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.context:
+            return _formula_value(self.context[key])
+        memory = getattr(self.entity, 'memory', None)
+        if memory is not None and key in memory:
+            return _formula_value(memory[key])
+        if key == 'self':
+            return FormulaEntity(self.entity) if self.entity is not None else None
+        if key == 'context':
+            return FormulaValue({**(memory or {}), **self.context})
+        if key == 'global_':
+            return FormulaValue(self.simulation.global_vars)
+        if key == 'env':
+            return self.simulation.env
+        if key == 'time':
+            return self.simulation.env.now
+        if key == 'message':
+            return _formula_value(self.context.get('message'))
+        if key == 'current_position' and self.entity is not None:
+            return FormulaValue(self.entity.position)
+        if key in self.simulation.resources:
+            return self.simulation.resources[key]
+        return FORMULA_FUNCTIONS[key]
+
+    def __iter__(self):
+        return iter(self.context)
+
+    def __len__(self):
+        return len(self.context)
+
+@dataclass
+class ActivitySpec:
+    id: str
+    name: str
+    expression: Optional[CompiledFormula] = None
+    assignments: List[tuple] = field(default_factory=list)  # [(目标, 公式)]
+    process: Optional[CompiledProcess] = None  # SimPyFunction代码块，存在时由其控制耗时
+    preconditions: List[CompiledFormula] = field(default_factory=list)  # 不满足时跳过本活动
+    sub_activities: List[str] = field(default_factory=list)  # compound活动按顺序执行的子活动
+    external: Optional[tuple] = None  # (模块, 函数名, [(参数名, 来源公式, 默认值)])
+    distribution: str = 'constant'
+    parameters: Dict[str, float] = field(default_factory=dict)
+    truncation: tuple = (None, None)
+
+@dataclass
+class ActionSpec:
+    id: str
+    name: str
+    activities: List[str] = field(default_factory=list)
+    execution_mode: str = 'sequential'
+    trigger_type: Optional[str] = None  # condition: 条件成立且未在执行时启动; event: 条件由假变真时启动
+    trigger: Optional[CompiledFormula] = None
+    start_conditions: List[CompiledFormula] = field(default_factory=list)
+    resources: List[tuple] = field(default_factory=list)  # [(资源id, 数量)]
+
+@dataclass
+class HandlerSpec:
+    interaction_id: str
+    action_id: str
+    precondition: Optional[CompiledFormula] = None
+
+@dataclass
+class EntitySpec:
+    id: str
+    name: str
+    type: str = 'agent'
+    position: Dict = field(default_factory=lambda: {'x': 0.0, 'y': 0.0, 'z': 0.0})
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    state_variables: Dict[str, Any] = field(default_factory=dict)
+    actions: List[str] = field(default_factory=list)
+    handlers: Dict[str, HandlerSpec] = field(default_factory=dict)  # 按消息类型
+    initialization_action: Optional[str] = None
+    change_events: Dict[str, List[tuple]] = field(default_factory=dict)  # {状态变量: [(条件公式, 动作id)]}
+    followups: List[str] = field(default_factory=list)  # 本实体其他动作完成后检查开始条件的动作
+
+    @property
+    def role(self) -> str:
+        return self.id[4:] if self.id.startswith('ent_') else self.id
+
+@dataclass
+class InteractionSpec:
+    id: str
+    message_type: str
+    source: Optional[str] = None
+    target: Optional[str] = None
+    target_action: Optional[str] = None
+    context_data: List[tuple] = field(default_factory=list)  # [(上下文名, 来源)]，来源为 message / message.X / source_entity_id
+    trigger: Optional[CompiledFormula] = None  # 在源实体上由假变真时发送
+
+@dataclass
+class EventSpec:
+    id: str
+    name: str
+    trigger: Optional[CompiledFormula] = None
+    actions: List[str] = field(default_factory=list)
+    repeatable: bool = False
+
+@dataclass
+class TaskSpec:
+    id: str
+    name: str
+    entities: List[str] = field(default_factory=list)
+    initial_action: Optional[str] = None
+    start_condition: Optional[CompiledFormula] = None
+
+@dataclass
+class ResourceSpec:
+    id: str
+    name: str
+    kind: str = 'Container'
+    capacity: float = float('inf')
+    init: float = 0.0
+
+@dataclass
+class CompiledModel:
+    """编译后的EATI模型（纯数据，可pickle缓存）"""
+    source_path: str
+    source_hash: str = ''
+    config: Dict[str, Any] = field(default_factory=dict)
+    global_vars: Dict[str, Any] = field(default_factory=dict)
+    resources: Dict[str, ResourceSpec] = field(default_factory=dict)
+    entities: Dict[str, EntitySpec] = field(default_factory=dict)
+    actions: Dict[str, ActionSpec] = field(default_factory=dict)
+    activities: Dict[str, ActivitySpec] = field(default_factory=dict)
+    interactions: Dict[str, InteractionSpec] = field(default_factory=dict)  # 按消息类型
+    events: Dict[str, EventSpec] = field(default_factory=dict)
+    tasks: Dict[str, TaskSpec] = field(default_factory=dict)
+    warnings: List[str] = field(default_factory=list)
+
+    def link(self):
+        """补全交互处理器并校验引用，缺失的硬引用抛出ModelValidationError"""
+        errors = []
+        for entity in self.entities.values():
+            for action_id in entity.actions:
+                if action_id not in self.actions:
+                    errors.append(f'实体 {entity.id} 引用了不存在的动作 {action_id}')
+            for message_type, handler in entity.handlers.items():
+                if handler.action_id not in self.actions:
+                    errors.append(f'实体 {entity.id} 的 {message_type} 处理器引用了不存在的动作 {handler.action_id}')
+        for action in self.actions.values():
+            for activity_id in action.activities:
+                if activity_id not in self.activities:
+                    errors.append(f'动作 {action.id} 引用了不存在的活动 {activity_id}')
+            for resource_id, _ in action.resources:
+                if resource_id not in self.resources:
+                    errors.append(f'动作 {action.id} 引用了不存在的资源 {resource_id}')
+        for activity in self.activities.values():
+            for activity_id in activity.sub_activities:
+                if activity_id not in self.activities:
+                    errors.append(f'活动 {activity.id} 引用了不存在的子活动 {activity_id}')
+        for event in self.events.values():
+            for action_id in event.actions:
+                if action_id not in self.actions:
+                    errors.append(f'事件 {event.id} 引用了不存在的动作 {action_id}')
+        for entity in self.entities.values():
+            for name, changes in entity.change_events.items():
+                for _, action_id in changes:
+                    if action_id not in self.actions:
+                        errors.append(f'实体 {entity.id} 的 {name} 变化事件引用了不存在的动作 {action_id}')
+        for task in self.tasks.values():
+            if task.initial_action and task.initial_action not in self.actions:
+                errors.append(f'任务 {task.id} 的初始动作 {task.initial_action} 不存在')
+            for entity_id in task.entities:
+                if entity_id not in self.entities:
+                    errors.append(f'任务 {task.id} 引用了不存在的实体 {entity_id}')
+        
+        # 目标实体未声明处理器时，依次采用交互的TargetAction、同名动作 act_<消息类型>
+        for interaction in self.interactions.values():
+            target = self.entities.get(interaction.target)
+            if target is None:
+                self.warnings.append(f'交互 {interaction.id} 的目标实体 {interaction.target} 不存在')
+                continue
+            if interaction.message_type in target.handlers:
+                continue
+            for action_id in (interaction.target_action, f'act_{interaction.message_type}'):
+                if action_id in self.actions:
+                    target.handlers[interaction.message_type] = HandlerSpec(interaction.id, action_id)
+                    break
+            else:
+                self.warnings.append(f'交互 {interaction.id} 在目标实体 {target.id} 上没有处理动作')
+        
+        # 由活动赋值 interaction.X 发送的交互不再按交互自身的TriggerCondition发送
+        sent = {target.split('.', 1)[1].removeprefix('int_') for activity in self.activities.values()
+                for target, _ in activity.assignments if target.startswith('interaction.')}
+        for interaction in self.interactions.values():
+            if interaction.message_type in sent:
+                interaction.trigger = None
+        
+        # 只有开始条件、不由触发条件/交互/事件启动的动作作为后续动作
+        started = {handler.action_id for entity in self.entities.values() for handler in entity.handlers.values()}
+        started.update(action_id for event in self.events.values() for action_id in event.actions)
+        started.update(action_id for entity in self.entities.values()
+                       for changes in entity.change_events.values() for _, action_id in changes)
+        for entity in self.entities.values():
+            entity.followups = [action_id for action_id in entity.actions
+                                if action_id in self.actions and action_id not in started
+                                and self.actions[action_id].trigger is None and self.actions[action_id].start_conditions]
+        if errors:
+            raise ModelValidationError('\n'.join(errors))
+
+def _local_tag(elem: ET.Element) -> str:
+    return elem.tag.rsplit('}', 1)[-1]
+
+def _child(elem: ET.Element, *path: str) -> Optional[ET.Element]:
+    """按本地标签名（忽略命名空间）逐级查找子元素"""
+    for name in path:
+        if elem is None:
+            return None
+        elem = next((child for child in elem if _local_tag(child) == name), None)
+    return elem
+
+def _children(elem: Optional[ET.Element], name: str) -> List[ET.Element]:
+    return [child for child in elem if _local_tag(child) == name] if elem is not None else []
+
+def _text(elem: ET.Element, *path: str, default: Any = None) -> Any:
+    node = _child(elem, *path)
+    if node is None or node.text is None or not node.text.strip():
+        return default
+    return node.text.strip()
+
+def _typed_value(text: Optional[str], value_type: str = 'string') -> Any:
+    """按XML声明的类型转换取值"""
+    if text is None:
+        return None
+    value_type = (value_type or 'string').lower()
+    if value_type == 'boolean':
+        return text.strip().lower() == 'true'
+    if value_type == 'integer':
+        return int(float(text))
+    if value_type in ('double', 'float', 'time'):
+        return float(text)
+    if value_type in ('dict', 'list'):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+    return text
+
+def _variable_name(elem: ET.Element, prefix: str, camel: bool = False) -> str:
+    """变量在公式中的名字：Name为ASCII标识符时取Name，否则由id去掉前缀得到（全局变量转为驼峰）"""
+    name = _text(elem, 'Name')
+    if name and name.isascii() and name.isidentifier():
+        return name
+    name = elem.get('id') or name
+    name = name[len(prefix):] if name.startswith(prefix) else name
+    return ''.join(part.capitalize() for part in name.split('_')) if camel else name
+
+def _formula(elem: Optional[ET.Element], where: str) -> Optional[CompiledFormula]:
+    source = _text(elem, 'Expression', 'Formula') if elem is not None else None
+    return CompiledFormula(source, where) if source else None
+
+def _parse_entity(elem: ET.Element) -> EntitySpec:
+    entity_id = elem.get('id')
+    position = _child(elem, 'Position')
+    spec = EntitySpec(entity_id, _text(elem, 'Name', default=entity_id), _text(elem, 'Type', default='agent'))
+    if position is not None:
+        spec.position = {axis: float(_text(position, axis.upper(), default=0.0)) for axis in ('x', 'y', 'z')}
+    for attribute in _children(_child(elem, 'Attributes'), 'Attribute'):
+        spec.attributes[attribute.get('name')] = _typed_value(attribute.get('value'), attribute.get('type'))
+    for variable in _children(_child(elem, 'StateVariables'), 'StateVariable'):
+        name = _variable_name(variable, 'sv_')
+        spec.state_variables[name] = _typed_value(_text(variable, 'InitialValue'), _text(variable, 'Type'))
+        for change in _children(_child(variable, 'ChangeEvents'), 'ChangeEvent'):
+            condition = _text(change, 'Condition', 'Formula')
+            spec.change_events.setdefault(name, []).append((
+                CompiledFormula(condition, f'{entity_id}/{name}/ChangeEvent') if condition else None,
+                _text(change, 'TriggerAction')))
+    spec.actions = [ref.text.strip() for ref in _children(_child(elem, 'Actions'), 'ActionRef')]
+    spec.initialization_action = _text(elem, 'Lifecycle', 'InitializationAction')
+    for handler in _children(_child(elem, 'InteractionHandlers'), 'Handler'):
+        interaction_id = _text(handler, 'InteractionRef')
+        message_type = interaction_id[4:] if interaction_id.startswith('int_') else interaction_id
+        precondition = _text(handler, 'PreCondition', 'Formula')
+        spec.handlers[message_type] = HandlerSpec(
+            interaction_id, _text(handler, 'TargetAction'),
+            CompiledFormula(precondition, f'{entity_id}/{handler.get("id")}') if precondition else None)
+    return spec
+
+def _parse_action(elem: ET.Element) -> ActionSpec:
+    action_id = elem.get('id')
+    activities = _child(elem, 'Activities')
+    trigger = _child(elem, 'TriggerCondition')
+    spec = ActionSpec(action_id, _text(elem, 'Name', default=action_id),
+                      [ref.text.strip() for ref in _children(activities, 'ActivityRef')],
+                      activities.get('executionMode', 'sequential') if activities is not None else 'sequential')
+    if trigger is not None:
+        spec.trigger_type = _text(trigger, 'Type', default='condition')
+        spec.trigger = _formula(trigger, f'{action_id}/TriggerCondition')
+    spec.start_conditions = [_formula(condition, f'{action_id}/StartConditions')
+                             for condition in _children(_child(elem, 'StartConditions'), 'Condition')]
+    spec.start_conditions = [condition for condition in spec.start_conditions if condition is not None]
+    for requirement in _children(_child(elem, 'ResourceRequirements'), 'ResourceRequirement'):
+        spec.resources.append((_text(requirement, 'ResourceRef'), float(_text(requirement, 'Quantity', default=1))))
+    return spec
+
+def _parse_activity(elem: ET.Element) -> ActivitySpec:
+    activity_id = elem.get('id')
+    function = _child(elem, 'InternalFunction')
+    spec = ActivitySpec(activity_id, _text(elem, 'Name', default=activity_id))
+    if function is not None:
+        spec.expression = _formula(function, f'{activity_id}/Expression')
+        for assignment in _children(_child(function, 'Assignments'), 'Assignment'):
+            formula = _formula(assignment, f'{activity_id}/Assignment')
+            if formula is not None:
+                spec.assignments.append((_text(assignment, 'Target'), formula))
+    for conditions in (_child(function, 'PreConditions') if function is not None else None,
+                       _child(elem, 'StartConditions')):
+        for condition in _children(conditions, 'Condition'):
+            formula = _formula(condition, f'{activity_id}/Condition')
+            if formula is not None:
+                spec.preconditions.append(formula)
+    spec.sub_activities = [ref.text.strip() for ref in _children(_child(elem, 'SubActivities'), 'ActivityRef')]
+    external = _child(elem, 'ExternalAlgorithm')
+    if external is not None:
+        parameters = []
+        for parameter in _children(_child(external, 'Parameters'), 'Parameter'):
+            source = parameter.get('source')
+            parameters.append((parameter.get('name'),
+                               CompiledFormula(source, f'{activity_id}/{parameter.get("name")}') if source else None,
+                               _typed_value(parameter.get('default'), parameter.get('type'))))
+        spec.external = (_text(external, 'Module'), _text(external, 'FunctionName'), parameters)
+    code = _text(elem, 'SimPyFunction', 'Code')
+    if code:
+        spec.process = CompiledProcess(_child(elem, 'SimPyFunction', 'Code').text, f'{activity_id}/Code')
+    delay = _child(elem, 'DelayTime')
+    if delay is not None:
+        spec.distribution = _text(delay, 'Distribution', default='constant')
+        spec.parameters = {parameter.get('name'): float(parameter.text)
+                           for parameter in _children(_child(delay, 'Parameters'), 'Parameter')}
+        low, high = _text(delay, 'TruncationMin'), _text(delay, 'TruncationMax')
+        spec.truncation = (float(low) if low else None, float(high) if high else None)
+    return spec
+
+def _parse_interaction(elem: ET.Element) -> InteractionSpec:
+    interaction_id = elem.get('id')
+    message_type = interaction_id[4:] if interaction_id.startswith('int_') else interaction_id
+    action_trigger = _child(elem, 'ExecutionSemantics', 'TargetBehavior', 'ProcessingBehavior', 'ActionTrigger')
+    spec = InteractionSpec(interaction_id, message_type, _text(elem, 'Source'), _text(elem, 'Target'),
+                           _text(action_trigger, 'TargetAction') if action_trigger is not None
+                           else _text(elem, 'TargetAction'))
+    spec.context_data = [(_text(item, 'Name'), _text(item, 'Source', default='message'))
+                         for item in _children(_child(action_trigger, 'ContextData'), 'DataItem')]
+    spec.trigger = _formula(_child(elem, 'TriggerCondition'), f'{interaction_id}/TriggerCondition')
+    return spec
+
+def _parse_event(elem: ET.Element) -> EventSpec:
+    event_id = elem.get('id')
+    return EventSpec(event_id, _text(elem, 'Name', default=event_id),
+                     _formula(_child(elem, 'TriggerCondition'), f'{event_id}/TriggerCondition'),
+                     [ref.text.strip() for ref in _children(_child(elem, 'Actions'), 'ActionRef')],
+                     _text(elem, 'Repeatable', default='false').lower() == 'true')
+
+def _parse_resource(elem: ET.Element) -> ResourceSpec:
+    capacity = _text(elem, 'Capacity')
+    return ResourceSpec(elem.get('id'), _text(elem, 'Name', default=elem.get('id')), _text(elem, 'Type', default='Container'),
+                        float(capacity) if capacity else float('inf'), float(_text(elem, 'InitialQuantity', default=0)))
+
+def _parse_task(elem: ET.Element) -> TaskSpec:
+    task_id = elem.get('id')
+    start = _text(elem, 'TaskLifecycle', 'StartCondition', 'Formula')
+    return TaskSpec(task_id, _text(elem, 'Name', default=task_id),
+                    [ref.text.strip() for ref in _children(_child(elem, 'Entities'), 'EntityRef')],
+                    _text(elem, 'InitialAction'),
+                    CompiledFormula(start, f'{task_id}/StartCondition') if start else None)
+
+def compile_model(xml_path: str) -> CompiledModel:
+    """流式解析EATI XML：只在顶层集合的直接子元素结束时构建规格，随后清空该元素释放内存"""
+    model = CompiledModel(source_path=xml_path)
+    item_tags = {'Entities': 'Entity', 'Actions': 'Action', 'Activities': 'Activity',
+                   'Interactions': 'Interaction', 'Events': 'Event', 'Resources': 'Resource',
+                   'GlobalVariables': 'Variable', 'Tasks': 'Task'}
+    stack = []
+    with EATIXmlSource(xml_path) as source:
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(_local_tag(elem))
+                continue
+            tag = stack.pop()
+            if len(stack) == 1 and tag == 'SimulationConfig':
+                model.config = {_local_tag(child): child.text.strip() for child in elem
+                                if child.text and child.text.strip()}
+                elem.clear()
+            elif len(stack) == 2 and item_tags.get(stack[1]) == tag:
+                if tag == 'Entity':
+                    spec = _parse_entity(elem)
+                    model.entities[spec.id] = spec
+                elif tag == 'Action':
+                    spec = _parse_action(elem)
+                    model.actions[spec.id] = spec
+                elif tag == 'Activity':
+                    spec = _parse_activity(elem)
+                    model.activities[spec.id] = spec
+                elif tag == 'Interaction':
+                    spec = _parse_interaction(elem)
+                    model.interactions[spec.message_type] = spec
+                elif tag == 'Event':
+                    spec = _parse_event(elem)
+                    model.events[spec.id] = spec
+                elif tag == 'Resource':
+                    spec = _parse_resource(elem)
+                    model.resources[spec.id] = spec
+                elif tag == 'Task':
+                    spec = _parse_task(elem)
+                    model.tasks[spec.id] = spec
+                else:
+                    model.global_vars[_variable_name(elem, 'gv_', camel=True)] = _typed_value(
+                        _text(elem, 'InitialValue'), _text(elem, 'Type'))
+                elem.clear()
+    model.link()
+    return model
+
+_compiled_models: Dict[tuple, CompiledModel] = {}
+
+class ModelCacheUnpickler(pickle.Unpickler):
+    """模型缓存的反序列化：规格类按名字解析到当前模块
+
+    作为脚本运行时本模块是 __main__，被导入时是模块名；缓存中记录的模块名与当前不同时，
+    默认的find_class会再导入一次本文件（重复配置日志等）。其他全局名只允许少数内置类型。
+    """
+    MODEL_CLASSES = {'CompiledModel', 'CompiledFormula', 'CompiledProcess', 'ActivitySpec', 'ActionSpec',
+                     'HandlerSpec', 'EntitySpec', 'InteractionSpec', 'EventSpec', 'TaskSpec', 'ResourceSpec'}
+    SAFE_GLOBALS = {('builtins', 'set'), ('builtins', 'frozenset'), ('builtins', 'complex'),
+                    ('collections', 'OrderedDict'), ('copyreg', '_reconstructor'), ('builtins', 'object')}
+
+    def find_class(self, module: str, name: str) -> Any:
+        if name in self.MODEL_CLASSES:
+            return globals()[name]
+        if (module, name) in self.SAFE_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f'模型缓存中不允许的类型 {module}.{name}')
+
+def load_model(xml_path: str, cache_dir: str = None) -> CompiledModel:
+    """加载模型：按文件内容SHA-256查找进程内和磁盘缓存，未命中时编译并写入缓存"""
+    digest = hashlib.sha256()
+    with open(xml_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    source_hash = digest.hexdigest()
+    key = (os.path.abspath(xml_path), source_hash)
+    if key in _compiled_models:
+        return _compiled_models[key]
+    
+    # code对象的marshal格式与解释器版本相关，缓存文件名包含cache_tag
+    cache_dir = cache_dir or MODEL_CACHE_DIR or os.path.join(os.path.dirname(os.path.abspath(xml_path)), '__eaticache__')
+    cache_path = os.path.join(cache_dir, f'{os.path.basename(xml_path)}.{source_hash[:16]}.'
+                                         f'{sys.implementation.cache_tag}.v{MODEL_CACHE_VERSION}.pickle')
+    model = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                model = ModelCacheUnpickler(f).load()
+            logging.info(f'从缓存加载编译模型: {cache_path}')
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError, TypeError, KeyError) as e:
+            logging.warning(f'模型缓存不可用，重新编译: {e}')
+            model = None
+    if model is None or model.source_hash != source_hash:
+        model = compile_model(xml_path)
+        model.source_hash = source_hash
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.warning(f'写入模型缓存失败: {e}')
+    model.source_path = xml_path
+    for warning in model.warnings:
+        logging.warning(f'模型校验: {warning}')
+    _compiled_models[key] = model
+    return model
+
+def apply_model_config(model: CompiledModel):
+    """用模型的 SimulationConfig 覆盖运行参数"""
+    global SIMULATION_END_TIME, REAL_TIME_RATIO, RUN_MODE, STEP_SIZE
+    config = model.config
+    if 'EndTime' in config:
+        SIMULATION_END_TIME = float(config['EndTime'])
+    if 'RealTimeRatio' in config:
+        REAL_TIME_RATIO = float(config['RealTimeRatio'])
+    if 'RunMode' in config:
+        RUN_MODE = config['RunMode']
+    if 'StepSize' in config:
+        STEP_SIZE = float(config['StepSize'])
+    if 'RandomSeed' in config:
+        random.seed(int(config['RandomSeed']))
+        np.random.seed(int(config['RandomSeed']))
+
+class InterpretedEntity(BaseEntity):
+    """由编译模型实例化的通用实体；每个实体规格派生一个子类以声明其状态变量"""
+    _classes: Dict[tuple, type] = {}
+
+    @classmethod
+    def for_spec(cls, spec: EntitySpec) -> type:
+        key = (spec.role, tuple(spec.state_variables))
+        if key not in cls._classes:
+            cls._classes[key] = type(f'Interpreted_{spec.role}', (cls,), {
+                'ROLE': spec.role, 'STATE_VARIABLES': tuple(spec.state_variables)})
+        return cls._classes[key]
+
+    def __init__(self, env: simpy.Environment, spec: EntitySpec, simulation):
+        super().__init__(env, spec.id, simulation)
+        self.name = spec.name
+        self.type = spec.type
+        self.position = dict(spec.position)
+        self.attributes = dict(spec.attributes)
+        self.actions = list(spec.actions)
+        self.memory = {}  # 模型公式中的 context.X，跨动作保留
+        self.running_actions = {}
+        for name, value in spec.state_variables.items():
+            setattr(self, name, value)
+        self.spec = spec  # 设置后状态变量的赋值才检查ChangeEvent
+
+    def __setattr__(self, name: str, value: Any):
+        # 状态变量的ChangeEvent：值变化且条件成立时启动TriggerAction
+        spec = self.__dict__.get('spec')
+        if spec is None or name not in spec.change_events:
+            super().__setattr__(name, value)
+            return
+        old_value = self.__dict__.get(name)
+        super().__setattr__(name, value)
+        if old_value == value:
+            return
+        scope = FormulaScope(self.simulation, self, {'new_value': value, 'old_value': old_value})
+        for condition, action_id in spec.change_events[name]:
+            if action_id in actions and not self.running_actions.get(action_id) and (
+                    condition is None or condition.evaluate(scope)):
+                self.start_process(self.run_action(action_id))
+
+    def __getattr__(self, name: str) -> Any:
+        # 公式中 self.guns_count 等读取静态属性
+        attributes = self.__dict__.get('attributes')
+        if attributes is not None and name in attributes:
+            return attributes[name]
+        raise AttributeError(name)
+
+    def start(self):
+        log_and_collect('INFO', '%s 开始运行', self.name, entity=self.name)
+        self.start_process(self.message_handler())
+
+    def message_handler(self):
+        """按交互处理器分派收到的消息"""
+        while True:
+            try:
+                msg = yield self.message_queue.get()
+            except simpy.Interrupt:
+                break
+            message_type = msg.get('type', 'unknown')
+            log_and_collect('INFO', '%s 收到消息: %s', self.name, message_type, entity=self.name)
+            handler = self.spec.handlers.get(message_type)
+            if handler is None:
+                continue
+            context = {'message': msg}
+            interaction = self.simulation.model_runtime.model.interactions.get(message_type)
+            # ContextData映射，消息中缺失的字段不写入上下文，公式中的默认值仍然生效
+            for name, source in (interaction.context_data if interaction is not None else ()):
+                if source == 'source_entity_id':
+                    value = msg.get('source')
+                elif source.startswith('message.'):
+                    value = msg.get(source[len('message.'):])
+                else:
+                    value = msg
+                if value is not None:
+                    context[name] = value
+            if handler.precondition is not None and not handler.precondition.evaluate(
+                    FormulaScope(self.simulation, self, context)):
+                log_and_collect('WARNING', '%s 不满足 %s 的处理条件，忽略消息', self.name, message_type, entity=self.name)
+                continue
+            self.start_process(self.run_action(handler.action_id, context))
+
+    def run_action(self, action_id: str, context_data: Dict = None):
+        """执行动作"""
+        self.update_status(action=action_id)
+        self.running_actions[action_id] = self.running_actions.get(action_id, 0) + 1
+        try:
+            if action_id in actions:
+                yield from run_step(self.env, actions[action_id].execute(self, dict(context_data or {})))
+        finally:
+            self.running_actions[action_id] -= 1
+        
+        for followup in self.spec.followups:
+            if (followup != action_id and not self.running_actions.get(followup)
+                    and actions[followup].ready(self, context_data or {})):
+                self.start_process(self.run_action(followup, context_data))
+
+def _external_artillery_barrage(simulation: Any, entity: Any, gun_count: int = 1, rounds_per_gun: int = 2,
+                                target_coordinates: Dict = None, ammunition_type: str = 'HE') -> Dict:
+    """外部算法 execute_artillery_barrage：由火力毁伤模型结算一次齐射"""
+    guns = int(gun_count or 1)
+    rounds = guns * int(rounds_per_gun or 1)
+    aim = dict(target_coordinates) if isinstance(target_coordinates, dict) else {'x': 800.0, 'y': 600.0}
+    fire_effects = simulation.fire_effects
+    targets = fire_effects.targets_near(simulation.hostile_index, aim)
+    sheaf = (targets[0].footprint[2], targets[0].footprint[1]) if targets else (0.0, 0.0)
+    salvo = fire_effects.fire_salvo(entity.position, aim, rounds, guns, targets, sheaf)
+    miss = np.hypot(salvo['impacts'][:, 0] - aim['x'], salvo['impacts'][:, 1] - aim['y'])
+    return {'rounds_fired': rounds, 'accuracy_estimate': float(np.mean(miss <= max(LETHAL_RADIUS))),
+            'effects': {result['target_id']: result['damage'] for result in salvo['targets']}}
+
+# XML中ExternalAlgorithm引用的函数，优先使用本程序内的实现，否则按Module导入
+EXTERNAL_ALGORITHMS = {
+    'execute_artillery_barrage': _external_artillery_barrage
+}
+
+@functools.lru_cache(maxsize=None)
+def resolve_external_algorithm(module: str, function_name: str) -> Optional[Callable]:
+    if function_name in EXTERNAL_ALGORITHMS:
+        return EXTERNAL_ALGORITHMS[function_name]
+    try:
+        function = getattr(importlib.import_module(module), function_name)
+    except (ImportError, AttributeError, TypeError, ValueError) as e:
+        logging.warning(f'外部算法 {module}.{function_name} 不可用，活动只计耗时: {e}')
+        return None
+    # 外部模块中的函数不接收simulation/entity
+    return lambda simulation, entity, **kwargs: function(**kwargs)
+
+def make_interpreted_activity(spec: ActivitySpec, activities: Dict[str, Callable]) -> Callable:
+    """由活动规格生成activity函数，经enhanced_activity_wrapper包装后与手写activity同样记录时间线
+
+    activities为全部已生成的活动，compound活动在执行时按id查找子活动。
+    """
+    process = spec.process.bind() if spec.process is not None else None
+    
+    def activity(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
+        yield from pause_point(env, entity)
+        
+        scope = FormulaScope(entity.simulation, entity, context)
+        if not all(condition.evaluate(scope) for condition in spec.preconditions):
+            log_and_collect('WARNING', '%s 不满足活动 %s 的前置条件，跳过', entity.name, spec.name, entity=entity.name)
+            return {}
+        result = {}
+        for activity_id in spec.sub_activities:
+            outputs = yield from run_step(env, activities[activity_id](env, entity, context))
+            if isinstance(outputs, dict):
+                result.update(outputs)
+        if spec.external is not None:
+            module, function_name, parameters = spec.external
+            function = resolve_external_algorithm(module, function_name)
+            if function is not None:
+                kwargs = {}
+                for name, source, default in parameters:
+                    value = _plain_value(source.evaluate(scope)) if source is not None else None
+                    kwargs[name] = default if value is None else value
+                outputs = function(entity.simulation, entity, **kwargs)
+                if isinstance(outputs, dict):
+                    entity.memory.update(outputs)
+                    result.update(outputs)
+        # 求值失败的赋值被跳过，保留原值
+        if spec.expression is not None:
+            value = spec.expression.evaluate(scope, FORMULA_FAILED)
+            if spec.expression.target and value is not FORMULA_FAILED:
+                entity.memory[spec.expression.target] = result[spec.expression.target] = _plain_value(value)
+        for target, formula in spec.assignments:
+            value = formula.evaluate(scope, FORMULA_FAILED)
+            if value is not FORMULA_FAILED:
+                entity.simulation.model_runtime.assign(entity, target, _plain_value(value))
+        if process is not None:
+            outputs = yield from process(env, entity, context)
+            if isinstance(outputs, dict):
+                entity.memory.update(outputs)
+                result.update(outputs)
+            return result
+        
+        delay_time = TimeDistribution.generate(spec.distribution, spec.parameters)
+        low, high = spec.truncation
+        if low is not None:
+            delay_time = max(low, delay_time)
+        if high is not None:
+            delay_time = min(high, delay_time)
+        yield env.timeout(delay_time)
+        return result
+
+    activity.__name__ = activity.__qualname__ = spec.id
+    activity.__doc__ = f'活动：{spec.name}'
+    return enhanced_activity_wrapper(activity)
+
+class InterpretedAction(ActionBase):
+    """由动作规格驱动的通用动作：检查开始条件、申请资源，再按顺序或并行执行活动"""
+    def __init__(self, env: simpy.Environment, spec: ActionSpec, activities: Dict[str, Callable]):
+        super().__init__(env, spec.id, spec.name, spec.name)
+        self.spec = spec
+        self.activities = [activities[activity_id] for activity_id in spec.activities]
+
+    def ready(self, entity: Any, context: Dict) -> bool:
+        scope = FormulaScope(entity.simulation, entity, context)
+        return all(condition.evaluate(scope) for condition in self.spec.start_conditions)
+
+    def do_execute(self, entity: Any, context: Dict):
+        if not self.ready(entity, context):
+            log_and_collect('WARNING', '%s 不满足动作 %s 的开始条件', entity.name, self.chinese_name,
+                           entity=entity.name)
+            return
+        
+        requests = []
+        for resource_id, quantity in self.spec.resources:
+            resource = entity.simulation.resources[resource_id]
+            if isinstance(resource, simpy.Container):
+                if resource.level < quantity:
+                    log_and_collect('ERROR', '%s 资源 %s 不足，需要 %s，剩余 %s', entity.name, resource_id,
+                                   quantity, resource.level, entity=entity.name)
+                    return
+                yield resource.get(quantity)
+            else:
+                request = resource.request()
+                yield request
+                requests.append((resource, request))
+        try:
+            if self.spec.execution_mode == 'parallel':
+                yield self.env.all_of([child_process(self.env, activity(self.env, entity, context))
+                                       for activity in self.activities])
+            else:
+                for activity in self.activities:
+                    yield from run_step(self.env, activity(self.env, entity, context))
+        finally:
+            for resource, request in requests:
+                resource.release(request)
+
+class ModelRuntime:
+    """模型运行时：由编译模型创建资源/实体/动作，检查动作触发条件与模型事件，发送交互消息"""
+    def __init__(self, simulation, model: CompiledModel):
+        self.simulation = simulation
+        self.model = model
+        self.triggered = []  # [(实体, 动作规格)]
+        self.trigger_groups = {}  # 动作id -> 该动作在triggered中的序号（同一触发条件的实体）
+        self.batch_plans = {}  # 动作id -> (表达式, 批量求值器, 引用的名字)，None表示不批量求值
+        self.owners = {}  # 动作id -> 拥有该动作的实体
+        self.trigger_state = {}
+        self.interaction_targets = {}
+
+    def create_resources(self) -> Dict[str, Any]:
+        env = self.simulation.env
+        created = {}
+        for spec in self.model.resources.values():
+            if spec.kind == 'Resource':
+                created[spec.id] = MonitoredResource(env, capacity=int(spec.capacity))
+            elif spec.kind == 'Store':
+                created[spec.id] = MonitoredStore(env, capacity=spec.capacity)
+            else:
+                created[spec.id] = MonitoredContainer(env, capacity=spec.capacity, init=spec.init)
+        return created
+
+    def instantiate(self) -> Dict[str, BaseEntity]:
+        entities = {}
+        for spec in self.model.entities.values():
+            entity = InterpretedEntity.for_spec(spec)(self.simulation.env, spec, self.simulation)
+            entities[spec.id] = entity
+            for action_id in spec.actions:
+                self.owners.setdefault(action_id, []).append(entity)
+                action = self.model.actions[action_id]
+                if action.trigger is not None:
+                    self.trigger_groups.setdefault(action_id, []).append(len(self.triggered))
+                    self.triggered.append((entity, action))
+        for interaction in self.model.interactions.values():
+            self.interaction_targets[interaction.message_type] = entities.get(interaction.target)
+        return entities
+
+    def create_actions(self) -> Dict[str, ActionBase]:
+        env = self.simulation.env
+        activities = {}
+        for activity_id, spec in self.model.activities.items():
+            activities[activity_id] = make_interpreted_activity(spec, activities)
+        return {action_id: InterpretedAction(env, spec, activities) for action_id, spec in self.model.actions.items()}
+
+    def start(self):
+        """写入全局变量，启动实体初始化动作和任务初始动作，并注册触发检查"""
+        simulation = self.simulation
+        simulation.global_vars.update(self.model.global_vars)
+        for entity_spec in self.model.entities.values():
+            if entity_spec.initialization_action in self.model.actions:
+                entity = simulation.entities[entity_spec.id]
+                entity.start_process(entity.run_action(entity_spec.initialization_action))
+        for task in self.model.tasks.values():
+            if not task.initial_action:
+                continue
+            if task.start_condition is not None and not task.start_condition.evaluate(FormulaScope(simulation)):
+                continue
+            # 由任务中声明了该动作的实体执行，都未声明时由第一个实体执行
+            owners = [simulation.entities[entity_id] for entity_id in task.entities
+                      if task.initial_action in self.model.entities[entity_id].actions]
+            for entity in owners or [simulation.entities[entity_id] for entity_id in task.entities[:1]]:
+                entity.start_process(entity.run_action(task.initial_action))
+        simulation.timer_wheel.register(self.check_triggers, period=MODEL_TRIGGER_INTERVAL, owner=self)
+
+    def _batch_plan(self, action: ActionSpec) -> Optional[tuple]:
+        """触发条件的批量求值方案；含 random 的条件不批量求值，保持按triggered顺序逐实体抽样"""
+        if action.id in self.batch_plans:
+            return self.batch_plans[action.id]
+        plan = None
+        formula = action.trigger
+        try:
+            expression = CompiledFormula.translate(formula.source).strip()
+            tree = ast.parse(expression, mode='eval')
+        except (SyntaxError, tokenize.TokenError):
+            tree = None
+        if tree is not None and formula.target is None:
+            names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+            fields = sorted({node.attr for node in ast.walk(tree) if isinstance(node, ast.Attribute)
+                             and isinstance(node.value, ast.Name) and node.value.id == 'self'})
+            if 'random' not in names:
+                simulation = self.simulation
+                evaluator = BatchExpressionEvaluator(
+                    EntityAttributeBatch([], fields),
+                    fallback=lambda entity: formula.evaluate(FormulaScope(simulation, entity)))
+                plan = (expression, evaluator, names)
+        self.batch_plans[action.id] = plan
+        return plan
+
+    def _evaluate_batch(self, action: ActionSpec, entities: List[Any]) -> Optional[List[bool]]:
+        """对拥有同一动作的一组实体一次性求触发条件，不能批量时返回None"""
+        plan = self._batch_plan(action)
+        if plan is None:
+            return None
+        expression, evaluator, names = plan
+        # 实体记忆中的同名变量优先于全局名字，逐实体不同，这种情况逐实体求值
+        if any(name in entity.memory for entity in entities for name in names):
+            return None
+        scope = FormulaScope(self.simulation)
+        context = {}
+        for name in names:
+            if name in ('self', 'np') or name in _VectorizeTransformer.FUNCTION_MAP:
+                continue
+            if name in ('context', 'message', 'current_position'):
+                return None
+            try:
+                context[name] = scope[name]
+            except KeyError:
+                return None
+        evaluator.batch = EntityAttributeBatch(entities, evaluator.batch.fields)
+        evaluator.context = context
+        return [bool(value) for value in evaluator.evaluate(expression)]
+
+    def evaluate_triggers(self) -> List[bool]:
+        """按triggered顺序求各(实体, 动作)的触发条件；同一条件的实体足够多时批量向量化求值"""
+        values: List[Optional[bool]] = [None] * len(self.triggered)
+        for indices in self.trigger_groups.values():
+            if len(indices) < BATCH_EVALUATION_MIN_ENTITIES:
+                continue
+            action = self.triggered[indices[0]][1]
+            batch_values = self._evaluate_batch(action, [self.triggered[i][0] for i in indices])
+            if batch_values is not None:
+                for i, value in zip(indices, batch_values):
+                    values[i] = value
+        simulation = self.simulation
+        for i, (entity, action) in enumerate(self.triggered):
+            if values[i] is None:
+                values[i] = bool(action.trigger.evaluate(FormulaScope(simulation, entity)))
+        return values
+
+    def check_triggers(self, now: float):
+        """定时轮回调：condition型触发在条件成立且动作未执行时启动，event型和模型事件在条件由假变真时启动
+
+        先求出全部触发条件（求值只读状态），再按原顺序启动动作，批量与逐实体求值时启动顺序相同。
+        """
+        simulation = self.simulation
+        for (entity, action), value in zip(self.triggered, self.evaluate_triggers()):
+            if action.trigger_type == 'event':
+                key = (entity.id, action.id)
+                fire = value and not self.trigger_state.get(key, False)
+                self.trigger_state[key] = value
+            else:
+                fire = value
+            if fire and not entity.running_actions.get(action.id):
+                entity.start_process(entity.run_action(action.id))
+        
+        for interaction in self.model.interactions.values():
+            source = simulation.entities.get(interaction.source)
+            if interaction.trigger is None or source is None:
+                continue
+            value = bool(interaction.trigger.evaluate(FormulaScope(simulation, source)))
+            if value and not self.trigger_state.get(interaction.id, False):
+                self.send_interaction(source, interaction.message_type, dict(source.memory))
+            self.trigger_state[interaction.id] = value
+        
+        scope = FormulaScope(simulation)
+        for event in self.model.events.values():
+            if event.trigger is None:
+                continue
+            value = bool(event.trigger.evaluate(scope))
+            fire = value and not self.trigger_state.get(event.id, False)
+            self.trigger_state[event.id] = value
+            if not fire or (event.id in simulation.event_scheduler.events and not event.repeatable):
+                continue
+            simulation.event_scheduler.events[event.id] = True
+            log_and_collect('INFO', '触发事件: %s', event.name, msg_type=MessageType.EVENT_TRIGGERED)
+            for action_id in event.actions:
+                for entity in self.owners.get(action_id, ()):
+                    entity.start_process(entity.run_action(action_id))
+
+    def assign(self, entity: Any, target: str, value: Any):
+        """执行活动赋值：self.X / global.X / context.X / interaction.X / 局部变量"""
+        head, _, rest = target.partition('.')
+        if head == 'self' and rest:
+            if rest == 'position' and isinstance(value, dict):
+                value = {'x': value.get('x', 0.0), 'y': value.get('y', 0.0), 'z': value.get('z', 0.0)}
+            setattr(entity, rest, value)
+        elif head == 'global' and rest:
+            self.simulation.global_vars[rest] = value
+        elif head == 'interaction' and rest:
+            self.send_interaction(entity, rest, value)
+        else:
+            entity.memory[rest if head == 'context' and rest else target] = value
+
+    def send_interaction(self, entity: Any, message_type: str, value: Any):
+        message_type = message_type[4:] if message_type.startswith('int_') else message_type
+        target = self.interaction_targets.get(message_type)
+        if target is None:
+            logging.warning(f'交互 {message_type} 没有可投递的目标实体')
+            return
+        message = dict(value) if isinstance(value, dict) else {'value': value}
+        message.setdefault('source', entity.id)
+        message['type'] = message_type
+        self.simulation.message_bus.send(entity, target, message)
+
+# 静态关键路径分析（动作/活动图上卷积时长分布，不运行离散事件仿真）
+class DurationPMF:
+    """等间隔网格上的时长概率质量函数：pmf[k] 为时长取 k*step 的概率"""
+    __slots__ = ('pmf', 'step')
+
+    def __init__(self, pmf: np.ndarray, step: float):
+        self.pmf = pmf
+        self.step = step
+
+    @classmethod
+    def discrete(cls, values: List[float], weights: List[float], step: float) -> 'DurationPMF':
+        """离散取值按距离线性分摊到相邻两格，保持期望不变"""
+        position = np.asarray(values, dtype=np.float64) / step
+        lower = np.floor(position).astype(int)
+        fraction = position - lower
+        weights = np.asarray(weights, dtype=np.float64)
+        pmf = np.zeros(lower.max() + 2)
+        np.add.at(pmf, lower, weights * (1 - fraction))
+        np.add.at(pmf, lower + 1, weights * fraction)
+        return cls(pmf / pmf.sum(), step)
+
+    @classmethod
+    def point(cls, value: float, step: float) -> 'DurationPMF':
+        return cls.discrete([value], [1.0], step)
+
+    @classmethod
+    def from_distribution(cls, dist_type: str, params: Dict[str, float], step: float,
+                          truncation: tuple = (None, None)) -> 'DurationPMF':
+        """把时长分布离散到网格上（第k格为 [(k-0.5)*step, (k+0.5)*step)），截断按取值钳位处理"""
+        low, high = truncation
+        upper = TimeDistribution.upper_bound(dist_type, params)
+        samples = None
+        if upper is None:
+            # 没有解析分布函数时用固定种子的大样本经验分布
+            samples = np.sort(TimeDistribution.sample(dist_type, params, ANALYSIS_SAMPLE_SIZE,
+                                                      np.random.default_rng(0)))
+            upper = float(samples[-1])
+        if high is not None:
+            upper = min(upper, high)
+        if low is not None:
+            upper = max(upper, low)
+        edges = (np.arange(int(math.ceil(upper / step)) + 2) - 0.5) * step
+        if samples is None:
+            cdf = TimeDistribution.cdf(dist_type, params, edges)
+        else:
+            cdf = np.searchsorted(samples, edges, side='left') / len(samples)
+        if low is not None:
+            cdf[edges < low] = 0.0
+        if high is not None:
+            cdf[edges >= high] = 1.0
+        cdf[0], cdf[-1] = 0.0, 1.0
+        pmf = np.clip(np.diff(cdf), 0.0, None)
+        return cls(pmf / pmf.sum(), step)
+
+    def __add__(self, other: 'DurationPMF') -> 'DurationPMF':
+        """两段串行时长之和（独立），即卷积"""
+        return DurationPMF(np.convolve(self.pmf, other.pmf), self.step)
+
+    def maximum(self, other: 'DurationPMF') -> 'DurationPMF':
+        """两段并行时长的较大者（独立），分布函数相乘"""
+        size = max(len(self.pmf), len(other.pmf))
+        cdf = (np.cumsum(np.pad(self.pmf, (0, size - len(self.pmf))))
+               * np.cumsum(np.pad(other.pmf, (0, size - len(other.pmf)))))
+        return DurationPMF(np.diff(cdf, prepend=0.0), self.step)
+
+    @property
+    def mean(self) -> float:
+        return float(np.dot(np.arange(len(self.pmf)) * self.step, self.pmf))
+
+    @property
+    def variance(self) -> float:
+        values = np.arange(len(self.pmf)) * self.step
+        return max(0.0, float(np.dot(values ** 2, self.pmf)) - self.mean ** 2)
+
+    def quantile(self, q: float) -> float:
+        return float(np.searchsorted(np.cumsum(self.pmf), q - 1e-12) * self.step)
+
+def scenario_activity_durations(source_path: str = __file__) -> Dict[str, tuple]:
+    """读取生成代码中各activity函数的 TimeDistribution.generate 字面量参数，作为默认场景的活动时长"""
+    with open(source_path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    durations = {}
+    for node in tree.body:
+        if not (isinstance(node, ast.FunctionDef) and node.name.startswith('activity_')):
+            continue
+        for call in ast.walk(node):
+            if (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == 'generate'
+                    and isinstance(call.func.value, ast.Name) and call.func.value.id == 'TimeDistribution'):
+                try:
+                    dist_type, params = (ast.literal_eval(arg) for arg in call.args[:2])
+                except ValueError:
+                    continue
+                durations[node.name] = (dist_type, params, (None, None))
+                break
+    return durations
+
+class CriticalPathAnalyzer:
+    """动作链的期望时长、方差与关键路径
+
+    节点是模型中的动作；动作A的活动通过 interaction.X 发出交互、写入 self.V / global.G 触发其他动作，
+    或完成后启动本实体的后续动作时，得到边A→B。边的起点是动作内产生影响的位置（赋值在活动开始时生效，
+    SimPy代码块和子活动的写入按活动结束计），边上叠加信道时延（含重传）或触发检查的轮询等待。
+    路径时长为各段独立时长分布的卷积；多条路径中期望最长的为关键路径。
+    蒙特卡洛在同一个图上批量抽样，同一动作的同一活动在各路径间共用样本，给出最长路径
+    （全部完成）与最短路径（最先到达）的经验分布及各路径成为关键路径的频率。
+    """
+    def __init__(self, model: 'CompiledModel', step: float = ANALYSIS_TIME_STEP,
+                 durations: Dict[str, tuple] = None, channels: Dict[str, ChannelModel] = None):
+        self.model = model
+        self.step = step
+        self.durations = durations or {}  # {活动id: (分布, 参数, 截断)}，覆盖模型中的DelayTime
+        if channels is None:
+            channels = load_channel_models(model.source_path) if os.path.exists(model.source_path) else {}
+        self.channels = channels
+        self._activity_pmfs: Dict[str, DurationPMF] = {}
+        self._writes: Dict[str, List[tuple]] = {}
+        self.edges = self._build_edges()
+
+    @classmethod
+    def for_scenario(cls, model_path: str = INTERACTION_MODEL_FILE, step: float = ANALYSIS_TIME_STEP):
+        """默认场景：拓扑取自交互模型XML，活动时长取自生成代码"""
+        return cls(load_model(model_path), step, scenario_activity_durations())
+
+    # 图结构
+    def writes(self, activity_id: str) -> List[tuple]:
+        """活动的写入 [(interaction/global/self, 名字, 是否在活动结束时生效)]"""
+        if activity_id not in self._writes:
+            spec = self.model.activities[activity_id]
+            writes = []
+            for target, _ in spec.assignments:
+                head, _, rest = target.partition('.')
+                if head == 'interaction' and rest:
+                    writes.append((head, rest[4:] if rest.startswith('int_') else rest, False))
+                elif head in ('global', 'self') and rest:
+                    writes.append((head, rest, False))
+            if spec.process is not None:
+                writes.extend(('self', name, True) for name in spec.process.code.co_names)
+            for sub_activity in spec.sub_activities:
+                writes.extend((kind, name, True) for kind, name, _ in self.writes(sub_activity))
+            self._writes[activity_id] = writes
+        return self._writes[activity_id]
+
+    def _build_edges(self) -> Dict[str, List[tuple]]:
+        """{动作: [(目标动作, 活动序号, 是否在活动结束时, 时延)]}，时延为 None / ('channel', 消息类型) / ('poll',)"""
+        model = self.model
+        owners = defaultdict(list)
+        for entity in model.entities.values():
+            for action_id in entity.actions:
+                owners[action_id].append(entity)
+        # 各触发条件读取的名字
+        triggered = [(action.id, set(action.trigger.code.co_names)) for action in model.actions.values()
+                     if action.trigger is not None]
+        event_reads = [(event, set(event.trigger.code.co_names)) for event in model.events.values()
+                       if event.trigger is not None]
         
-        message = {
-            'type': 'fire_order',
-            'source': entity.id,
-            'target_position': str(fire_order.get('target', 'unknown')),
-            'fire_type': fire_order.get('type', 'suppression'),
-            'rounds_count': fire_order.get('rounds', 36),
-            'fire_order': fire_order
-        }
+        edges = defaultdict(list)
+        for action in model.actions.values():
+            entities = owners.get(action.id, [])
+            for index, activity_id in enumerate(action.activities):
+                for kind, name, at_end in self.writes(activity_id):
+                    if kind == 'interaction':
+                        interaction = model.interactions.get(name)
+                        target = model.entities.get(interaction.target) if interaction is not None else None
+                        handler = target.handlers.get(name) if target is not None else None
+                        if handler is not None:
+                            edges[action.id].append((handler.action_id, index, at_end, ('channel', name)))
+                        continue
+                    marker = 'global_' if kind == 'global' else 'self'
+                    for action_id, reads in triggered:
+                        if marker in reads and name in reads and (
+                                kind == 'global' or any(action_id in entity.actions for entity in entities)):
+                            edges[action.id].append((action_id, index, at_end, ('poll',)))
+                    if kind == 'global':
+                        for event, reads in event_reads:
+                            if 'global_' in reads and name in reads:
+                                edges[action.id].extend((action_id, index, at_end, ('poll',))
+                                                        for action_id in event.actions)
+                    else:
+                        for entity in entities:
+                            for _, action_id in entity.change_events.get(name, ()):
+                                edges[action.id].append((action_id, index, at_end, None))
+                        # 源实体状态触发的交互
+                        for interaction in model.interactions.values():
+                            if (interaction.trigger is None or name not in interaction.trigger.code.co_names
+                                    or not any(entity.id == interaction.source for entity in entities)):
+                                continue
+                            target = model.entities.get(interaction.target)
+                            handler = target.handlers.get(interaction.message_type) if target is not None else None
+                            if handler is not None:
+                                edges[action.id].append((handler.action_id, index, at_end,
+                                                         ('channel', interaction.message_type)))
+            for entity in entities:
+                edges[action.id].extend((followup, len(action.activities) - 1, True, None)
+                                        for followup in entity.followups if followup != action.id)
+        # 同一位置到同一目标的重复边只保留一条
+        return {action_id: list(dict.fromkeys(action_edges)) for action_id, action_edges in edges.items()}
+
+    def paths(self, source: str, target: str) -> List[list]:
+        """source/target 为动作id或活动id，返回简单路径 [(动作, 起始活动序号, 结束活动序号, 时延), ...]
+
+        结束活动序号为开区间；路径最后一段的时延为None。
+        """
+        model = self.model
+        def locate(item_id: str, is_target: bool) -> Dict[str, int]:
+            if item_id in model.actions:
+                return {item_id: len(model.actions[item_id].activities) if is_target else 0}
+            found = {action.id: action.activities.index(item_id) + (1 if is_target else 0)
+                     for action in model.actions.values() if item_id in action.activities}
+            if not found:
+                raise KeyError(f'模型中没有动作或活动 {item_id}')
+            return found
         
-        yield artillery.message_queue.put(message)
-        log_and_collect('INFO', f'{entity.name} 火力命令已发送', entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 5})
-    yield env.timeout(delay_time)
+        sources, targets = locate(source, False), locate(target, True)
+        paths = []
+        stack = [(action_id, start, [], {action_id}) for action_id, start in sources.items()]
+        while stack and len(paths) < ANALYSIS_MAX_PATHS:
+            action_id, start, path, visited = stack.pop()
+            if action_id in targets and targets[action_id] > start:
+                paths.append(path + [(action_id, start, targets[action_id], None)])
+                continue
+            for next_action, index, at_end, delay in self.edges.get(action_id, ()):
+                if index < start or next_action in visited:
+                    continue
+                stop = index + 1 if at_end else index
+                stack.append((next_action, 0, path + [(action_id, start, stop, delay)], visited | {next_action}))
+        return paths
 
-@enhanced_activity_wrapper
-def activity_prepare_guns(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：准备火炮"""
-    log_and_collect('INFO', f'{entity.name} 开始准备火炮', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    entity.fire_status = 'preparing'
-    
-    log_and_collect('INFO', f'{entity.name} 火炮装填中，{entity.attributes["guns_count"]}门火炮准备就绪', 
-                   entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 60})
-    
-    for i in range(6):
-        yield env.timeout(delay_time / 6)
-        progress = (i + 1) * 100 / 6
-        if i % 2 == 0:
-            log_and_collect('INFO', f'{entity.name} 准备进度: {progress:.0f}%', entity=entity.name)
+    # 时长分布
+    def activity_duration(self, activity_id: str) -> tuple:
+        spec = self.model.activities[activity_id]
+        return self.durations.get(activity_id, (spec.distribution, spec.parameters, spec.truncation))
 
-@enhanced_activity_wrapper
-def activity_fire_barrage(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：火力齐射"""
-    log_and_collect('WARNING', f'{entity.name} 开始火力齐射！', entity=entity.name,
-                   msg_type=MessageType.ALERT)
-    
-    yield env.process(check_pause(env, entity))
-    
-    entity.fire_status = 'firing'
-    rounds_fired = 36
-    entity.rounds_fired += rounds_fired
-    
-    if 'res_artillery_rounds' in resources:
-        ammo = resources['res_artillery_rounds']
-        if ammo.level >= rounds_fired:
-            yield ammo.get(rounds_fired)
-            logging.info(f'{entity.name} 消耗弹药 {rounds_fired} 发，剩余: {ammo.level}')
-            
-            message_collector.add_message(SimulationMessage(
-                type=MessageType.RESOURCE_UPDATE,
-                data={
-                    'resource_id': 'res_artillery_rounds',
-                    'level': ammo.level,
-                    'capacity': ammo.capacity,
-                    'utilization': ((ammo.capacity - ammo.level) / ammo.capacity) * 100
-                }
-            ))
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 120})
-    
-    for i in range(4):
-        yield env.timeout(delay_time / 4)
-        if i == 3:
-            logging.info(f'{entity.name} 齐射完成')
-    
-    entity.simulation.global_vars['StrikeCompleted'] = True
-    
-    log_and_collect('INFO', f'{entity.name} 火力齐射完成，共发射 {rounds_fired} 发炮弹', entity=entity.name)
-    
-    return {'rounds_fired': rounds_fired, 'result': '齐射完成'}
+    def activity_pmf(self, activity_id: str) -> DurationPMF:
+        """活动时长：子活动依次执行后再经过自身的延时（与解释器一致）"""
+        if activity_id not in self._activity_pmfs:
+            dist_type, params, truncation = self.activity_duration(activity_id)
+            pmf = DurationPMF.from_distribution(dist_type, params, self.step, truncation)
+            for sub_activity in self.model.activities[activity_id].sub_activities:
+                pmf = self.activity_pmf(sub_activity) + pmf
+            self._activity_pmfs[activity_id] = pmf
+        return self._activity_pmfs[activity_id]
 
-@enhanced_activity_wrapper
-def activity_observe_impact(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：观察打击效果"""
-    log_and_collect('INFO', f'{entity.name} 开始观察火力打击效果', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    damage_level = 0.7 + random.random() * 0.3
-    context['damage_level'] = damage_level
-    
-    damage_desc = '严重' if damage_level > 0.85 else ('中等' if damage_level > 0.7 else '轻微')
-    log_and_collect('INFO', f'{entity.name} 初步评估: 目标受损程度 - {damage_desc} ({damage_level:.2f})', 
-                   entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 60})
-    yield env.timeout(delay_time)
-    
-    return {'damage_level': damage_level, 'damage_desc': damage_desc}
+    def segment_activities(self, action_id: str, start: int, stop: int) -> tuple:
+        """路径在一个动作内经过的活动，以及是否并行执行"""
+        action = self.model.actions[action_id]
+        if action.execution_mode == 'parallel':
+            # 并行动作：完整执行取最长者，中途发出的影响只等待产生影响的那个活动
+            if start == 0 and stop == len(action.activities):
+                return action.activities, True
+            return action.activities[stop - 1:stop] if stop > start else [], False
+        return action.activities[start:stop], False
 
-@enhanced_activity_wrapper
-def activity_report_bda(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：报告毁伤评估"""
-    log_and_collect('INFO', f'{entity.name} 发送毁伤评估报告', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    damage_level = context.get('damage_level', 0.0)
-    entity.simulation.global_vars['DamageAssessment'] = damage_level
-    
-    message_collector.add_message(SimulationMessage(
-        type=MessageType.GLOBAL_VAR_UPDATE,
-        data={'DamageAssessment': damage_level}
-    ))
-    
-    if 'ent_command_post' in entity.simulation.entities:
-        command_post = entity.simulation.entities['ent_command_post']
-        
-        message = {
-            'type': 'bda_report',
-            'source': entity.id,
-            'damage_assessment': damage_level,
-            'target_status': '摧毁' if damage_level > 0.8 else '重创'
+    def channel_delay(self, message_type: str) -> tuple:
+        """信道时延的离散分布：基础时延 + 重传次数 × 重传超时（按送达条件化）"""
+        channel = self.channels.get(message_type) or ChannelModel(f'int_{message_type}', message_type)
+        retries = CHANNEL_MAX_RETRIES if channel.reliable else 0
+        p = channel.loss_probability
+        values = [channel.latency + k * channel.retry_timeout for k in range(retries + 1)]
+        weights = [(1 - p) * p ** k for k in range(retries + 1)]
+        return values, weights
+
+    def delay_pmf(self, delay: Optional[tuple]) -> DurationPMF:
+        if delay is None:
+            return DurationPMF.point(0.0, self.step)
+        if delay[0] == 'channel':
+            return DurationPMF.discrete(*self.channel_delay(delay[1]), self.step)
+        return DurationPMF.from_distribution('uniform', {'min': 0.0, 'max': MODEL_TRIGGER_INTERVAL}, self.step)
+
+    def path_pmf(self, path: list) -> DurationPMF:
+        total = DurationPMF.point(0.0, self.step)
+        for action_id, start, stop, delay in path:
+            activities, parallel = self.segment_activities(action_id, start, stop)
+            pmfs = [self.activity_pmf(activity_id) for activity_id in activities]
+            if parallel:
+                segment = functools.reduce(DurationPMF.maximum, pmfs)
+            else:
+                segment = functools.reduce(operator.add, pmfs, DurationPMF.point(0.0, self.step))
+            total = total + segment + self.delay_pmf(delay)
+        return total
+
+    @staticmethod
+    def describe(path: list) -> List[str]:
+        return [f'{action_id}[{start}:{stop}]' + (f' -({delay[0]}:{delay[1]})->' if delay and len(delay) > 1
+                                                  else ' -(poll)->' if delay else '')
+                for action_id, start, stop, delay in path]
+
+    def analyze(self, source: str, target: str, monte_carlo: int = 0, seed: int = None) -> Dict:
+        """source到target的期望时长、方差、分位数与关键路径；monte_carlo>0时附带图上的蒙特卡洛结果"""
+        paths = self.paths(source, target)
+        if not paths:
+            raise ValueError(f'{source} 与 {target} 之间没有动作链')
+        summaries = []
+        for path in paths:
+            pmf = self.path_pmf(path)
+            summaries.append({'path': self.describe(path), 'mean': pmf.mean, 'std': math.sqrt(pmf.variance),
+                              'pmf': pmf})
+        critical = max(summaries, key=lambda summary: summary['mean'])
+        pmf = critical['pmf']
+        result = {
+            'source': source, 'target': target, 'step': self.step,
+            'expected_duration': pmf.mean, 'variance': pmf.variance, 'std': math.sqrt(pmf.variance),
+            'percentiles': {f'p{int(q * 100)}': pmf.quantile(q) for q in (0.05, 0.5, 0.9, 0.95)},
+            'critical_path': critical['path'],
+            'paths': [{key: value for key, value in summary.items() if key != 'pmf'}
+                      for summary in sorted(summaries, key=lambda summary: -summary['mean'])]
         }
+        if monte_carlo:
+            result['monte_carlo'] = self.monte_carlo(paths, monte_carlo, seed)
+        return result
+
+    # 蒙特卡洛
+    def monte_carlo(self, paths: List[list], samples: int, seed: int = None) -> Dict:
+        rng = np.random.default_rng(seed)
+        drawn = {}
         
-        yield command_post.message_queue.put(message)
-    
-    log_and_collect('INFO', f'{entity.name} 毁伤评估报告已发送: 毁伤程度 {damage_level:.2%}', entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 10})
-    yield env.timeout(delay_time)
+        def activity_samples(activity_id: str) -> np.ndarray:
+            dist_type, params, (low, high) = self.activity_duration(activity_id)
+            values = TimeDistribution.sample(dist_type, params, samples, rng)
+            if low is not None or high is not None:
+                values = np.clip(values, low, high)
+            for sub_activity in self.model.activities[activity_id].sub_activities:
+                values = values + activity_samples(sub_activity)
+            return values
+        
+        def shared(key: tuple, factory: Callable) -> np.ndarray:
+            if key not in drawn:
+                drawn[key] = factory()
+            return drawn[key]
+        
+        totals = np.zeros((len(paths), samples))
+        for row, path in enumerate(paths):
+            for action_id, start, stop, delay in path:
+                activities, parallel = self.segment_activities(action_id, start, stop)
+                action = self.model.actions[action_id]
+                values = [shared((action_id, action.activities.index(activity_id)),
+                                 functools.partial(activity_samples, activity_id)) for activity_id in activities]
+                if values:
+                    totals[row] += np.max(values, axis=0) if parallel else np.sum(values, axis=0)
+                if delay is not None and delay[0] == 'channel':
+                    values, weights = self.channel_delay(delay[1])
+                    totals[row] += shared(('channel', action_id, stop, delay[1]), lambda: rng.choice(
+                        values, size=samples, p=np.asarray(weights) / sum(weights)))
+                elif delay is not None:
+                    totals[row] += shared(('poll', action_id, stop), lambda: rng.uniform(0.0, MODEL_TRIGGER_INTERVAL, samples))
+        
+        longest, first = totals.max(axis=0), totals.min(axis=0)
+        criticality = np.bincount(totals.argmax(axis=0), minlength=len(paths)) / samples
+        return {
+            'samples': samples,
+            'critical_mean': float(longest.mean()), 'critical_std': float(longest.std()),
+            'critical_percentiles': {f'p{q}': float(np.percentile(longest, q)) for q in (5, 50, 90, 95)},
+            'first_arrival_mean': float(first.mean()), 'first_arrival_std': float(first.std()),
+            'first_arrival_percentiles': {f'p{q}': float(np.percentile(first, q)) for q in (5, 50, 90, 95)},
+            'criticality': {' '.join(self.describe(path)): float(index)
+                            for path, index in zip(paths, criticality) if index > 0}
+        }
 
-@enhanced_activity_wrapper
-def activity_evaluate_results(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：评估结果"""
-    log_and_collect('INFO', f'{entity.name} 评估任务执行结果', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    damage_assessment = entity.simulation.global_vars.get('DamageAssessment', 0.0)
-    mission_success = damage_assessment >= 0.8
-    
-    context['mission_success'] = mission_success
-    
-    if mission_success:
-        log_and_collect('INFO', f'{entity.name} 任务成功！目标已被有效打击', entity=entity.name)
+def analyze_action_chain(source: str, target: str, model_path: str = None, monte_carlo: int = 0) -> Dict:
+    """命令行入口：输出source到target的关键路径分析结果"""
+    if model_path:
+        analyzer = CriticalPathAnalyzer(load_model(model_path))
     else:
-        log_and_collect('WARNING', f'{entity.name} 任务未完全达成，可能需要补充打击', entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 20})
-    yield env.timeout(delay_time)
-    
-    return {'mission_success': mission_success}
+        analyzer = CriticalPathAnalyzer.for_scenario()
+    result = analyzer.analyze(source, target, monte_carlo)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return result
 
-@enhanced_activity_wrapper
-def activity_send_cease_fire(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：发送停火命令"""
-    log_and_collect('INFO', f'{entity.name} 发送停火命令', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    if 'ent_artillery_battalion' in entity.simulation.entities:
-        artillery = entity.simulation.entities['ent_artillery_battalion']
+# 事件处理器
+class EventScheduler:
+    """事件调度器"""
+    def __init__(self, env: simpy.Environment, simulation):
+        self.env = env
+        self.simulation = simulation
+        self.events = {}
+
+    def start(self):
+        """启动事件监控"""
+        self.simulation.timer_wheel.register(self.monitor_conditions, period=1, owner=self)
+
+    def monitor_conditions(self, now: float):
+        """监控条件事件（定时轮每秒回调）"""
+        # 监控发现敌情事件
+        if self.simulation.global_vars.get('EnemyDetected', False):
+            if 'evt_enemy_detected' not in self.events:
+                self.events['evt_enemy_detected'] = True
+                log_and_collect('WARNING', '触发事件: 发现敌情', msg_type=MessageType.EVENT_TRIGGERED)
         
-        message = {
-            'type': 'cease_fire',
-            'source': entity.id
-        }
+        # 监控任务完成事件
+        damage = self.simulation.global_vars.get('DamageAssessment', 0.0)
+        if damage >= 0.8:
+            if 'evt_mission_complete' not in self.events:
+                self.events['evt_mission_complete'] = True
+                log_and_collect('INFO', '触发事件: 任务完成', msg_type=MessageType.EVENT_TRIGGERED)
+                
+                # 触发停火命令（由下达过射击命令的指挥所发出）
+                for command_post in self.simulation.entity_index.role(CommandPost.ROLE):
+                    if command_post.tasked_battalions:
+                        command_post.start_process(command_post.run_action('act_cease_fire_order'))
+
+def reinit_after_fork():
+    """在fork出的子进程中重建与线程相关的全局状态（父进程的其他线程不会被复制）"""
+    log_pipeline.reset_after_fork()
+    message_collector.lock = threading.Lock()
+    ws_manager.lock = threading.Lock()
+    ws_manager.clients = {}
+    metrics.lock = threading.Lock()
+    if trace_exporter is not None:
+        trace_exporter.reset_after_fork()
+    message_collector.update_log_interest([])
+
+# 检查点管理器（基于fork写时复制）
+@dataclass
+class Checkpoint:
+    """检查点 - 一个挂起的fork子进程"""
+    sim_time: float
+    pid: int
+    control_fd: int  # 向子进程发送恢复指令的管道写端
+
+class CheckpointManager:
+    """检查点管理器 - 按仿真时间间隔fork出挂起的子进程，支持回退到任意时刻
+
+    SimPy的生成器进程无法序列化，因此用fork的写时复制保存完整进程状态。
+    回退到时刻t时，唤醒不晚于t的最近检查点，由它快进到t并接管仿真（含WebSocket服务），
+    当前进程随即退役，等待所有仿真进程结束后退出。回退延迟不超过一个检查点间隔。
+    """
+    def __init__(self, simulation, interval: float = CHECKPOINT_INTERVAL,
+                 max_checkpoints: int = MAX_CHECKPOINTS):
+        self.simulation = simulation
+        self.interval = interval
+        self.max_checkpoints = max(1, max_checkpoints)
+        self.checkpoints: List[Checkpoint] = []
+        self.next_checkpoint_time = 0.0
+        self.enabled = interval > 0 and hasattr(os, 'fork')
         
-        yield artillery.message_queue.put(message)
-        log_and_collect('INFO', f'{entity.name} 停火命令已发送', entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 5})
-    yield env.timeout(delay_time)
+        if interval > 0 and not self.enabled:
+            logging.warning('当前平台不支持os.fork，检查点功能已关闭')
+        
+        # 会话管道：所有仿真进程都持有写端，全部退出后退役进程读到EOF
+        self._session_r = self._session_w = None
+        if self.enabled:
+            self._session_r, self._session_w = os.pipe()
 
-@enhanced_activity_wrapper
-def activity_stop_firing(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：停止射击"""
-    log_and_collect('INFO', f'{entity.name} 执行停火命令', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    entity.fire_status = 'ceased'
-    
-    log_and_collect('INFO', f'{entity.name} 已停止射击，共发射 {entity.rounds_fired} 发炮弹', entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 10})
-    yield env.timeout(delay_time)
+    def checkpoint_times(self) -> List[float]:
+        return [cp.sim_time for cp in self.checkpoints]
 
-@enhanced_activity_wrapper
-def activity_report_status(env: simpy.Environment, entity: Any, context: Dict) -> simpy.Event:
-    """活动：报告状态"""
-    log_and_collect('INFO', f'{entity.name} 报告当前状态', entity=entity.name)
-    
-    yield env.process(check_pause(env, entity))
-    
-    entity.fire_status = 'ready'
-    
-    remaining_ammo = 0
-    if 'res_artillery_rounds' in resources:
-        remaining_ammo = resources['res_artillery_rounds'].level
-    
-    log_and_collect('INFO', f'{entity.name} 状态: 就绪，剩余弹药: {remaining_ammo} 发', entity=entity.name)
-    
-    delay_time = TimeDistribution.generate('constant', {'value': 5})
-    yield env.timeout(delay_time)
-    
-    return {'status': 'ready', 'remaining_ammo': remaining_ammo}
+    def maybe_checkpoint(self):
+        """到达检查点时刻时创建检查点"""
+        if self.enabled and self.simulation.env.now >= self.next_checkpoint_time:
+            self.take_checkpoint()
 
-# 动作类定义
-class ActionBase:
-    """动作基类"""
-    def __init__(self, env: simpy.Environment, action_id: str, name: str, chinese_name: str):
-        self.env = env
-        self.id = action_id
-        self.name = name
-        self.chinese_name = chinese_name
-        self.interrupted = False
+    def take_checkpoint(self):
+        """fork一个挂起的子进程作为检查点"""
+        env = self.simulation.env
+        self.next_checkpoint_time = env.now + self.interval
+        read_fd, write_fd = os.pipe()
+        
+        pid = os.fork()
+        if pid == 0:
+            # 子进程：释放继承的WebSocket套接字后挂起，直到被唤醒或被丢弃
+            os.close(write_fd)
+            self._release_inherited_sockets()
+            target_time = self._wait_for_resume(read_fd)
+            self._resume(target_time)
+            return
+        
+        os.close(read_fd)
+        self.checkpoints.append(Checkpoint(sim_time=env.now, pid=pid, control_fd=write_fd))
+        
+        # 超过上限时丢弃最早的检查点
+        while len(self.checkpoints) > self.max_checkpoints:
+            self._discard(self.checkpoints.pop(0))
+        
+        logging.info(f'创建检查点: 仿真时间 {env.now:.1f}s, PID {pid}, 当前保留 {len(self.checkpoints)} 个')
 
-    def execute(self, entity: Any, context: Dict):
-        """执行动作"""
-        entity.update_status(action=self.id)
+    def rewind(self, target_time: float) -> bool:
+        """回退到指定仿真时刻；成功时当前进程退役，不会返回"""
+        if not self.enabled:
+            log_and_collect('WARNING', '检查点功能未开启，无法回退（设置CHECKPOINT_INTERVAL启用）')
+            return False
+        if target_time > self.simulation.env.now:
+            log_and_collect('WARNING', '回退目标时刻 %ss 晚于当前仿真时间 %.1fs', target_time, self.simulation.env.now)
+            return False
         
-        # 收集动作开始消息
-        message_collector.add_message(SimulationMessage(
-            type=MessageType.ACTION_STARTED,
-            entity_id=entity.id,
-            data={
-                'entity_name': entity.name,
-                'action': self.id,
-                'action_name': self.chinese_name
-            }
-        ))
+        # 选择不晚于目标时刻的最近一个仍然存活的检查点
+        candidates = sorted((cp for cp in self.checkpoints if cp.sim_time <= target_time),
+                            key=lambda cp: cp.sim_time, reverse=True)
+        chosen = None
+        for cp in candidates:
+            if self._is_alive(cp):
+                chosen = cp
+                break
+            self.checkpoints.remove(cp)
         
+        if chosen is None:
+            log_and_collect('WARNING', '没有可用的检查点早于 %ss，保留的检查点: %s', target_time, self.checkpoint_times())
+            return False
+        
+        log_and_collect('INFO', '回退到 %ss：从 %.1fs 检查点恢复并快进', target_time, chosen.sim_time)
+        
+        # 更晚的检查点属于被放弃的时间线
+        for cp in [cp for cp in self.checkpoints if cp.sim_time > chosen.sim_time]:
+            self.checkpoints.remove(cp)
+            self._discard(cp)
+        
+        # 先释放WebSocket端口并输出完本进程的日志（时间线文件不能被两个进程同时写），再唤醒检查点接管
+        self.simulation.stop_websocket()
+        log_pipeline.stop()
+        if trace_exporter is not None:
+            trace_exporter.flush()
         try:
-            yield self.env.process(self.do_execute(entity, context))
-            
-            # 收集动作完成消息
-            message_collector.add_message(SimulationMessage(
-                type=MessageType.ACTION_COMPLETED,
-                entity_id=entity.id,
-                data={
-                    'entity_name': entity.name,
-                    'action': self.id,
-                    'action_name': self.chinese_name
-                }
-            ))
-        except simpy.Interrupt:
-            self.interrupted = True
-            logging.info(f'动作 {self.chinese_name} 被中断')
+            os.write(chosen.control_fd, json.dumps({'target_time': target_time}).encode('utf-8') + b'\n')
+        except OSError as e:
+            logging.error(f'唤醒检查点失败: {e}')
+        self._retire()
+
+    def discard_all(self):
+        """丢弃所有检查点（仿真结束时调用）"""
+        for cp in self.checkpoints:
+            self._discard(cp)
+        self.checkpoints = []
+
+    def _is_alive(self, cp: Checkpoint) -> bool:
+        try:
+            os.kill(cp.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def _discard(self, cp: Checkpoint):
+        try:
+            os.close(cp.control_fd)
+        except OSError:
+            pass
+        try:
+            os.kill(cp.pid, signal.SIGKILL)
+            os.waitpid(cp.pid, 0)
+        except (OSError, ChildProcessError):
+            # 不是本进程的子进程（继承自回退前的进程），由其父进程回收
+            pass
+
+    def _release_inherited_sockets(self):
+        """用/dev/null替换继承的监听和客户端套接字，使端口能在父进程关闭后释放"""
+        fds = []
+        server = self.simulation.ws_server
+        for sock in (getattr(server, 'sockets', None) or []) if server is not None else []:
+            fds.append(sock.fileno())
+        for websocket in list(ws_manager.clients):
+            transport = getattr(websocket, 'transport', None)
+            sock = transport.get_extra_info('socket') if transport is not None else None
+            if sock is not None:
+                fds.append(sock.fileno())
+        
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in fds:
+            if fd >= 0:
+                try:
+                    os.dup2(devnull, fd)
+                except OSError:
+                    pass
+        os.close(devnull)
+
+    def _wait_for_resume(self, read_fd: int) -> float:
+        """挂起等待恢复指令；管道关闭说明检查点已被丢弃，直接退出"""
+        buffer = b''
+        while not buffer.endswith(b'\n'):
+            chunk = os.read(read_fd, 4096)
+            if not chunk:
+                os._exit(0)
+            buffer += chunk
+        os.close(read_fd)
+        return float(json.loads(buffer.decode('utf-8'))['target_time'])
 
-    def do_execute(self, entity: Any, context: Dict):
-        """具体执行逻辑 - 子类实现"""
-        yield self.env.timeout(0)
+    def _resume(self, target_time: float):
+        """检查点被唤醒：重建线程相关状态，重启WebSocket服务并快进到目标时刻"""
+        reinit_after_fork()
+        
+        simulation = self.simulation
+        checkpoint_time = simulation.env.now
+        if simulation.metrics_server is not None:
+            # fork继承了父进程指标服务的监听套接字，但没有服务线程
+            simulation.metrics_server.server.server_close()
+            simulation.metrics_server = None
+        simulation.setup_websocket()
+        simulation.fast_forward(target_time)
+        
+        log_and_collect('INFO', '已从 %.1fs 检查点恢复并快进到 %.1fs (PID %s)', checkpoint_time, simulation.env.now, os.getpid())
+        message_collector.add_message(SimulationMessage(
+            type=MessageType.SIMULATION_STATE_CHANGED,
+            data={
+                'state': 'rewound',
+                'checkpoint_time': checkpoint_time,
+                'target_time': target_time,
+                'current_time': simulation.env.now,
+                'checkpoints': self.checkpoint_times()
+            }
+        ))
 
-class ActionPatrol(ActionBase):
-    """动作：巡逻"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'Patrol', '巡逻')
+    def _retire(self):
+        """退役：关闭持有的管道，等所有仿真进程结束后退出"""
+        for cp in self.checkpoints:
+            try:
+                os.close(cp.control_fd)
+            except OSError:
+                pass
+        self.checkpoints = []
+        os.close(self._session_w)
+        while os.read(self._session_r, 4096):
+            pass
+        os._exit(0)
 
-    def do_execute(self, entity: Any, context: Dict):
-        """循环执行巡逻"""
-        while entity.patrol_status == 'patrolling' and not entity.enemy_contact:
-            yield self.env.process(activity_move_patrol(self.env, entity, context))
-            yield self.env.process(activity_scan_area(self.env, entity, context))
-            yield self.env.process(check_pause(self.env, entity))
+# 断点管理（状态变化时求值的编译断点）
+class ObservableDict(dict):
+    """写入时回调的字典，用于在全局变量变化时触发断点求值"""
+    __slots__ = ('on_change',)
 
-class ActionReportEnemy(ActionBase):
-    """动作：报告敌情"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'ReportEnemy', '报告敌情')
+    def __init__(self, *args, on_change: Callable = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_change = on_change
 
-    def do_execute(self, entity: Any, context: Dict):
-        yield self.env.process(activity_gather_intel(self.env, entity, context))
-        yield self.env.process(activity_send_enemy_report(self.env, entity, context))
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
 
-class ActionAssessDamage(ActionBase):
-    """动作：评估毁伤"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'AssessDamage', '评估毁伤')
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
 
-    def do_execute(self, entity: Any, context: Dict):
-        yield self.env.process(activity_observe_impact(self.env, entity, context))
-        yield self.env.process(activity_report_bda(self.env, entity, context))
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
 
-class ActionProcessIntel(ActionBase):
-    """动作：处理情报"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'ProcessIntel', '处理情报')
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
 
-    def do_execute(self, entity: Any, context: Dict):
-        yield self.env.process(activity_analyze_report(self.env, entity, context))
-        yield self.env.process(activity_make_decision(self.env, entity, context))
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
 
-class ActionIssueFireOrder(ActionBase):
-    """动作：下达开火命令"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'IssueFireOrder', '下达开火命令')
+    def pop(self, key, *args):
+        value = super().pop(key, *args)
+        self._changed()
+        return value
 
-    def do_execute(self, entity: Any, context: Dict):
-        yield self.env.process(activity_prepare_fire_order(self.env, entity, context))
-        yield self.env.process(activity_transmit_order(self.env, entity, context))
+@dataclass
+class Breakpoint:
+    """断点：condition 为表达式断点，activity 为Activity开始断点"""
+    bp_id: int
+    kind: str
+    spec: str
+    entity_id: Optional[str] = None
+    once: bool = False
+    hits: int = 0
+    code: Any = None
+    last_value: bool = False
 
-class ActionCeaseFireOrder(ActionBase):
-    """动作：下达停火命令"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'CeaseFireOrder', '下达停火命令')
+    def to_dict(self) -> Dict:
+        return {'id': self.bp_id, 'kind': self.kind, 'spec': self.spec,
+                'entity': self.entity_id, 'once': self.once, 'hits': self.hits}
 
-    def do_execute(self, entity: Any, context: Dict):
-        yield self.env.process(activity_evaluate_results(self.env, entity, context))
-        yield self.env.process(activity_send_cease_fire(self.env, entity, context))
+class BreakpointManager:
+    """断点管理器
 
-class ActionExecuteFireMission(ActionBase):
-    """动作：执行火力任务"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'ExecuteFireMission', '执行火力任务')
+    条件断点在添加时编译一次，只在全局变量或实体状态变量写入时求值，
+    由假变真时命中；Activity断点在对应Activity开始时命中。
+    命中后触发停止事件，使 run() 在当前仿真时刻返回。
+    """
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.breakpoints: Dict[int, Breakpoint] = {}
+        self.conditions: List[Breakpoint] = []
+        self.activities: Dict[str, List[Breakpoint]] = {}
+        self.next_id = 1
+        self.hit = None
+        self.stop_event = None
+        self.evaluating = False
 
-    def do_execute(self, entity: Any, context: Dict):
-        rounds_needed = context.get('fire_order', {}).get('rounds', 36)
-        if 'res_artillery_rounds' in resources:
-            if resources['res_artillery_rounds'].level < rounds_needed:
-                log_and_collect('ERROR', f'{entity.name} 弹药不足，需要 {rounds_needed} 发，剩余 {resources["res_artillery_rounds"].level} 发', 
-                               entity=entity.name)
-                return
-        
-        yield self.env.process(activity_prepare_guns(self.env, entity, context))
-        yield self.env.process(activity_fire_barrage(self.env, entity, context))
+    @property
+    def watching(self) -> bool:
+        return bool(self.conditions)
 
-class ActionCeaseFire(ActionBase):
-    """动作：停止射击"""
-    def __init__(self, env: simpy.Environment, action_id: str):
-        super().__init__(env, action_id, 'CeaseFire', '停止射击')
+    def add(self, kind: str, spec: str, entity_id: str = None, once: bool = False) -> Breakpoint:
+        bp = Breakpoint(self.next_id, kind, spec, entity_id=entity_id, once=once)
+        if kind == 'condition':
+            bp.code = compile(spec, f'<breakpoint {bp.bp_id}>', 'eval')
+            bp.last_value = self._evaluate(bp)
+            self.conditions.append(bp)
+        elif kind == 'activity':
+            bp.spec = spec[len('activity_'):] if spec.startswith('activity_') else spec
+            self.activities.setdefault(bp.spec, []).append(bp)
+        else:
+            raise ValueError(f'未知的断点类型: {kind}')
+        self.breakpoints[bp.bp_id] = bp
+        self.next_id += 1
+        return bp
 
-    def do_execute(self, entity: Any, context: Dict):
-        yield self.env.process(activity_stop_firing(self.env, entity, context))
-        yield self.env.process(activity_report_status(self.env, entity, context))
+    def remove(self, bp_id: int) -> bool:
+        bp = self.breakpoints.pop(bp_id, None)
+        if bp is None:
+            return False
+        if bp.kind == 'condition':
+            self.conditions.remove(bp)
+        else:
+            self.activities[bp.spec].remove(bp)
+            if not self.activities[bp.spec]:
+                del self.activities[bp.spec]
+        return True
 
-# 事件处理器
-class EventScheduler:
-    """事件调度器"""
-    def __init__(self, env: simpy.Environment, simulation):
-        self.env = env
+    def clear(self):
+        self.breakpoints.clear()
+        self.conditions.clear()
+        self.activities.clear()
+
+    def list(self) -> List[Dict]:
+        return [bp.to_dict() for bp in self.breakpoints.values()]
+
+    def _evaluate(self, bp: Breakpoint) -> bool:
+        simulation = self.simulation
+        namespace = ChainMap({'global_vars': simulation.global_vars, 'entities': simulation.entities,
+                              'time': simulation.env.now}, simulation.global_vars)
+        try:
+            return bool(eval(bp.code, {'__builtins__': {}}, namespace))
+        except Exception:
+            return False
+
+    def notify_state_change(self):
+        """全局变量或实体状态变量被写入"""
+        if self.evaluating:
+            return
+        self.evaluating = True
+        try:
+            for bp in list(self.conditions):
+                value = self._evaluate(bp)
+                if value and not bp.last_value:
+                    self._trigger(bp, {})
+                bp.last_value = value
+        finally:
+            self.evaluating = False
+
+    def notify_activity_start(self, activity_name: str, entity: Any):
+        for bp in list(self.activities.get(activity_name, ())):
+            if bp.entity_id is None or bp.entity_id == getattr(entity, 'id', None):
+                self._trigger(bp, {'activity_name': activity_name, 'entity': getattr(entity, 'id', None)})
+
+    def _trigger(self, bp: Breakpoint, detail: Dict):
+        bp.hits += 1
+        self.hit = dict(bp.to_dict(), time=self.simulation.env.now, **detail)
+        if bp.once:
+            self.remove(bp.bp_id)
+        if self.stop_event is not None and not self.stop_event.triggered:
+            self.stop_event.succeed()
+
+    def consume_hit(self) -> Optional[Dict]:
+        hit, self.hit = self.hit, None
+        return hit
+
+    def run(self, until_time: float):
+        """推进到 until_time，若中途命中断点则在命中时刻停止
+
+        与 env.run(until=until_time) 相同，到达时刻的停止事件为URGENT优先级，恰好在 until_time 的事件留到下一次运行。
+        """
+        env = self.simulation.env
+        if not self.breakpoints:
+            env.run(until=until_time)
+            return
+        at = urgent_event(env, max(0.0, until_time - env.now))
+        at.callbacks.append(simpy.core.StopSimulation.callback)
+        self.stop_event = env.event()
+        try:
+            env.run(until=self.stop_event)
+        finally:
+            self.stop_event = None
+            # 因断点提前停止时，到达时刻的停止事件仍在事件表中，去掉其回调使之成为空事件
+            if at.callbacks and simpy.core.StopSimulation.callback in at.callbacks:
+                at.callbacks.remove(simpy.core.StopSimulation.callback)
+
+# 运行时诊断（经WebSocket command通道按需进行cProfile性能剖析和tracemalloc内存快照）
+MEMORY_SUBSYSTEMS = {
+    'collector': ('LazyLogRecord', 'SimulationMessage', 'MessageCollector', 'log_and_collect'),
+    'timeline_logger': ('ActivityTimelineLogger',),
+    'client_queues': ('ClientInfo', 'WebSocketManager', 'ws_send', 'log_push_task', 'metrics_publish_task'),
+}
+DIAGNOSTIC_COMMANDS = ('profile_start', 'profile_stop', 'memory_snapshot', 'memory_diff', 'memory_stop')
+
+class RuntimeDiagnostics:
+    """性能剖析在处理命令的仿真线程上进行；内存分配按调用栈中最近的本模块帧归属到子系统"""
+    PROFILE_SORT_KEYS = {'ncalls': 1, 'tottime': 2, 'cumtime': 3}
+
+    def __init__(self, simulation: 'EATISimulation', source_path: str = __file__):
         self.simulation = simulation
-        self.events = {}
+        self.source_path = os.path.abspath(source_path)
+        self.profile = None
+        self.profile_start = None  # (仿真时间, 墙钟时间, SimPy事件数)
+        self.snapshots: Dict[str, tuple] = {}  # 名称 → (快照, 摘要)，按拍摄顺序
+        self._ranges = None
 
-    def start(self):
-        """启动事件监控"""
-        self.env.process(self.monitor_conditions())
+    # 性能剖析
+    def start_profile(self) -> Dict:
+        if self.profile is not None:
+            raise ValueError('性能剖析已在进行中')
+        self.profile = cProfile.Profile()
+        self.profile_start = (self.simulation.env.now, time.perf_counter(), simpy_events_total.values.get('', 0))
+        self.profile.enable()
+        return {'sim_time': self.simulation.env.now}
 
-    def monitor_conditions(self):
-        """监控条件事件"""
-        while True:
-            yield self.env.timeout(1)
-            
-            # 监控发现敌情事件
-            if self.simulation.global_vars.get('EnemyDetected', False):
-                if 'evt_enemy_detected' not in self.events:
-                    self.events['evt_enemy_detected'] = True
-                    log_and_collect('WARNING', '触发事件: 发现敌情', msg_type=MessageType.EVENT_TRIGGERED)
-            
-            # 监控任务完成事件
-            damage = self.simulation.global_vars.get('DamageAssessment', 0.0)
-            if damage >= 0.8:
-                if 'evt_mission_complete' not in self.events:
-                    self.events['evt_mission_complete'] = True
-                    log_and_collect('INFO', '触发事件: 任务完成', msg_type=MessageType.EVENT_TRIGGERED)
-                    
-                    # 触发停火命令
-                    if 'ent_command_post' in self.simulation.entities:
-                        command_post = self.simulation.entities['ent_command_post']
-                        self.env.process(command_post.run_action('act_cease_fire_order'))
+    def stop_profile(self, top: int = PROFILE_TOP_N, sort: str = 'tottime') -> Dict:
+        if self.profile is None:
+            raise ValueError('性能剖析未开始')
+        if sort not in self.PROFILE_SORT_KEYS:
+            raise ValueError(f'不支持的排序字段: {sort}，可选 {sorted(self.PROFILE_SORT_KEYS)}')
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+        sim_start, wall_start, events_start = self.profile_start
+        stats = pstats.Stats(profile)
+        index = self.PROFILE_SORT_KEYS[sort]
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][index], reverse=True)[:top]
+        return {
+            'sort': sort,
+            'sim_time': [sim_start, self.simulation.env.now],
+            'wall_time': time.perf_counter() - wall_start,
+            'simpy_events': simpy_events_total.values.get('', 0) - events_start,
+            'total_calls': stats.total_calls,
+            'total_time': stats.total_tt,
+            'functions': [{'function': function, 'file': filename, 'line': line, 'ncalls': ncalls,
+                           'primitive_calls': primitive_calls, 'tottime': tottime, 'cumtime': cumtime,
+                           'percall': cumtime / ncalls if ncalls else 0.0}
+                          for (filename, line, function), (primitive_calls, ncalls, tottime, cumtime, _) in rows]
+        }
+
+    # 内存快照
+    def _subsystem_of(self, lineno: int) -> str:
+        """本模块某行所属的子系统（顶层类/函数的行范围取自源码）"""
+        if self._ranges is None:
+            with open(self.source_path, encoding='utf-8') as f:
+                tree = ast.parse(f.read())
+            owners = {name: subsystem for subsystem, names in MEMORY_SUBSYSTEMS.items() for name in names}
+            self._ranges = sorted((node.lineno, node.end_lineno, owners[node.name]) for node in tree.body
+                                  if getattr(node, 'name', None) in owners)
+        index = bisect.bisect_right(self._ranges, (lineno, float('inf'))) - 1
+        if index >= 0 and self._ranges[index][0] <= lineno <= self._ranges[index][1]:
+            return self._ranges[index][2]
+        return 'simulation'
+
+    def attribute(self, snapshot: tracemalloc.Snapshot) -> Dict[str, Dict]:
+        """按子系统汇总分配；调用栈中没有本模块帧的分配归入other"""
+        subsystems = defaultdict(lambda: {'size': 0, 'count': 0})
+        for stat in snapshot.statistics('traceback'):
+            subsystem = 'other'
+            for frame in reversed(stat.traceback):
+                if frame.filename == self.source_path:
+                    subsystem = self._subsystem_of(frame.lineno)
+                    break
+            subsystems[subsystem]['size'] += stat.size
+            subsystems[subsystem]['count'] += stat.count
+        return dict(subsystems)
+
+    def buffer_sizes(self) -> Dict[str, int]:
+        """各子系统缓冲区的条目数（与内存归属对照）"""
+        with message_collector.lock:
+            sizes = {'collector_messages': len(message_collector.messages),
+                     'collector_log_buffer': len(message_collector.log_messages_buffer)}
+        sizes['timeline_records'] = len(activity_logger.timeline_records)
+        sizes['timeline_executions'] = sum(len(stats['executions']) for stats in activity_logger.activity_stats.values())
+        with ws_manager.lock:
+            clients = list(ws_manager.clients)
+        sizes['ws_clients'] = len(clients)
+        sizes['ws_client_write_buffer_bytes'] = sum(
+            transport.get_write_buffer_size() for transport in (getattr(ws, 'transport', None) for ws in clients)
+            if transport is not None)
+        return sizes
+
+    def take_snapshot(self, name: str = None, top: int = PROFILE_TOP_N) -> Dict:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        name = name or f'snapshot_{len(self.snapshots) + 1}'
+        current, peak = tracemalloc.get_traced_memory()
+        summary = {
+            'name': name,
+            'sim_time': self.simulation.env.now,
+            'taken_at': datetime.now().isoformat(),
+            'tracing_started': started,  # 刚开始跟踪时只包含此后的分配
+            'traced_memory': {'current': current, 'peak': peak},
+            'subsystems': self.attribute(snapshot),
+            'buffers': self.buffer_sizes(),
+            'top': [{'location': f'{stat.traceback[-1].filename}:{stat.traceback[-1].lineno}',
+                     'size': stat.size, 'count': stat.count} for stat in snapshot.statistics('lineno')[:top]]
+        }
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = (snapshot, summary)
+        while len(self.snapshots) > MEMORY_SNAPSHOT_LIMIT:
+            self.snapshots.pop(next(iter(self.snapshots)))
+        return summary
+
+    def diff(self, base: str, target: str = None, top: int = PROFILE_TOP_N) -> Dict:
+        if target is None and self.snapshots:
+            target = next(reversed(self.snapshots))
+        missing = [name for name in (base, target) if name not in self.snapshots]
+        if missing:
+            raise ValueError(f'没有内存快照: {missing}，现有 {list(self.snapshots)}')
+        (base_snapshot, base_summary), (target_snapshot, target_summary) = self.snapshots[base], self.snapshots[target]
+        subsystems = {}
+        for subsystem in set(base_summary['subsystems']) | set(target_summary['subsystems']):
+            before = base_summary['subsystems'].get(subsystem, {'size': 0, 'count': 0})
+            after = target_summary['subsystems'].get(subsystem, {'size': 0, 'count': 0})
+            subsystems[subsystem] = {'size': after['size'], 'size_diff': after['size'] - before['size'],
+                                     'count_diff': after['count'] - before['count']}
+        return {
+            'base': base, 'target': target,
+            'sim_time': [base_summary['sim_time'], target_summary['sim_time']],
+            'subsystems': subsystems,
+            'buffers': {key: value - base_summary['buffers'].get(key, 0)
+                        for key, value in target_summary['buffers'].items()},
+            'top': [{'location': f'{stat.traceback[-1].filename}:{stat.traceback[-1].lineno}',
+                     'size_diff': stat.size_diff, 'count_diff': stat.count_diff, 'size': stat.size}
+                    for stat in target_snapshot.compare_to(base_snapshot, 'lineno')[:top]]
+        }
+
+    def stop_memory(self) -> Dict:
+        dropped = list(self.snapshots)
+        self.snapshots.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {'dropped_snapshots': dropped}
+
+    def execute(self, command: Dict) -> tuple:
+        """执行诊断命令，返回 (消息类型, 结果)"""
+        cmd_type = command.get('type')
+        top = int(command.get('top', PROFILE_TOP_N))
+        if cmd_type == 'profile_start':
+            return MessageType.PROFILE_RESULT, self.start_profile()
+        if cmd_type == 'profile_stop':
+            return MessageType.PROFILE_RESULT, self.stop_profile(top, command.get('sort', 'tottime'))
+        if cmd_type == 'memory_snapshot':
+            return MessageType.MEMORY_REPORT, self.take_snapshot(command.get('name'), top)
+        if cmd_type == 'memory_diff':
+            return MessageType.MEMORY_REPORT, self.diff(command.get('base'), command.get('target'), top)
+        return MessageType.MEMORY_REPORT, self.stop_memory()
 
 # 主仿真类（支持日志推送版）
 class EATISimulation:
     """主仿真控制器 - 支持日志推送版"""
-    def __init__(self):
-        self.env = simpy.Environment()
+    def __init__(self, flat_execution: bool = None):
+        self.env = create_environment(flat_execution=flat_execution)
         self.env.simulation = self
+        if METRICS_ENABLED:
+            count_simpy_steps(self.env)
+            env = self.env
+            metrics.gauge('simpy_pending_events', 'SimPy事件表中待处理的事件数',
+                          collector=lambda: {'': pending_event_count(env)})
         self.entities = {}
+        self.entity_index = EntityIndex()
+        self.scenario = None
+        self.model_runtime = None
+        self.path_analyzer = None
+        self.diagnostics = RuntimeDiagnostics(self)
+        
+        # 实体状态存储与空间索引（己方单位与敌方目标分别建立网格）
+        self.entity_state = EntityStateStore()
+        self.terrain = TerrainGrid.load(TERRAIN_FILE)
+        self.los = LineOfSightService(self.terrain)
+        self.kinematics = KinematicsSystem(self)
+        self.unit_index = SpatialGrid(locator=self.entity_state.locate)
+        self.hostile_index = SpatialGrid()
+        self.targets = {}
+        self.fire_effects = FireEffectsModel()
+        self.message_bus = MessageBus.from_xml(self.env)
+        self.state_monitor = StateMonitor(self.env)
         self.resources = {}
         self.actions = {}
         self.global_vars = {}
@@ -1437,41 +6530,116 @@ class EATISimulation:
         self.ws_server = None
         self.ws_thread = None
         self.ws_loop = None
+        self.metrics_server = None
         
         # 状态跟踪
         self.start_time = None
         self.last_message_check = datetime.now()
         
+        # 断点（全局变量写入时求值条件断点）
+        self.breakpoints = BreakpointManager(self)
+        self.background_processes = set()
+        
+        # 周期回调共用的定时轮
+        self.timer_wheel = TimerWheel(self.env)
+        self.start_background(self.timer_wheel.run())
+        
         # 初始化全局变量
-        self.global_vars = {
+        self.global_vars = ObservableDict({
             'EnemyDetected': False,
             'StrikeCompleted': False,
             'DamageAssessment': 0.0
-        }
+        }, on_change=self._on_state_change)
         
         # 命令队列
         self.command_queue = queue.Queue()
         
         # 事件调度器
         self.event_scheduler = EventScheduler(self.env, self)
+        
+        # 检查点管理
+        self.checkpoints = CheckpointManager(self)
+
+    def _on_state_change(self):
+        if self.breakpoints.watching:
+            self.breakpoints.notify_state_change()
+
+    def start_background(self, generator) -> simpy.Process:
+        """启动周期性监视进程；按事件单步时跳过这类进程的事件"""
+        process = self.env.process(generator)
+        self.background_processes.add(process)
+        return process
 
-    def setup(self):
-        """设置仿真组件"""
+    def setup(self, enable_websocket: bool = True, scenario: 'ScenarioSpec' = None, model: 'CompiledModel' = None):
+        """设置仿真组件；指定编译模型时由模型解释构建资源、实体和动作"""
         log_and_collect('INFO', '开始初始化侦察-火力打击仿真环境...')
+        global resources, actions
+        
+        if model is not None:
+            self.setup_model(model)
+        else:
+            self.setup_scenario(scenario)
+        
+        # 启动实体进程
+        for entity in self.entities.values():
+            if hasattr(entity, 'start'):
+                entity.start()
+        
+        # 启动运动学子系统和事件调度器（解释模型的事件由模型运行时检查）
+        self.kinematics.start()
+        if self.model_runtime is not None:
+            self.model_runtime.start()
+        else:
+            self.event_scheduler.start()
+        
+        # 启动WebSocket服务器（批量/分支运行时不需要）
+        if enable_websocket:
+            self.setup_websocket()
+        
+        log_and_collect('INFO', '仿真环境初始化完成')
+        
+        # 记录初始状态变化
+        message_collector.add_message(SimulationMessage(
+            type=MessageType.SIMULATION_STATE_CHANGED,
+            data={'state': self.run_state.value, 'mode': RUN_MODE}
+        ))
+
+    def setup_model(self, model: 'CompiledModel'):
+        """由编译模型创建资源、实体和动作"""
+        global resources, actions
+        self.model_runtime = ModelRuntime(self, model)
+        resources = self.model_runtime.create_resources()
+        self.resources = resources
+        self.entities.update(self.model_runtime.instantiate())
+        self.entity_index.rebuild(self.entities, self.unit_index)
+        self.message_bus.build_routes(self.entities)
+        actions = self.model_runtime.create_actions()
+        self.actions = actions
+        log_and_collect('INFO', '已加载模型 %s：%s个实体，%s个动作，%s个活动', model.source_path,
+                       len(model.entities), len(model.actions), len(model.activities))
+
+    def setup_scenario(self, scenario: 'ScenarioSpec' = None):
+        """按场景模板创建资源、实体和动作（生成代码的固定场景）"""
+        global resources, actions
+        if scenario is None:
+            scenario = ScenarioSpec.from_string(SCENARIO_UNITS) if SCENARIO_UNITS else ScenarioSpec.default()
+        self.scenario = scenario
+        declare_entity_schema()
         
         # 创建资源
-        global resources
         resources = {}
-        resources['res_artillery_rounds'] = simpy.Container(self.env, capacity=200, init=180)
+        resources['res_artillery_rounds'] = MonitoredContainer(self.env, capacity=200, init=180)
         self.resources = resources
         
-        # 创建实体
-        self.entities['ent_command_post'] = CommandPost(self.env, 'ent_command_post', self)
-        self.entities['ent_artillery_battalion'] = ArtilleryBattalion(self.env, 'ent_artillery_battalion', self)
-        self.entities['ent_recon_squad'] = ReconSquad(self.env, 'ent_recon_squad', self)
+        # 按场景模板创建实体
+        self.entities.update(self.scenario.instantiate(self))
+        self.entity_index.rebuild(self.entities, self.unit_index)
+        self.message_bus.build_routes(self.entities)
+        for target in self.scenario.create_targets():
+            self.targets[target.id] = target
+            self.hostile_index.update(target.id, target.position['x'], target.position['y'], target)
         
         # 创建动作
-        global actions
         actions = {}
         actions['act_patrol'] = ActionPatrol(self.env, 'act_patrol')
         actions['act_report_enemy'] = ActionReportEnemy(self.env, 'act_report_enemy')
@@ -1482,25 +6650,6 @@ class EATISimulation:
         actions['act_execute_fire_mission'] = ActionExecuteFireMission(self.env, 'act_execute_fire_mission')
         actions['act_cease_fire'] = ActionCeaseFire(self.env, 'act_cease_fire')
         self.actions = actions
-        
-        # 启动实体进程
-        for entity in self.entities.values():
-            if hasattr(entity, 'start'):
-                entity.start()
-        
-        # 启动事件调度器
-        self.event_scheduler.start()
-        
-        # 启动WebSocket服务器
-        self.setup_websocket()
-        
-        log_and_collect('INFO', '仿真环境初始化完成')
-        
-        # 记录初始状态变化
-        message_collector.add_message(SimulationMessage(
-            type=MessageType.SIMULATION_STATE_CHANGED,
-            data={'state': self.run_state.value, 'mode': RUN_MODE}
-        ))
 
     def setup_websocket(self):
         """设置WebSocket服务器"""
@@ -1532,10 +6681,10 @@ class EATISimulation:
             
             # 添加客户端
             client_info = ws_manager.add_client(websocket, log_push_interval)
-            client_info.log_level_filter = log_level
+            ws_manager.set_log_level_filter(client_info, log_level)
             
             # 发送欢迎消息
-            await websocket.send(json.dumps({
+            await ws_send(websocket, json.dumps({
                 'type': 'welcome',
                 'data': {
                     'simulation_name': '侦察-火力打击仿真',
@@ -1553,7 +6702,11 @@ class EATISimulation:
             try:
                 async for message in websocket:
                     data = json.loads(message)
+                    command_start = time.perf_counter()
                     await self.handle_ws_message(websocket, data)
+                    if trace_exporter is not None:
+                        trace_exporter.server_span('ws_command', str(data.get('type')), command_start,
+                                                   time.perf_counter(), {'command': data.get('command')})
             except websockets.exceptions.ConnectionClosed:
                 pass
             finally:
@@ -1562,7 +6715,9 @@ class EATISimulation:
         async def start_server():
             """启动WebSocket服务器"""
             self.ws_server = await websockets.serve(handle_client, WS_HOST, WS_PORT)
-            log_and_collect('INFO', f'WebSocket服务器启动: {WS_HOST}:{WS_PORT}')
+            log_and_collect('INFO', 'WebSocket服务器启动: %s:%s', WS_HOST, WS_PORT)
+            if METRICS_ENABLED:
+                asyncio.ensure_future(metrics_publish_task())
 
         def run_ws_server():
             """在独立线程中运行WebSocket服务器"""
@@ -1574,17 +6729,55 @@ class EATISimulation:
 
         self.ws_thread = threading.Thread(target=run_ws_server, daemon=True)
         self.ws_thread.start()
+        self.setup_metrics_server()
         time.sleep(0.5)
 
+    def setup_metrics_server(self):
+        """在本地端口启动Prometheus指标服务"""
+        if not METRICS_ENABLED or not METRICS_PORT or self.metrics_server is not None:
+            return
+        try:
+            self.metrics_server = MetricsHTTPServer(metrics)
+        except OSError as e:
+            logging.warning(f'Prometheus指标服务启动失败（端口 {METRICS_PORT}）: {e}')
+            return
+        self.metrics_server.start()
+
+    def stop_websocket(self, timeout: float = 5.0):
+        """关闭WebSocket服务器（及指标服务）并停止其事件循环"""
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if not self.ws_loop:
+            return
+        
+        async def close_server():
+            if self.ws_server is not None:
+                self.ws_server.close()
+                await self.ws_server.wait_closed()
+        
+        try:
+            asyncio.run_coroutine_threadsafe(close_server(), self.ws_loop).result(timeout=timeout)
+        except Exception as e:
+            logging.warning(f'关闭WebSocket服务器超时或失败: {e}')
+        self.ws_loop.call_soon_threadsafe(self.ws_loop.stop)
+        if self.ws_thread:
+            self.ws_thread.join(timeout=timeout)
+        self.ws_server = None
+        self.ws_loop = None
+
     async def handle_ws_message(self, websocket, data: Dict):
         """处理WebSocket消息 - 支持日志配置"""
         msg_type = data.get('type')
         
         if msg_type == 'command':
-            # 处理控制命令
+            # 处理控制命令（诊断命令的结果回复给发出命令的客户端）
             command = data.get('command')
-            self.command_queue.put(command)
-            await websocket.send(json.dumps({
+            if isinstance(command, dict) and command.get('type') in DIAGNOSTIC_COMMANDS:
+                self.command_queue.put(dict(command, reply_to=websocket))
+            else:
+                self.command_queue.put(command)
+            await ws_send(websocket, json.dumps({
                 'type': 'ack',
                 'command': command
             }))
@@ -1604,7 +6797,7 @@ class EATISimulation:
                 if 'level' in config:
                     level = config['level']
                     if level in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
-                        client_info.log_level_filter = level
+                        ws_manager.set_log_level_filter(client_info, level)
                 
                 # 更新每次推送的最大日志数
                 if 'max_logs' in config:
@@ -1616,7 +6809,7 @@ class EATISimulation:
                     client_info.push_task.cancel()
                     client_info.push_task = asyncio.create_task(log_push_task(client_info))
                 
-                await websocket.send(json.dumps({
+                await ws_send(websocket, json.dumps({
                     'type': 'log_config_updated',
                     'config': {
                         'interval': client_info.log_push_interval,
@@ -1643,7 +6836,7 @@ class EATISimulation:
             if client_info and logs:
                 client_info.last_log_id = last_id
             
-            await websocket.send(json.dumps({
+            await ws_send(websocket, json.dumps({
                 'type': 'log_history',
                 'data': {
                     'logs': logs,
@@ -1655,7 +6848,7 @@ class EATISimulation:
         elif msg_type == 'get_status':
             # 查询当前状态
             status = self.get_simulation_status()
-            await websocket.send(json.dumps({
+            await ws_send(websocket, json.dumps({
                 'type': MessageType.STATUS_UPDATE.value,
                 'data': status
             }))
@@ -1671,14 +6864,37 @@ class EATISimulation:
                         'capacity': resource.capacity,
                         'utilization': ((resource.capacity - resource.level) / resource.capacity) * 100
                     }
-            await websocket.send(json.dumps({
+            await ws_send(websocket, json.dumps({
                 'type': MessageType.RESOURCE_UPDATE.value,
                 'data': resources_data
             }))
         
+        elif msg_type == 'get_statistics':
+            # 查询时间加权统计
+            await ws_send(websocket, json.dumps({
+                'type': MessageType.STATISTICS.value,
+                'data': self.get_statistics()
+            }, default=str))
+        
+        elif msg_type == 'analyze_critical_path':
+            # 静态关键路径分析（在线程池中计算，不阻塞推送）
+            options = data.get('options', {})
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, self.analyze_critical_path, options.get('source'), options.get('target'),
+                    int(options.get('monte_carlo', 0)))
+            except (KeyError, ValueError) as e:
+                await ws_send(websocket, json.dumps({'type': 'error', 'command': msg_type, 'error': str(e)},
+                                                ensure_ascii=False))
+            else:
+                await ws_send(websocket, json.dumps({
+                    'type': MessageType.CRITICAL_PATH.value,
+                    'data': result
+                }, default=str))
+        
         elif msg_type == 'get_global_vars':
             # 查询全局变量
-            await websocket.send(json.dumps({
+            await ws_send(websocket, json.dumps({
                 'type': MessageType.GLOBAL_VAR_UPDATE.value,
                 'data': self.global_vars.copy()
             }))
@@ -1686,13 +6902,15 @@ class EATISimulation:
         elif msg_type == 'get_step_info':
             # 查询单步信息
             if self.run_state == RunState.STEPPING:
-                await websocket.send(json.dumps({
+                await ws_send(websocket, json.dumps({
                     'type': MessageType.STEP_COMPLETED.value,
                     'data': {
                         'current_time': self.env.now,
                         'step_points': self.step_points,
                         'next_available': self.env.now < SIMULATION_END_TIME,
-                        'waiting_for_step': not self.step_continue
+                        'waiting_for_step': not self.step_continue,
+                        'checkpoints': self.checkpoints.checkpoint_times(),
+                        'breakpoints': self.breakpoints.list()
                     }
                 }))
         
@@ -1718,14 +6936,14 @@ class EATISimulation:
             # 过滤掉日志消息
             messages = [m for m in messages if m['type'] != MessageType.LOG_MESSAGE.value]
             
-            await websocket.send(json.dumps({
+            await ws_send(websocket, json.dumps({
                 'type': 'messages',
                 'data': messages
             }))
 
     def run(self):
         """运行仿真"""
-        log_and_collect('INFO', f'仿真开始运行 - 模式: {RUN_MODE}, 总时长: {SIMULATION_END_TIME}秒')
+        log_and_collect('INFO', '仿真开始运行 - 模式: %s, 总时长: %s秒', RUN_MODE, SIMULATION_END_TIME)
         self.start_time = time.time()
         
         try:
@@ -1734,7 +6952,7 @@ class EATISimulation:
             else:
                 self.run_continuous()
         except Exception as e:
-            log_and_collect('ERROR', f'仿真运行错误: {e}')
+            log_and_collect('ERROR', '仿真运行错误: %s', e)
             raise
         finally:
             log_and_collect('INFO', '仿真运行完成')
@@ -1745,6 +6963,7 @@ class EATISimulation:
         log_and_collect('INFO', '进入单步运行模式，等待步进指令...')
         
         while self.env.now < SIMULATION_END_TIME and self.run_state != RunState.STOPPED:
+            self.checkpoints.maybe_checkpoint()
             self.process_commands()
             
             if self.run_state == RunState.RUNNING:
@@ -1758,20 +6977,12 @@ class EATISimulation:
                     next_time = min(self.env.now + STEP_SIZE, SIMULATION_END_TIME)
                     
                     try:
-                        self.env.run(until=next_time)
+                        self.breakpoints.run(next_time)
                     except simpy.Interrupt:
                         pass
                     
                     # 记录步骤完成
-                    message_collector.add_message(SimulationMessage(
-                        type=MessageType.STEP_COMPLETED,
-                        data={
-                            'step_start': step_start_time,
-                            'step_end': self.env.now,
-                            'step_points': self.step_points,
-                            'next_available': self.env.now < SIMULATION_END_TIME
-                        }
-                    ))
+                    self.report_step(step_start_time)
                     
                     self.step_continue = False
                     logging.info(f'单步执行完成: {step_start_time:.1f}s -> {self.env.now:.1f}s')
@@ -1798,7 +7009,16 @@ class EATISimulation:
                 break
             
             step_time = min(0.1, SIMULATION_END_TIME - self.env.now)
-            self.env.run(until=self.env.now + step_time)
+            self.breakpoints.run(self.env.now + step_time)
+            self.checkpoints.maybe_checkpoint()
+            
+            # 命中断点时转入单步模式
+            if self.breakpoints.hit:
+                self.run_state = RunState.STEPPING
+                self.report_step(self.env.now)
+                logging.info('命中断点，切换到单步模式')
+                self.run_step_mode()
+                break
             
             if self.time_ratio > 0:
                 real_elapsed = time.time() - start_real_time
@@ -1807,12 +7027,131 @@ class EATISimulation:
                 if expected_real_time > real_elapsed:
                     time.sleep(expected_real_time - real_elapsed)
 
+    def fast_forward(self, target_time: float):
+        """不按实时比例、不在单步点停留地推进到目标时刻，之后恢复原运行状态"""
+        target_time = min(target_time, SIMULATION_END_TIME)
+        if target_time <= self.env.now:
+            return
+        
+        saved_state = self.run_state
+        self.run_state = RunState.RUNNING
+        try:
+            self.env.run(until=target_time)
+        finally:
+            self.run_state = saved_state
+            self.step_continue = False
+
+    def report_step(self, step_start_time: float):
+        """记录步骤完成（附带命中的断点）"""
+        message_collector.add_message(SimulationMessage(
+            type=MessageType.STEP_COMPLETED,
+            data={
+                'step_start': step_start_time,
+                'step_end': self.env.now,
+                'step_points': self.step_points,
+                'next_available': self.env.now < SIMULATION_END_TIME,
+                'breakpoint': self.breakpoints.consume_hit()
+            }
+        ))
+
+    def _is_step_target(self, event: simpy.Event, entity: Any = None) -> bool:
+        """判断事件是否为单步目标：跳过周期性监视、单步等待轮询及无回调事件，可限定为某实体的事件
+
+        单步等待事件由 step_wait 标记，事件归属取等待它的进程的 owner（由 start_process/child_process 设置）。
+        """
+        if not event.callbacks or getattr(event, 'step_wait', False):
+            return False
+        for callback in event.callbacks:
+            process = getattr(callback, '__self__', None)
+            if process is event:
+                continue  # 条件事件自身的取值回调
+            if isinstance(process, simpy.events.Condition):
+                # 条件事件（any_of/all_of）按等待该条件的进程判断
+                if self._is_step_target(process, entity):
+                    return True
+                continue
+            if not isinstance(process, simpy.Process):
+                if entity is None:
+                    return True
+                continue
+            if process in self.background_processes:
+                continue
+            if entity is None or getattr(process, 'owner', None) is entity:
+                return True
+        return False
+
+    def step_to_next_event(self, entity_id: str = None):
+        """跳到下一个有效事件（或指定实体的下一个事件）并处理该时刻的全部事件"""
+        entity = self.entities.get(entity_id) if entity_id else None
+        if entity_id and entity is None:
+            log_and_collect('WARNING', '未知实体: %s', entity_id)
+            return
+        
+        self.breakpoints.consume_hit()
+        step_start_time = self.env.now
+        self.step_points.clear()
+        saved_state = self.run_state
+        self.run_state = RunState.RUNNING
+        try:
+            while self.env.peek() <= SIMULATION_END_TIME and not self.breakpoints.hit:
+                target = self._is_step_target(peek_entry(self.env)[3], entity)
+                self.env.step()
+                if target:
+                    while self.env.peek() == self.env.now:
+                        self.env.step()
+                    break
+        finally:
+            self.run_state = saved_state
+            self.step_continue = False
+        
+        self.report_step(step_start_time)
+        logging.info(f'事件单步完成: {step_start_time:.1f}s -> {self.env.now:.1f}s')
+
+    def run_until(self, condition: str = None, activity: str = None, entity_id: str = None,
+                  max_time: float = None):
+        """不按实时比例地运行，直到条件成立或指定Activity开始（一次性断点）"""
+        if not condition and not activity:
+            log_and_collect('WARNING', 'run_until需要指定condition或activity')
+            return
+        self.breakpoints.consume_hit()
+        try:
+            if condition:
+                bp = self.breakpoints.add('condition', condition, once=True)
+                if bp.last_value:
+                    self.breakpoints.remove(bp.bp_id)
+                    log_and_collect('INFO', '条件已成立: %s', condition)
+                    return
+            else:
+                bp = self.breakpoints.add('activity', activity, entity_id=entity_id, once=True)
+        except (SyntaxError, ValueError) as e:
+            log_and_collect('WARNING', '无效的断点: %s', e)
+            return
+        
+        step_start_time = self.env.now
+        self.step_points.clear()
+        limit = SIMULATION_END_TIME if max_time is None else min(self.env.now + max_time, SIMULATION_END_TIME)
+        saved_state = self.run_state
+        self.run_state = RunState.RUNNING
+        try:
+            self.breakpoints.run(limit)
+        finally:
+            self.run_state = saved_state
+            self.step_continue = False
+            self.breakpoints.remove(bp.bp_id)
+        
+        self.report_step(step_start_time)
+        logging.info(f'运行到断点: {step_start_time:.1f}s -> {self.env.now:.1f}s')
+
     def process_commands(self):
         """处理所有待处理的命令"""
         while not self.command_queue.empty():
             try:
                 command = self.command_queue.get_nowait()
+                command_start = time.perf_counter()
                 self.process_command(command)
+                if trace_exporter is not None:
+                    trace_exporter.server_span('sim_command', str(command.get('type')), command_start,
+                                               time.perf_counter(), {'sim_time': self.env.now})
             except queue.Empty:
                 break
 
@@ -1842,11 +7181,54 @@ class EATISimulation:
             
         elif cmd_type == 'change_speed':
             self.time_ratio = command.get('speed_ratio', 1.0)
-            log_and_collect('INFO', f'仿真速度调整为: {self.time_ratio}x')
+            log_and_collect('INFO', '仿真速度调整为: %sx', self.time_ratio)
             
         elif cmd_type == 'stop':
             self.run_state = RunState.STOPPED
             log_and_collect('INFO', '仿真已停止')
+
+        elif cmd_type in ('step_event', 'step_entity', 'run_until'):
+            # 事件级单步/运行到断点，完成后停在单步模式
+            self.run_state = RunState.STEPPING
+            if cmd_type == 'run_until':
+                self.run_until(command.get('condition'), command.get('activity'),
+                               command.get('entity'), command.get('max_time'))
+            else:
+                self.step_to_next_event(command.get('entity'))
+
+        elif cmd_type == 'set_breakpoint':
+            try:
+                bp = self.breakpoints.add(command.get('kind', 'condition'), command.get('spec', ''),
+                                          entity_id=command.get('entity'), once=command.get('once', False))
+                log_and_collect('INFO', '已设置断点 #%s: %s %s', bp.bp_id, bp.kind, bp.spec)
+            except (SyntaxError, ValueError) as e:
+                log_and_collect('WARNING', '无效的断点: %s', e)
+
+        elif cmd_type == 'clear_breakpoint':
+            if command.get('id') is None:
+                self.breakpoints.clear()
+                log_and_collect('INFO', '已清除全部断点')
+            elif self.breakpoints.remove(int(command['id'])):
+                log_and_collect('INFO', '已清除断点 #%s', command["id"])
+
+        elif cmd_type == 'rewind':
+            # 回退到指定仿真时刻（成功时由检查点进程接管，本进程不再返回）
+            self.checkpoints.rewind(float(command.get('time', 0)))
+
+        elif cmd_type in DIAGNOSTIC_COMMANDS:
+            self.run_diagnostic(command)
+
+        elif cmd_type == 'set_instrumentation':
+            level = command.get('level')
+            activity = command.get('activity')
+            try:
+                set_instrumentation_level(level, activity)
+                if activity:
+                    log_and_collect('INFO', '埋点级别调整为: %s (Activity: %s)', level, activity)
+                else:
+                    log_and_collect('INFO', '埋点级别调整为: %s', level)
+            except ValueError:
+                log_and_collect('WARNING', '无效的埋点级别: %s', level)
         
         # 记录状态变化
         if old_state != self.run_state:
@@ -1855,6 +7237,23 @@ class EATISimulation:
                 data={'old_state': old_state.value, 'new_state': self.run_state.value}
             ))
 
+    def run_diagnostic(self, command: Dict):
+        """在仿真线程上执行诊断命令，结果加入消息收集器并回复给发出命令的客户端"""
+        cmd_type = command.get('type')
+        try:
+            msg_type, result = self.diagnostics.execute(command)
+            data = dict(result, command=cmd_type, status='ok')
+            log_and_collect('INFO', '诊断命令 %s 完成', cmd_type)
+        except (ValueError, TypeError) as e:
+            msg_type = MessageType.PROFILE_RESULT if cmd_type.startswith('profile') else MessageType.MEMORY_REPORT
+            data = {'command': cmd_type, 'status': 'error', 'error': str(e)}
+            log_and_collect('WARNING', '诊断命令 %s 失败: %s', cmd_type, e)
+        message_collector.add_message(SimulationMessage(type=msg_type, data=data))
+        websocket = command.get('reply_to')
+        if websocket is not None and self.ws_loop is not None:
+            payload = json.dumps({'type': msg_type.value, 'data': data}, default=str)
+            asyncio.run_coroutine_threadsafe(ws_send(websocket, payload), self.ws_loop)
+
     def record_completion(self):
         """记录仿真完成"""
         status = self.get_simulation_status()
@@ -1869,6 +7268,40 @@ class EATISimulation:
             }
         ))
 
+    def build_results(self) -> Dict:
+        """汇总仿真结果"""
+        return {
+            'simulation_info': {
+                'name': '侦察-火力打击仿真',
+                'total_time': SIMULATION_END_TIME,
+                'end_time': self.env.now,
+                'completion_rate': (self.env.now / SIMULATION_END_TIME) * 100
+            },
+            'final_status': self.get_simulation_status(),
+            'global_vars': self.global_vars,
+            'events_triggered': list(self.event_scheduler.events.keys()),
+            'channels': self.message_bus.get_statistics(),
+            'statistics': self.get_statistics()
+        }
+
+    def get_statistics(self) -> Dict:
+        """资源与状态变量的时间加权统计"""
+        return {
+            'simulation_time': self.env.now,
+            'resources': {res_id: resource.monitor.to_dict(resource) for res_id, resource in self.resources.items()
+                          if hasattr(resource, 'monitor')},
+            'state_variables': self.state_monitor.to_dict()
+        }
+
+    def analyze_critical_path(self, source: str, target: str, monte_carlo: int = 0) -> Dict:
+        """静态分析source到target的动作链时长；加载了模型时分析该模型，否则分析默认场景"""
+        if self.path_analyzer is None:
+            if self.model_runtime is not None:
+                self.path_analyzer = CriticalPathAnalyzer(self.model_runtime.model)
+            else:
+                self.path_analyzer = CriticalPathAnalyzer.for_scenario()
+        return self.path_analyzer.analyze(source, target, monte_carlo)
+
     def get_simulation_status(self) -> Dict:
         """获取仿真状态（增加了activity名称字段）"""
         progress = (self.env.now / SIMULATION_END_TIME) * 100
@@ -1886,12 +7319,12 @@ class EATISimulation:
                 'current_activity_chinese_name': getattr(entity, 'current_activity_chinese_name', None),  # 新增
             }
             
-            if entity_id == 'ent_command_post':
+            if isinstance(entity, CommandPost):
                 entity_status['alert_level'] = entity.alert_level
-            elif entity_id == 'ent_artillery_battalion':
+            elif isinstance(entity, ArtilleryBattalion):
                 entity_status['fire_status'] = entity.fire_status
                 entity_status['rounds_fired'] = entity.rounds_fired
-            elif entity_id == 'ent_recon_squad':
+            elif isinstance(entity, ReconSquad):
                 entity_status['patrol_status'] = entity.patrol_status
                 entity_status['enemy_contact'] = entity.enemy_contact
             
@@ -1920,10 +7353,159 @@ class EATISimulation:
             'step_mode': self.run_state == RunState.STEPPING
         }
 
+# 分支运行器（共享仿真前缀的what-if分析）
+class BranchingRunner:
+    """分支运行器 - 将一个仿真推进到分支点后fork出多个分支，各自应用参数覆盖或重设随机种子
+
+    分支点可以是仿真时刻(branch_time)，也可以是监视条件(branch_condition)：
+    全局变量名（如 'EnemyDetected'）或接收仿真对象的可调用对象，先满足者为准。
+    前缀只计算一次，各分支通过fork写时复制共享前缀状态。
+
+    分支定义示例::
+
+        {'name': 'more_ammo', 'seed': 7,
+         'overrides': {'global_vars': {...}, 'entities': {'ent_artillery_battalion': {'fire_status': 'ready'}},
+                       'resources': {'res_artillery_rounds': 200}},
+         'apply': lambda simulation: ...}
+    """
+    def __init__(self, branch_time: float = None, branch_condition: Any = None,
+                 end_time: float = None, max_parallel: int = None):
+        if branch_time is None and branch_condition is None:
+            raise ValueError('必须指定branch_time或branch_condition')
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('当前平台不支持os.fork，无法运行分支分析')
+        self.branch_time = branch_time
+        self.branch_condition = branch_condition
+        self.end_time = end_time if end_time is not None else SIMULATION_END_TIME
+        self.max_parallel = max_parallel or os.cpu_count() or 1
+        self.simulation = None
+
+    def _condition_met(self) -> bool:
+        condition = self.branch_condition
+        if condition is None:
+            return False
+        if isinstance(condition, str):
+            return bool(self.simulation.global_vars.get(condition))
+        return bool(condition(self.simulation))
+
+    def advance_to_branch_point(self) -> float:
+        """推进共享前缀直到分支点"""
+        env = self.simulation.env
+        limit = min(self.branch_time if self.branch_time is not None else self.end_time, self.end_time)
+
+        if self.branch_condition is None:
+            self.simulation.fast_forward(limit)
+        else:
+            self.simulation.run_state = RunState.RUNNING
+            while not self._condition_met() and env.peek() <= limit:
+                env.step()
+            if not self._condition_met() and env.now < limit:
+                env.run(until=limit)
+
+        log_and_collect('INFO', '到达分支点: 仿真时间 %.1fs', env.now)
+        return env.now
+
+    def run(self, branches: List[Dict]) -> List[Dict]:
+        """运行全部分支，按分支顺序返回结果"""
+        self.simulation = EATISimulation()
+        self.simulation.run_state = RunState.RUNNING
+        self.simulation.setup(enable_websocket=False)
+        branch_point = self.advance_to_branch_point()
+
+        results: List[Optional[Dict]] = [None] * len(branches)
+        running = deque()  # (分支序号, pid, 读端)
+
+        for index, branch in enumerate(branches):
+            if len(running) >= self.max_parallel:
+                self._collect(running.popleft(), results)
+            running.append(self._launch(index, branch, branch_point))
+
+        while running:
+            self._collect(running.popleft(), results)
+
+        return results
+
+    def _launch(self, index: int, branch: Dict, branch_point: float) -> tuple:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            exit_code = 0
+            try:
+                reinit_after_fork()
+                detach_tracing()
+                activity_logger.start_new_file(f'branch_{index}')
+                payload = self._run_branch(index, branch, branch_point)
+            except BaseException as e:
+                payload = {'branch': branch.get('name', f'branch_{index}'), 'error': str(e)}
+                exit_code = 1
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    f.write(json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8'))
+                log_pipeline.stop()
+            except Exception as e:
+                sys.stderr.write(f'分支进程收尾失败: {e}\n')
+            finally:
+                os._exit(exit_code)
+
+        os.close(write_fd)
+        return index, pid, read_fd
+
+    def _collect(self, running_branch: tuple, results: List[Optional[Dict]]):
+        index, pid, read_fd = running_branch
+        with os.fdopen(read_fd, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        try:
+            results[index] = json.loads(data.decode('utf-8'))
+        except ValueError:
+            results[index] = {'branch': f'branch_{index}', 'error': '分支进程未返回结果'}
+
+    def _run_branch(self, index: int, branch: Dict, branch_point: float) -> Dict:
+        """在子进程中运行单个分支"""
+        simulation = self.simulation
+        name = branch.get('name', f'branch_{index}')
+
+        if branch.get('seed') is not None:
+            random.seed(branch['seed'])
+            np.random.seed(branch['seed'])
+
+        overrides = branch.get('overrides', {})
+        simulation.global_vars.update(overrides.get('global_vars', {}))
+        for entity_id, attrs in overrides.get('entities', {}).items():
+            entity = simulation.entities[entity_id]
+            for attr, value in attrs.items():
+                setattr(entity, attr, value)
+        for res_id, level in overrides.get('resources', {}).items():
+            container = simulation.resources[res_id]
+            if level > container.level:
+                container.put(level - container.level)
+            elif level < container.level:
+                container.get(container.level - level)
+        if branch.get('apply'):
+            branch['apply'](simulation)
+
+        wall_start = time.time()
+        simulation.fast_forward(self.end_time)
+
+        return {
+            'branch': name,
+            'seed': branch.get('seed'),
+            'overrides': overrides,
+            'branch_time': branch_point,
+            'wall_time': time.time() - wall_start,
+            'results': simulation.build_results()
+        }
+
 # Main Entry Point
-def main():
-    """主入口点"""
+def main(model_path: str = None):
+    """主入口点；model_path指定EATI XML时解释执行该模型"""
     try:
+        model = None
+        if model_path:
+            model = load_model(model_path)
+            apply_model_config(model)
+        
         logging.info(f"侦察-火力打击仿真程序启动 (增强Activity名称输出版) - PID: {os.getpid()}")
         logging.info(f"WebSocket端口: {WS_PORT}")
         logging.info(f"运行模式: {RUN_MODE}")
@@ -1933,34 +7515,27 @@ def main():
         logging.info("增量日志推送，默认只推送INFO及以上级别")
         logging.info("所有Activity都将记录开始和完成状态，包含activity_name和activity_chinese_name字段")
         
+        if TRACE_FILE:
+            start_tracing(TRACE_FILE)
+        
         global env
         simulation = EATISimulation()
         env = simulation.env
         
-        simulation.setup()
+        simulation.setup(model=model)
         time.sleep(1)
         simulation.run()
         
     except KeyboardInterrupt:
         log_and_collect('INFO', '仿真被用户中断')
     except Exception as e:
-        log_and_collect('ERROR', f'仿真错误: {e}')
+        log_and_collect('ERROR', '仿真错误: %s', e)
         logging.exception("仿真程序异常退出")
         raise
     finally:
         try:
             if 'simulation' in locals():
-                results = {
-                    'simulation_info': {
-                        'name': '侦察-火力打击仿真',
-                        'total_time': SIMULATION_END_TIME,
-                        'end_time': simulation.env.now,
-                        'completion_rate': (simulation.env.now / SIMULATION_END_TIME) * 100
-                    },
-                    'final_status': simulation.get_simulation_status(),
-                    'global_vars': simulation.global_vars,
-                    'events_triggered': list(simulation.event_scheduler.events.keys())
-                }
+                results = simulation.build_results()
                 
                 with open('detect_fire_simulation_results.json', 'w', encoding='utf-8') as f:
                     json.dump(results, f, ensure_ascii=False, indent=2)
@@ -1969,7 +7544,7 @@ def main():
                 
                 # 生成Activity时间线报告
                 activity_logger.generate_summary_report('activity_execution_summary.json')
-                log_and_collect('INFO', f'Activity时间线已保存到: {activity_logger.log_file_path}')
+                log_and_collect('INFO', 'Activity时间线已保存到: %s', activity_logger.log_file_path)
                 log_and_collect('INFO', 'Activity执行摘要已保存到: activity_execution_summary.json')
                 
                 if simulation.global_vars.get('DamageAssessment', 0) >= 0.8:
@@ -1984,6 +7559,27 @@ def main():
                 simulation.ws_loop.call_soon_threadsafe(simulation.ws_loop.stop)
         except:
             pass
+        
+        # 丢弃检查点进程，写完追踪文件，输出日志队列中剩余的日志
+        if 'simulation' in locals():
+            simulation.checkpoints.discard_all()
+        stop_tracing()
+        try:
+            log_pipeline.stop()
+        except Exception as e:
+            sys.stderr.write(f'停止日志监听线程失败: {e}\n')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if '--benchmark-queue' in sys.argv:
+        benchmark_event_queues()
+    elif '--benchmark-actions' in sys.argv:
+        benchmark_action_execution()
+    elif '--analyze' in sys.argv:
+        index = sys.argv.index('--analyze')
+        analyze_action_chain(sys.argv[index + 1], sys.argv[index + 2],
+                             sys.argv[sys.argv.index('--model') + 1] if '--model' in sys.argv else None,
+                             int(sys.argv[sys.argv.index('--monte-carlo') + 1]) if '--monte-carlo' in sys.argv else 0)
+    elif '--model' in sys.argv:
+        main(sys.argv[sys.argv.index('--model') + 1])
+    else:
+        main()
\ No newline at end of file
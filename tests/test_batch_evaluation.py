@@ -0,0 +1,62 @@
+"""批量表达式计算：向量化路径与逐实体路径的结果必须一致"""
+import os
+import random
+import sys
+import types
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixed_simulation_with_activity_names as sim  # noqa: E402
+
+HEALTH = [0.0, 1.0, 2.0, 3.0]
+AMMO = [0, 4, 0, 2]
+
+EXPRESSIONS = [
+    'self.health or 5',
+    'self.health and 7',
+    'self.health / self.ammo',
+    'self.ammo > 0 and self.health / self.ammo > 0.5',
+    'self.health > 1 and self.ammo > 0',
+    'not self.health or self.ammo >= 2',
+    'self.health * 2 + self.ammo',
+    'max(self.health, self.ammo) - min(self.health, 1)',
+    '1 < self.health <= 3',
+    'self.health if self.ammo else -1',
+    'self.health + random()',
+    'random() < 0.5 and self.ammo > 0',
+]
+
+
+def make_evaluator() -> sim.BatchExpressionEvaluator:
+    entities = [types.SimpleNamespace(health=health, ammo=ammo) for health, ammo in zip(HEALTH, AMMO)]
+    return sim.BatchExpressionEvaluator(sim.EntityAttributeBatch(entities, ['health', 'ammo']))
+
+
+def normalize(values):
+    return [None if value is None else float(value) for value in np.asarray(values, dtype=object).tolist()]
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_batch_matches_per_entity(expression):
+    random.seed(1234)
+    batch = make_evaluator().evaluate(expression)
+    batch_state = random.getstate()
+
+    random.seed(1234)
+    per_entity = make_evaluator().evaluate_per_entity(expression)
+
+    assert normalize(batch) == pytest.approx(normalize(per_entity))
+    assert batch_state == random.getstate()
+
+
+@pytest.mark.parametrize('expression, vectorized', [
+    ('self.health > 1 and self.ammo > 0', True),
+    ('not self.health or self.ammo >= 2', True),
+    ('self.health or 5', False),
+    ('self.health and 7', False),
+])
+def test_bool_op_vectorized_only_for_boolean_operands(expression, vectorized):
+    assert (make_evaluator()._compile(expression) is not None) == vectorized